@@ -61,5 +61,9 @@ app.conf.beat_schedule = {
             day_of_week='mon,tue,wed,thu,fri'),
         'args': None
     },
+    'enrich-assets-hourly': {
+        'task': 'enrich_assets',
+        'schedule': crontab(minute=0),
+    },
 }
 app.conf.timezone = 'UTC'
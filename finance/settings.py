@@ -47,6 +47,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django.contrib.admin',
     'django.contrib.humanize',
+    'rest_framework',
 ]
 
 MIDDLEWARE = [
@@ -96,6 +97,90 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# Shared by web and workers when pointed to memcached/redis
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    },
+}
+
+# Seconds after the last transaction write before the portfolio is
+# consolidated in background, and the most a burst of writes delays it
+CONSOLIDATION_DEBOUNCE = config('CONSOLIDATION_DEBOUNCE', default=5, cast=int)
+CONSOLIDATION_MAX_DELAY = config('CONSOLIDATION_MAX_DELAY', default=60, cast=int)
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.IsAuthenticated',
+    ],
+}
+
+# Seconds a rendered portfolio detail page is kept, the cache key already
+# changes with the data it shows
+PORTFOLIO_DETAIL_CACHE_TIMEOUT = config('PORTFOLIO_DETAIL_CACHE_TIMEOUT',
+    default=3600, cast=int)
+
+# Seconds the admin changelists reuse a row count
+ADMIN_COUNT_CACHE_TIMEOUT = config('ADMIN_COUNT_CACHE_TIMEOUT', default=60, cast=int)
+
+# Rows of an uploaded file committed together by an import job
+IMPORT_JOB_CHUNK_SIZE = config('IMPORT_JOB_CHUNK_SIZE', default=1000, cast=int)
+
+# Concurrent ticker info lookups of the asset import, and the seconds before
+# the assets stored with placeholder metadata are looked up again
+ASSET_INFO_WORKERS = config('ASSET_INFO_WORKERS', default=16, cast=int)
+ASSET_INFO_RETRY_DELAY = config('ASSET_INFO_RETRY_DELAY', default=300, cast=int)
+
+# Seconds the ticker symbol stored on an asset is used before it is looked
+# up again
+ASSET_INFO_TTL = config('ASSET_INFO_TTL', default=604800, cast=int)
+
+# Assets whose prices are fetched with one quote request and written with
+# one UPDATE by the scheduled refresh
+PRICE_REFRESH_CHUNK_SIZE = config('PRICE_REFRESH_CHUNK_SIZE', default=100, cast=int)
+
+# Quote requests of a refresh in flight at the same time, in total and to
+# one host. The latter should not be above QUOTE_SERVICE_POOL_SIZE
+PRICE_REFRESH_CONCURRENCY = config('PRICE_REFRESH_CONCURRENCY', default=32, cast=int)
+PRICE_REFRESH_PER_HOST = config('PRICE_REFRESH_PER_HOST', default=16, cast=int)
+
+# Connections kept open per process to the quote service: hosts and
+# connections per host, the latter at least ASSET_INFO_WORKERS. Failed calls
+# are retried QUOTE_SERVICE_RETRIES times with a jittered backoff starting
+# at QUOTE_SERVICE_BACKOFF seconds
+QUOTE_SERVICE_POOL_CONNECTIONS = config('QUOTE_SERVICE_POOL_CONNECTIONS',
+    default=4, cast=int)
+QUOTE_SERVICE_POOL_SIZE = config('QUOTE_SERVICE_POOL_SIZE', default=16, cast=int)
+QUOTE_SERVICE_RETRIES = config('QUOTE_SERVICE_RETRIES', default=2, cast=int)
+QUOTE_SERVICE_BACKOFF = config('QUOTE_SERVICE_BACKOFF', default=0.5, cast=float)
+
+# The quote service is not called for QUOTE_CIRCUIT_RESET seconds after
+# QUOTE_CIRCUIT_FAILURES failed calls within as many seconds
+QUOTE_CIRCUIT_FAILURES = config('QUOTE_CIRCUIT_FAILURES', default=5, cast=int)
+QUOTE_CIRCUIT_RESET = config('QUOTE_CIRCUIT_RESET', default=30, cast=int)
+
+# Requests per second to the quote service (0 for no limit) and the burst
+# above it. The bucket is shared in Redis when QUOTE_RATE_LIMIT_REDIS_URL is
+# set, otherwise every process has its own. A request waits at most
+# QUOTE_RATE_MAX_WAIT seconds for its turn. The burst takes a whole fan-out
+# of PRICE_REFRESH_CONCURRENCY requests, and PRICE_REFRESH_CONCURRENCY /
+# QUOTE_RATE_LIMIT, the longest wait in a queue that deep, should stay well
+# below QUOTE_RATE_MAX_WAIT
+QUOTE_RATE_LIMIT = config('QUOTE_RATE_LIMIT', default=20, cast=float)
+QUOTE_RATE_BURST = config('QUOTE_RATE_BURST', default=32, cast=int)
+QUOTE_RATE_LIMIT_REDIS_URL = config('QUOTE_RATE_LIMIT_REDIS_URL', default='')
+QUOTE_RATE_MAX_WAIT = config('QUOTE_RATE_MAX_WAIT', default=10, cast=float)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -22,6 +22,7 @@ from portfolio import urls as portfolio_urls
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('admin/portfolio/view/', include('portfolio.urls')),
+    path('api/', include('portfolio.api_urls')),
 ]+ static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 admin.site.site_header = "Finance Admin"
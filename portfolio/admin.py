@@ -3,26 +3,38 @@ from django.contrib import admin
 # Register your models here.
 from .models import Portfolio, Asset, AssetType, StockTransaction, FiiTransaction
 from django.forms import ModelChoiceField, CharField, ModelForm, BaseModelForm, TextInput, Textarea, HiddenInput
-from django.db.models import Sum, F
+from django.db.models import Sum, F, Q
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ALL_VAR, ORDER_VAR, PAGE_VAR
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
 from django.core.exceptions import ValidationError
 from django.utils.html import format_html
 from django.urls import reverse, path
 from django.contrib.admin import AdminSite
 from portfolio.selectors import (
     get_portfolios,
+    get_portfolios_total_value,
     get_fii_transactions_user,
     get_stock_transactions_user,
     get_fiis,
-    get_stocks
+    get_stocks,
+    get_import_jobs
 )
 from portfolio.services import (
-    get_total_value_portfolio,
     create_portfolio,
     create_fii_transaction,
     create_stock_transaction,
-    create_asset
+    create_asset,
+    refresh_asset_info,
+    resume_import_job
 )
-from portfolio.models import Transaction
+from portfolio.models import Transaction, ImportJob
+from portfolio.signals import deferred_unconsolidation
+import hashlib
 
 class PortfolioAdmin(admin.ModelAdmin):
 
@@ -37,11 +49,12 @@ class PortfolioAdmin(admin.ModelAdmin):
                 **form.cleaned_data)
 
     def get_queryset(self, request):
-        return get_portfolios(fetched_by=request.user)
+        return get_portfolios_total_value(fetched_by=request.user)
 
     def get_total(obj):
-        return "%2.2f" % (get_total_value_portfolio(portfolio=obj))
+        return "%2.2f" % obj.total_value
     get_total.short_description = 'Total Value'
+    get_total.admin_order_field = 'total_value'
 
     def show_view_link(obj):
         return format_html("<a href='{0}'>Visualizar</a>",
@@ -79,6 +92,12 @@ class AssetAdmin(admin.ModelAdmin):
     get_current_price.short_description = 'Current Price'
 
     list_display = ('ticker','name',get_current_price, 'last_update')
+    actions = ['refresh_info']
+
+    def refresh_info(self, request, queryset):
+        refreshed = sum(refresh_asset_info(asset=asset) for asset in queryset)
+        self.message_user(request, '%d assets refreshed' % refreshed)
+    refresh_info.short_description = 'Refresh ticker info of selected assets'
 
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
@@ -140,9 +159,87 @@ class TransactionForm(ModelForm):
                 return self.instance.asset.ticker
         return super().get_initial_for_field(field, field_name)"""
 
+class CachedCountPaginator(Paginator):
+    # COUNT(*) of a changelist is reused for a while, keyed by its query
+    @cached_property
+    def count(self):
+        key = 'admin-count-%s' % hashlib.md5(
+            str(self.object_list.query).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, timeout=settings.ADMIN_COUNT_CACHE_TIMEOUT)
+        return count
+
+AFTER_VAR = 'after'
+
+class KeysetChangeList(ChangeList):
+    # With the default ordering (newest first) the next page starts after
+    # the (transaction_date, id) of the last row shown instead of an OFFSET.
+    # Sorting by a column falls back to numbered pages
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        self.keyset = ORDER_VAR not in self.params and ALL_VAR not in self.params
+        if not self.keyset:
+            return super().get_results(request)
+
+        qs = self.queryset
+        after = self.params.get(AFTER_VAR)
+        if after:
+            date, _, pk = after.rpartition('_')
+            date = parse_datetime(date)
+            if date is None or not pk.isdigit():
+                raise IncorrectLookupParameters
+            qs = qs.filter(Q(transaction_date__lt=date) |
+                Q(transaction_date=date, pk__lt=int(pk)))
+        rows = list(qs[:self.list_per_page + 1])
+
+        self.result_list = rows[:self.list_per_page]
+        self.next_url = None
+        if len(rows) > self.list_per_page:
+            last = self.result_list[-1]
+            self.next_url = self.get_query_string({AFTER_VAR: '%s_%s' % (
+                last.transaction_date.isoformat(), last.pk)}, [PAGE_VAR])
+        self.first_url = self.get_query_string(remove=[AFTER_VAR, PAGE_VAR]) \
+            if after else None
+        self.paginator = self.model_admin.get_paginator(request,
+            self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = bool(self.next_url or after)
+
 class TransactionAdmin(admin.ModelAdmin):
 
     change_list_template = 'admin/change_list_with_upload.html'
+    paginator = CachedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('asset',)
+    ordering = ('-transaction_date', '-id')
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        # An exact ticker is served by the unique index on Asset.ticker,
+        # other terms go through search_fields
+        ticker = search_term.strip().upper()
+        if ticker:
+            found = queryset.filter(asset__ticker=ticker)
+            if found.exists():
+                return found, False
+        return super(TransactionAdmin, self).get_search_results(request,
+            queryset, search_term)
+
+    def delete_queryset(self, request, queryset):
+        with deferred_unconsolidation():
+            super(TransactionAdmin, self).delete_queryset(request, queryset)
 
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
@@ -232,8 +329,29 @@ class FiiTransactionAdmin(TransactionAdmin):
             create_stock_transaction(user=request.user,
                 **form.cleaned_data)
 
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'kind', 'portfolio', 'status', 'processed_rows',
+        'total_rows', 'imported_rows', 'error_count', 'created_at', 'last_update')
+    list_filter = ('kind', 'status')
+    readonly_fields = list_display[1:] + ('file', 'errors')
+    fields = readonly_fields
+    actions = ['resume_jobs']
+
+    def get_queryset(self, request):
+        return get_import_jobs(fetched_by=request.user).select_related('portfolio')
+
+    def has_add_permission(self, request):
+        return False
+
+    def resume_jobs(self, request, queryset):
+        resumed = sum(resume_import_job(user=request.user, job=job)
+            for job in queryset)
+        self.message_user(request, '%d import jobs resumed' % resumed)
+    resume_jobs.short_description = 'Resume selected import jobs'
+
 admin.site.register(AssetType)
 admin.site.register(Asset, AssetAdmin)
 admin.site.register(Portfolio, PortfolioAdmin)
 admin.site.register(StockTransaction, StockTransactionAdmin)
 admin.site.register(FiiTransaction, FiiTransactionAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
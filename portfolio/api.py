@@ -0,0 +1,162 @@
+from django.db.models import Count, Max, Q, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from portfolio.selectors import (
+    get_portfolios,
+    get_assets_consolidated,
+    get_portfolio_consolidated,
+    get_import_jobs
+)
+from portfolio.services import (
+    get_portfolio_detail_cache_key,
+    check_results_permission
+)
+from portfolio.serializers import (
+    PortfolioSerializer,
+    PortfolioConsolidatedSerializer,
+    PositionSerializer,
+    ResultSerializer,
+    ImportJobSerializer
+)
+import hashlib
+
+
+class KeysetPagination(CursorPagination):
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class ValuesAPIView(APIView):
+    # Read only endpoints over QuerySet.values(). get_etag returns a key that
+    # changes with the data, a matching If-None-Match gets a 304 before any
+    # row is read. Subclasses define get_rows, which returns the Response
+    serializer_class = None
+    # Views over the consolidated results need the same permission as the
+    # results page
+    results_permission = False
+
+    def get_etag(self, request, **kwargs):
+        return None
+
+    def get_serializer(self, request, **kwargs):
+        fields = request.query_params.get('fields')
+        fields = [f for f in fields.split(',') if f] if fields else None
+        return self.serializer_class(fields=fields, **kwargs)
+
+    def get_portfolio(self, request, portfolio_id):
+        portfolio = get_portfolios(fetched_by=request.user,
+            filters={'pk': portfolio_id}).first()
+        if portfolio is None:
+            raise NotFound
+        if self.results_permission:
+            check_results_permission(portfolio=portfolio, user=request.user)
+        return portfolio
+
+    def paginate(self, request, serializer, queryset):
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(serializer.values(queryset),
+            request, view=self)
+        return paginator.get_paginated_response(
+            serializer.to_representation(page))
+
+    def get(self, request, **kwargs):
+        etag = self.get_etag(request, **kwargs)
+        if etag is not None:
+            etag = quote_etag(hashlib.md5(('%s %s %s' % (etag,
+                request.get_full_path(),
+                request.accepted_renderer.format)).encode()).hexdigest())
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                return not_modified
+        response = self.get_rows(request, **kwargs)
+        if etag is not None:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class PortfolioListAPI(ValuesAPIView):
+    serializer_class = PortfolioSerializer
+
+    def get_etag(self, request):
+        state = get_portfolios(fetched_by=request.user).aggregate(
+            count=Count('pk'),
+            consolidated=Count('pk', filter=Q(consolidated=True)),
+            versions=Sum('consolidation_version'),
+            last_update=Max('last_update'))
+        return 'portfolios-%s-%s' % (request.user.pk,
+            '-'.join(str(v) for v in state.values()))
+
+    def get_rows(self, request):
+        return self.paginate(request, self.get_serializer(request),
+            get_portfolios(fetched_by=request.user))
+
+
+class PortfolioDetailAPI(ValuesAPIView):
+    serializer_class = PortfolioSerializer
+
+    def get_etag(self, request, portfolio_id):
+        self.portfolio = self.get_portfolio(request, portfolio_id)
+        return '%s-%s' % (get_portfolio_detail_cache_key(
+            portfolio=self.portfolio, user=request.user),
+            self.portfolio.last_update.isoformat())
+
+    def get_rows(self, request, portfolio_id):
+        serializer = self.get_serializer(request)
+        data = serializer.to_representation([{name: getattr(self.portfolio, name)
+            for name in serializer.fields}])[0]
+        consolidated = PortfolioConsolidatedSerializer()
+        data['consolidated_totals'] = consolidated.to_representation(
+            consolidated.values(get_portfolio_consolidated(
+                portfolio=self.portfolio)))
+        return Response(data)
+
+
+class PositionListAPI(ValuesAPIView):
+    serializer_class = PositionSerializer
+    results_permission = True
+
+    def get_etag(self, request, portfolio_id):
+        self.portfolio = self.get_portfolio(request, portfolio_id)
+        return get_portfolio_detail_cache_key(portfolio=self.portfolio,
+            user=request.user)
+
+    def get_rows(self, request, portfolio_id):
+        return self.paginate(request, self.get_serializer(request),
+            get_assets_consolidated(portfolio=self.portfolio))
+
+
+class ResultListAPI(ValuesAPIView):
+    serializer_class = ResultSerializer
+    results_permission = True
+
+    def get_etag(self, request, portfolio_id):
+        self.portfolio = self.get_portfolio(request, portfolio_id)
+        return get_portfolio_detail_cache_key(portfolio=self.portfolio,
+            user=request.user)
+
+    def get_rows(self, request, portfolio_id):
+        assets_c = get_assets_consolidated(portfolio=self.portfolio)
+        total = assets_c.aggregate(total=Sum('total_current'))['total']
+        return self.paginate(request,
+            self.get_serializer(request, context={'total_portfolio': total}),
+            assets_c)
+
+
+class ImportJobAPI(ValuesAPIView):
+    # Polled by the upload page while the job runs, never cached
+    serializer_class = ImportJobSerializer
+
+    def get_rows(self, request, job_id):
+        serializer = self.get_serializer(request)
+        rows = serializer.values(get_import_jobs(fetched_by=request.user,
+            filters={'pk': job_id}))
+        if not rows:
+            raise NotFound
+        return Response(serializer.to_representation(rows)[0])
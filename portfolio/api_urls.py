@@ -0,0 +1,15 @@
+from django.urls import path
+from . import api
+
+urlpatterns = [
+        path('portfolios/', api.PortfolioListAPI.as_view(),
+            name='api_portfolios'),
+        path('portfolios/<int:portfolio_id>/', api.PortfolioDetailAPI.as_view(),
+            name='api_portfolio'),
+        path('portfolios/<int:portfolio_id>/positions/', api.PositionListAPI.as_view(),
+            name='api_positions'),
+        path('portfolios/<int:portfolio_id>/results/', api.ResultListAPI.as_view(),
+            name='api_results'),
+        path('import-jobs/<int:job_id>/', api.ImportJobAPI.as_view(),
+            name='api_import_job'),
+]
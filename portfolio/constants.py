@@ -17,3 +17,13 @@ class StockBrokerChoices(models.TextChoices):
     RI = 'RI', _('Rico')
     AV = 'AV', _('Avenue')
     TD = 'TD', _('TD Ameritrade')
+
+class ImportJobKind(models.TextChoices):
+    TRANSACTIONS = 'T', _('Transactions')
+    ASSETS = 'A', _('Assets')
+
+class ImportJobStatus(models.TextChoices):
+    PENDING = 'P', _('Pending')
+    RUNNING = 'R', _('Running')
+    DONE = 'D', _('Done')
+    FAILED = 'F', _('Failed')
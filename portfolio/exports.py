@@ -0,0 +1,123 @@
+from django.core import exceptions
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from portfolio.constants import TypeTransactions
+from typing import Iterable, Iterator, Optional
+import csv
+import datetime
+
+# Exported columns as (header, lookup). Rows are read with values_list and
+# a chunked iterator, memory stays the same whatever the number of rows
+
+TRANSACTION_FIELDS = (
+    ('id', 'pk'),
+    ('portfolio', 'portfolio__name'),
+    ('ticker', 'asset__ticker'),
+    ('type_transaction', 'type_transaction'),
+    ('transaction_date', 'transaction_date'),
+    ('quantity', 'quantity'),
+    ('unit_cost', 'unit_cost'),
+    ('currency', 'currency'),
+    ('other_costs', 'other_costs'),
+    ('stockbroker', 'stockbroker'),
+    ('desc_1', 'desc_1'),
+    ('desc_2', 'desc_2'),
+)
+
+RESULT_FIELDS = (
+    ('portfolio', 'portfolio__name'),
+    ('ticker', 'asset__ticker'),
+    ('currency', 'currency'),
+    ('quantity', 'quantity'),
+    ('avg_p_price', 'avg_p_price'),
+    ('avg_p_price_nczp', 'avg_p_price_nczp'),
+    ('avg_s_price', 'avg_s_price'),
+    ('avg_s_price_nczp', 'avg_s_price_nczp'),
+    ('total_cost', 'total_cost'),
+    ('total_cost_nczp', 'total_cost_nczp'),
+    ('total_dividend', 'total_dividend'),
+    ('total_dividend_nczp', 'total_dividend_nczp'),
+    ('total_other_cost', 'total_other_cost'),
+    ('total_other_cost_nczp', 'total_other_cost_nczp'),
+    ('market_price', 'market_price'),
+    ('total_current', 'total_current'),
+    ('result_currency', 'result_currency'),
+    ('result_currency_nczp', 'result_currency_nczp'),
+    ('result_percentage', 'result_percentage'),
+    ('result_percentage_nczp', 'result_percentage_nczp'),
+    ('last_update', 'last_update'),
+)
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+class Echo:
+    # csv.writer target that hands every line back instead of buffering it
+    def write(self, value):
+        return value
+
+
+def _start_of_day(date: datetime.date) -> datetime.datetime:
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def get_export_filters(
+    *,
+    portfolio: Optional[str] = None,
+    asset: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    type_transaction: Optional[str] = None
+) -> dict:
+    # Filters of the transaction export, the results export only takes
+    # portfolio and asset. Dates are YYYY-MM-DD and date_to is inclusive
+    filters = {}
+    if portfolio:
+        if not str(portfolio).isdigit():
+            raise exceptions.ValidationError('Invalid portfolio %s' % portfolio)
+        filters['portfolio__pk'] = int(portfolio)
+    if asset:
+        filters['asset__ticker'] = asset
+    for name, value, lookup, days in (
+            ('date_from', date_from, 'transaction_date__gte', 0),
+            ('date_to', date_to, 'transaction_date__lt', 1)):
+        if not value:
+            continue
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise exceptions.ValidationError('Invalid %s %s' % (name, value))
+        filters[lookup] = _start_of_day(date + datetime.timedelta(days=days))
+    if type_transaction:
+        if type_transaction not in TypeTransactions.values:
+            raise exceptions.ValidationError(
+                'Invalid type_transaction %s' % type_transaction)
+        filters['type_transaction'] = type_transaction
+    return filters
+
+
+def stream_export(
+    *,
+    queryset,
+    fields: Iterable[tuple],
+    format: str = 'csv',
+    chunk_size: int = 2000
+) -> Iterator[str]:
+    headers = [header for header, _ in fields]
+    rows = queryset.order_by('pk').values_list(
+        *[lookup for _, lookup in fields]).iterator(chunk_size=chunk_size)
+
+    if format == 'jsonl':
+        encoder = DjangoJSONEncoder()
+        for row in rows:
+            yield encoder.encode(dict(zip(headers, row))) + '\n'
+    elif format == 'csv':
+        writer = csv.writer(Echo(), delimiter=';')
+        yield writer.writerow(headers)
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        raise exceptions.ValidationError('Invalid format %s' % format)
@@ -0,0 +1,107 @@
+from django.contrib.auth.models import User
+from django.utils import timezone
+from portfolio.models import (
+    Portfolio,
+    AssetType,
+    Asset,
+    Transaction
+)
+from portfolio.constants import TypeTransactions
+from decimal import Decimal
+from typing import Callable, Iterable
+import time
+
+# Helpers shared by the benchmark commands. Everything they create lives
+# inside a transaction that is rolled back at the end of the run
+
+
+class Rollback(Exception):
+    pass
+
+
+def get_benchmark_portfolio(
+    *,
+    name: str = 'benchmark'
+) -> Portfolio:
+    user = User.objects.get_or_create(username='benchmark')[0]
+    return Portfolio.objects.create(owner=user, name=name)
+
+
+def get_benchmark_asset(
+    *,
+    ticker: str,
+    type_investment: str = 'STOCK'
+) -> Asset:
+    asset_type = AssetType.objects.get_or_create(name=type_investment)[0]
+    return Asset.objects.create(
+        ticker=ticker,
+        name=ticker,
+        type_investment=asset_type)
+
+
+def synthetic_transactions(
+    *,
+    portfolio: Portfolio,
+    asset: Asset,
+    count: int,
+    zero_every: int = 50
+) -> Iterable[Transaction]:
+    # Buys with monthly dividends, closing the position every zero_every
+    # transactions so the nczp queries have zero crossings to find
+    start = timezone.now() - timezone.timedelta(days=count)
+    qty = Decimal(0)
+    for i in range(count):
+        date = start + timezone.timedelta(days=i)
+        if (i + 1) % zero_every == 0 and qty > 0:
+            type_transaction, quantity = TypeTransactions.SELL.value, qty
+        elif i % 30 == 29 and qty > 0:
+            type_transaction, quantity = TypeTransactions.DIVIDEND.value, qty
+        else:
+            type_transaction, quantity = TypeTransactions.BUY.value, Decimal(10)
+        if type_transaction == TypeTransactions.BUY.value:
+            qty += quantity
+        elif type_transaction == TypeTransactions.SELL.value:
+            qty -= quantity
+        yield Transaction(
+            portfolio=portfolio,
+            type_transaction=type_transaction,
+            transaction_date=date,
+            type_investment=asset.type_investment,
+            asset=asset,
+            quantity=quantity,
+            unit_cost=Decimal('10.5') + (i % 7),
+            other_costs=Decimal('0.1'),
+            consolidated=True)
+
+
+def bulk_load(
+    *,
+    rows: Iterable[Transaction],
+    batch_size: int = 5000
+) -> int:
+    total = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            Transaction.objects.bulk_create(batch, batch_size=batch_size)
+            total += len(batch)
+            batch = []
+    if batch:
+        Transaction.objects.bulk_create(batch, batch_size=batch_size)
+        total += len(batch)
+    return total
+
+
+def best_of(
+    *,
+    fn: Callable,
+    repeat: int = 3
+) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from portfolio.selectors import get_last_zeroed_date
+from portfolio.constants import TypeTransactions
+from portfolio.management.commands._benchmark import (
+    Rollback,
+    get_benchmark_portfolio,
+    get_benchmark_asset,
+    synthetic_transactions,
+    bulk_load,
+    best_of
+)
+
+# Self-join previously used by get_transactions_asset_nczp, kept here only
+# as the baseline of the benchmark
+LEGACY_SQL = '''
+WITH transaction_dates
+     AS (SELECT DISTINCT transaction_date date_t
+         FROM   portfolio_transaction
+         WHERE  portfolio_id = %s
+                AND asset_id = %s)
+SELECT td.date_t,
+       Sum(CASE
+             WHEN pt.type_transaction = %s THEN pt.quantity * -1
+             WHEN pt.type_transaction = %s THEN pt.quantity
+             ELSE NULL
+           END) AS qty
+FROM   portfolio_transaction pt,
+       transaction_dates td
+WHERE  pt.portfolio_id = %s
+       AND pt.asset_id = %s
+       AND pt.transaction_date <= td.date_t
+GROUP  BY td.date_t
+HAVING Sum(CASE
+             WHEN pt.type_transaction = %s THEN pt.quantity * -1
+             WHEN pt.type_transaction = %s THEN pt.quantity
+             ELSE NULL
+           END) = 0
+ORDER  BY td.date_t DESC
+'''
+
+class Command(BaseCommand):
+    help = 'Compare the zero-crossing query of the nczp selectors '\
+        'against the previous self-join at growing transaction counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,5000,10000,20000',
+            help='Comma separated transaction counts per asset')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--skip-legacy-above', type=int, default=20000,
+            help='Do not time the self-join above this many transactions')
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',') if s]
+        self.stdout.write('%10s %14s %14s' % ('rows', 'legacy (s)', 'window (s)'))
+        try:
+            with transaction.atomic():
+                portfolio = get_benchmark_portfolio(name='benchmark nczp')
+                for i, size in enumerate(sizes):
+                    asset = get_benchmark_asset(ticker='BNCH%s' % i)
+                    bulk_load(rows=synthetic_transactions(
+                        portfolio=portfolio, asset=asset, count=size))
+
+                    window = best_of(repeat=options['repeat'],
+                        fn=lambda: get_last_zeroed_date(
+                            portfolio=portfolio, asset=asset))
+                    legacy = None
+                    if size <= options['skip_legacy_above']:
+                        legacy = best_of(repeat=options['repeat'],
+                            fn=lambda: self._legacy(portfolio, asset))
+                    self.stdout.write('%10d %14s %14.4f' % (
+                        size,
+                        '%.4f' % legacy if legacy is not None else 'skipped',
+                        window))
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _legacy(self, portfolio, asset):
+        buy = TypeTransactions.BUY.value
+        sell = TypeTransactions.SELL.value
+        with connection.cursor() as cursor:
+            cursor.execute(LEGACY_SQL, [portfolio.pk, asset.pk, buy, sell,
+                portfolio.pk, asset.pk, buy, sell])
+            return cursor.fetchone()
@@ -0,0 +1,150 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Min
+from django.test.utils import CaptureQueriesContext
+from portfolio.models import Transaction
+from portfolio.selectors import (
+    get_transactions,
+    get_transactions_asset,
+    get_transactions_asset_nczp,
+    get_last_zeroed_transaction,
+    get_current_assets_portfolio,
+    get_assets_totals
+)
+from portfolio.services import get_total_buy_transactions
+from portfolio.management.commands._benchmark import (
+    Rollback,
+    get_benchmark_portfolio,
+    get_benchmark_asset,
+    synthetic_transactions,
+    bulk_load,
+    best_of
+)
+
+class Command(BaseCommand):
+    help = 'Load synthetic transactions and record the query plans and '\
+        'timings of the transaction selectors without and with the '\
+        'Transaction indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000000)
+        parser.add_argument('--portfolios', type=int, default=20)
+        parser.add_argument('--assets', type=int, default=50,
+            help='Assets per portfolio')
+        parser.add_argument('--pending', type=int, default=5,
+            help='Unconsolidated transactions per portfolio and asset')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--output', help='Write the plans to this file')
+
+    def handle(self, *args, **options):
+        self.plans = []
+        try:
+            with transaction.atomic():
+                portfolio, asset = self._load(options)
+                cases = self._cases(portfolio, asset)
+                indexes = Transaction._meta.indexes
+
+                self._drop(indexes)
+                before = self._measure('without indexes', cases,
+                    options['repeat'])
+                self._create(indexes)
+                after = self._measure('with indexes', cases,
+                    options['repeat'])
+
+                self.stdout.write('\n%-28s %14s %14s' % (
+                    'selector', 'before (s)', 'after (s)'))
+                for name, _ in cases:
+                    self.stdout.write('%-28s %14.4f %14.4f' % (
+                        name, before[name], after[name]))
+                raise Rollback
+        except Rollback:
+            pass
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write('\n'.join(self.plans))
+        else:
+            self.stdout.write('\n'.join(self.plans))
+
+    def _load(self, options):
+        per_pair = max(options['rows'] //
+            (options['portfolios'] * options['assets']), 1)
+        assets = [get_benchmark_asset(ticker='BT%s' % i)
+            for i in range(options['assets'])]
+        portfolios = [get_benchmark_portfolio(name='benchmark %s' % i)
+            for i in range(options['portfolios'])]
+
+        def rows():
+            for portfolio in portfolios:
+                for asset in assets:
+                    generated = synthetic_transactions(portfolio=portfolio,
+                        asset=asset, count=per_pair)
+                    for i, row in enumerate(generated):
+                        row.consolidated = i < per_pair - options['pending']
+                        yield row
+
+        total = bulk_load(rows=rows())
+        self.stdout.write('Loaded %d transactions' % total)
+        return portfolios[0], assets[0]
+
+    def _cases(self, portfolio, asset):
+        return [
+            ('get_transactions_asset', lambda: list(get_transactions_asset(
+                portfolio=portfolio, asset=asset).order_by('transaction_date'))),
+            ('get_transactions_asset_nczp', lambda: list(
+                get_transactions_asset_nczp(portfolio=portfolio, asset=asset))),
+            ('get_last_zeroed_transaction', lambda: get_last_zeroed_transaction(
+                portfolio=portfolio, asset=asset)),
+            ('unconsolidated', lambda: list(get_transactions(
+                portfolio=portfolio, filters={'consolidated': False}
+                ).values('asset').annotate(first_pk=Min('pk')))),
+            ('get_total_buy_transactions', lambda: get_total_buy_transactions(
+                portfolio=portfolio, filters={'asset': asset})),
+            ('get_assets_totals', lambda: get_assets_totals(
+                portfolio=portfolio)),
+            ('get_current_assets_portfolio', lambda: list(
+                get_current_assets_portfolio(portfolio=portfolio))),
+        ]
+
+    def _measure(self, label, cases, repeat):
+        self._analyze()
+        timings = {}
+        for name, fn in cases:
+            with CaptureQueriesContext(connection) as ctx:
+                fn()
+            timings[name] = best_of(fn=fn, repeat=repeat)
+            for query in ctx.captured_queries:
+                self.plans.append('-- %s, %s\n%s\n%s\n' % (
+                    name, label, query['sql'], self._explain(query['sql'])))
+        return timings
+
+    def _explain(self, sql):
+        if connection.vendor == 'postgresql':
+            prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+        elif connection.vendor == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql)
+            return '\n'.join(' '.join(str(c) for c in row)
+                for row in cursor.fetchall())
+
+    def _analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s' % connection.ops.quote_name(
+                Transaction._meta.db_table))
+
+    def _drop(self, indexes):
+        # DDL is transactional on PostgreSQL and SQLite, the rollback at the
+        # end of the run restores the indexes
+        editor = connection.schema_editor()
+        with connection.cursor() as cursor:
+            for index in indexes:
+                cursor.execute(str(index.remove_sql(Transaction, editor)))
+
+    def _create(self, indexes):
+        editor = connection.schema_editor()
+        with connection.cursor() as cursor:
+            for index in indexes:
+                cursor.execute(str(index.create_sql(Transaction, editor)))
@@ -0,0 +1,145 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from portfolio.models import Portfolio
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import time
+
+def _init_worker():
+    # Forked workers must not reuse the parent's database connection
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+def _consolidate(portfolio_id, full):
+    from portfolio.services import consolidate_scheduled_portfolio
+    start = time.perf_counter()
+    try:
+        consolidate_scheduled_portfolio(portfolio_id=portfolio_id, full=full)
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return portfolio_id, error, time.perf_counter() - start
+
+class Command(BaseCommand):
+    help = 'Consolidate every portfolio, sharded across a process pool '\
+        'or fanned out as a Celery chord'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='Processes used to consolidate (default: number of cores)')
+        parser.add_argument('--portfolio', type=int, action='append',
+            dest='portfolios', help='Only this portfolio id (repeatable)')
+        parser.add_argument('--dirty-only', action='store_true',
+            help='Only apply pending transactions instead of replaying '\
+                'every portfolio from its whole history')
+        parser.add_argument('--checkpoint',
+            help='File with the ids already consolidated; they are skipped '\
+                'and the ones finished by this run are appended to it')
+        parser.add_argument('--celery', action='store_true',
+            help='Fan out one Celery task per portfolio instead of using '\
+                'local processes')
+        parser.add_argument('--wait', action='store_true',
+            help='With --celery, wait for the chord and report progress')
+
+    def handle(self, *args, **options):
+        full = not options['dirty_only']
+        qs = Portfolio.objects.order_by('pk')
+        if options['portfolios']:
+            qs = qs.filter(pk__in=options['portfolios'])
+        if not full:
+            qs = qs.filter(consolidated=False)
+        done = self._read_checkpoint(options['checkpoint'])
+        ids = [pk for pk in qs.values_list('pk', flat=True) if pk not in done]
+        if done:
+            self.stdout.write('Skipping %d portfolios found in %s' % (
+                len(done), options['checkpoint']))
+        if not ids:
+            self.stdout.write('Nothing to consolidate')
+            return
+
+        if options['celery']:
+            self._run_celery(ids, full, options['wait'])
+        else:
+            self._run_pool(ids, full, options['workers'],
+                options['checkpoint'])
+
+    def _read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return set()
+        with open(path) as f:
+            return {int(line) for line in f if line.strip()}
+
+    def _run_pool(self, ids, full, workers, checkpoint):
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+        self.stdout.write('Consolidating %d portfolios with %d workers' % (
+            len(ids), workers))
+        # Children are forked with no open connection to inherit
+        connections.close_all()
+        timings = {}
+        errors = {}
+        start = time.perf_counter()
+        checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_worker) as executor:
+                futures = [executor.submit(_consolidate, pk, full) for pk in ids]
+                for i, future in enumerate(as_completed(futures), 1):
+                    pk, error, elapsed = future.result()
+                    timings[pk] = elapsed
+                    if error:
+                        errors[pk] = error
+                        self.stderr.write('[%d/%d] portfolio %d failed: %s' % (
+                            i, len(ids), pk, error))
+                        continue
+                    if checkpoint_file:
+                        checkpoint_file.write('%d\n' % pk)
+                        checkpoint_file.flush()
+                    self.stdout.write('[%d/%d] portfolio %d consolidated in %.2fs' % (
+                        i, len(ids), pk, elapsed))
+        finally:
+            if checkpoint_file:
+                checkpoint_file.close()
+        self._summary(timings, errors, time.perf_counter() - start)
+
+    def _run_celery(self, ids, full, wait):
+        from celery import chord
+        from finance.celery import app
+        header = [app.signature('consolidate_portfolio', args=[pk],
+            kwargs={'full': full}) for pk in ids]
+        start = time.perf_counter()
+        result = chord(header)(app.signature('consolidation_summary'))
+        self.stdout.write('Sent %d consolidation tasks, chord %s' % (
+            len(ids), result.id))
+        if not wait:
+            return
+        group = result.parent
+        while not result.ready():
+            if group is not None:
+                self.stdout.write('[%d/%d] portfolios consolidated' % (
+                    group.completed_count(), len(ids)))
+            time.sleep(2)
+        summary = result.get()
+        self.stdout.write('Consolidated %(consolidated)d of %(portfolios)d '\
+            'portfolios' % summary)
+        self.stdout.write('Wall time: %.2fs' % (time.perf_counter() - start))
+
+    def _summary(self, timings, errors, wall):
+        ok = [t for pk, t in timings.items() if pk not in errors]
+        self.stdout.write('')
+        self.stdout.write('Consolidated: %d  Failed: %d' % (len(ok), len(errors)))
+        self.stdout.write('Wall time: %.2fs' % wall)
+        if ok:
+            self.stdout.write('Per portfolio: total %.2fs  mean %.2fs  max %.2fs' % (
+                sum(ok), sum(ok)/len(ok), max(ok)))
+            slowest = sorted(timings.items(), key=lambda t: t[1], reverse=True)[:5]
+            self.stdout.write('Slowest: %s' % ', '.join(
+                '%d (%.2fs)' % (pk, t) for pk, t in slowest))
+        if errors:
+            raise CommandError('%d portfolios failed, run again with the same '\
+                '--checkpoint to resume' % len(errors))
@@ -0,0 +1,54 @@
+from django.core import exceptions
+from django.core.management.base import BaseCommand, CommandError
+from portfolio.models import Transaction, PortfolioAssetConsolidated
+from portfolio.exports import (
+    TRANSACTION_FIELDS,
+    RESULT_FIELDS,
+    EXPORT_FORMATS,
+    get_export_filters,
+    stream_export
+)
+import sys
+
+class Command(BaseCommand):
+    help = 'Stream transactions or consolidated results as CSV or JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=('transactions', 'results'))
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--output', help='File to write (default: stdout)')
+        parser.add_argument('--portfolio', help='Portfolio id')
+        parser.add_argument('--asset', help='Asset ticker')
+        parser.add_argument('--date-from', help='YYYY-MM-DD, transactions only')
+        parser.add_argument('--date-to', help='YYYY-MM-DD inclusive, transactions only')
+        parser.add_argument('--type-transaction', help='Transactions only')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        filters = {
+            'portfolio': options['portfolio'],
+            'asset': options['asset'],
+        }
+        if options['model'] == 'transactions':
+            queryset = Transaction.objects.all()
+            fields = TRANSACTION_FIELDS
+            filters.update({
+                'date_from': options['date_from'],
+                'date_to': options['date_to'],
+                'type_transaction': options['type_transaction'],
+            })
+        else:
+            queryset = PortfolioAssetConsolidated.objects.all()
+            fields = RESULT_FIELDS
+        try:
+            queryset = queryset.filter(**get_export_filters(**filters))
+        except exceptions.ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+
+        lines = stream_export(queryset=queryset, fields=fields,
+            format=options['format'], chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
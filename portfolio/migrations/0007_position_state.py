@@ -0,0 +1,89 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:19
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0006_auto_20210226_0417'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='buy_cost',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='buy_cost_nczp',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='buy_quantity',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='buy_quantity_nczp',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='dividend',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='dividend_nczp',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='last_transaction_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='last_transaction_pk',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='other_cost',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='other_cost_nczp',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='sell_quantity',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='sell_quantity_nczp',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='sell_value',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='sell_value_nczp',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='zeroed_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
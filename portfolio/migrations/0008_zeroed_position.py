@@ -0,0 +1,68 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:21
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+from itertools import groupby
+
+def build_zeroed_positions(apps, schema_editor):
+    Transaction = apps.get_model('portfolio', 'Transaction')
+    PortfolioAssetZeroedPosition = apps.get_model('portfolio',
+        'PortfolioAssetZeroedPosition')
+    qs = Transaction.objects.exclude(portfolio=None).order_by(
+        'portfolio', 'asset', 'transaction_date', 'pk').values_list(
+        'portfolio', 'asset', 'pk', 'type_transaction', 'transaction_date',
+        'quantity')
+    positions = []
+    for (portfolio, asset), rows in groupby(qs.iterator(),
+            key=lambda r: (r[0], r[1])):
+        position = PortfolioAssetZeroedPosition(portfolio_id=portfolio,
+            asset_id=asset)
+        traded = False
+        for _, _, pk, type_transaction, transaction_date, quantity in rows:
+            if (position.last_transaction_date is not None and
+                    transaction_date != position.last_transaction_date and
+                    traded and position.quantity == 0):
+                position.zeroed_date = position.last_transaction_date
+                position.zeroed_transaction_id = last_pk
+            if type_transaction == 'B':
+                position.quantity += quantity
+                traded = True
+            elif type_transaction == 'S':
+                position.quantity -= quantity
+                traded = True
+            position.last_transaction_date = transaction_date
+            last_pk = pk
+        if traded and position.quantity == 0:
+            position.zeroed_date = position.last_transaction_date
+            position.zeroed_transaction_id = last_pk
+        positions.append(position)
+    PortfolioAssetZeroedPosition.objects.bulk_create(positions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0007_position_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioAssetZeroedPosition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=5, default=Decimal('0'), max_digits=20)),
+                ('last_transaction_date', models.DateTimeField(blank=True, null=True)),
+                ('zeroed_date', models.DateTimeField(blank=True, null=True)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfolio.asset')),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfolio.portfolio')),
+                ('zeroed_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='portfolio.transaction')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='portfolioassetzeroedposition',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'asset'), name='unique_zeroed_position_portfolio_asset'),
+        ),
+        migrations.RunPython(build_zeroed_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:22
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+def remove_duplicates(apps, schema_editor):
+    # Keep the most recent row of each duplicated group and let the next
+    # consolidation rebuild the affected portfolios from scratch
+    Portfolio = apps.get_model('portfolio', 'Portfolio')
+    Transaction = apps.get_model('portfolio', 'Transaction')
+    dirty = set()
+    for model_name, key in (('PortfolioAssetConsolidated', 'asset'),
+            ('PortfolioConsolidated', 'currency')):
+        model = apps.get_model('portfolio', model_name)
+        duplicates = model.objects.values('portfolio', key).annotate(
+            n=Count('pk'), last_pk=Max('pk')).filter(n__gt=1).order_by()
+        for d in duplicates:
+            model.objects.filter(portfolio=d['portfolio'],
+                **{key: d[key]}).exclude(pk=d['last_pk']).delete()
+            dirty.add(d['portfolio'])
+    Portfolio.objects.filter(pk__in=dirty).update(consolidated=False)
+    Transaction.objects.filter(portfolio__in=dirty).update(consolidated=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0008_zeroed_position'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='portfolioassetconsolidated',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'asset'), name='unique_consolidated_portfolio_asset'),
+        ),
+        migrations.AddConstraint(
+            model_name='portfolioconsolidated',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'currency'), name='unique_consolidated_portfolio_currency'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0009_consolidated_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='consolidation_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0010_consolidation_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['portfolio', 'asset', 'transaction_date'], name='transaction_asset_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(consolidated=False), fields=['portfolio'], name='transaction_unconsolidated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['portfolio', 'type_transaction', 'asset'], name='transaction_type_asset_idx'),
+        ),
+    ]
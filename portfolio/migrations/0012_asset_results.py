@@ -0,0 +1,61 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:29
+
+from decimal import Decimal
+from django.db import migrations, models
+
+def replay_consolidated(apps, schema_editor):
+    # total_buy is part of the running state, stored rows can not be
+    # extended by deltas until their portfolio is replayed once
+    Portfolio = apps.get_model('portfolio', 'Portfolio')
+    Transaction = apps.get_model('portfolio', 'Transaction')
+    PortfolioAssetConsolidated = apps.get_model('portfolio',
+        'PortfolioAssetConsolidated')
+    PortfolioAssetConsolidated.objects.update(last_transaction_pk=None)
+    dirty = PortfolioAssetConsolidated.objects.values('portfolio')
+    Portfolio.objects.filter(pk__in=dirty).update(consolidated=False)
+    Transaction.objects.filter(portfolio__in=dirty).update(consolidated=False)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0011_transaction_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='market_price',
+            field=models.DecimalField(decimal_places=5, default=Decimal('0'), max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='result_currency',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=16),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='result_currency_nczp',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=16),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='result_percentage',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=16),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='result_percentage_nczp',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=16),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='total_buy',
+            field=models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=28),
+        ),
+        migrations.AddField(
+            model_name='portfolioassetconsolidated',
+            name='total_current',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=16),
+        ),
+        migrations.RunPython(replay_consolidated, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0012_asset_results'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_date', 'id'], name='transaction_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:42
+
+from django.db import migrations, models
+from django.db.models import F
+
+def set_info_updated_at(apps, schema_editor):
+    # Existing assets went through create_asset, they are not placeholders
+    Asset = apps.get_model('portfolio', 'Asset')
+    Asset.objects.update(info_updated_at=F('last_update'))
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0014_import_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='info_updated_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_info_updated_at, migrations.RunPython.noop),
+    ]
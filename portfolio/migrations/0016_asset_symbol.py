@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0015_asset_info_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='symbol',
+            field=models.CharField(blank=True, editable=False, max_length=20, null=True),
+        ),
+    ]
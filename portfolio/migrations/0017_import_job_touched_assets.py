@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0016_asset_symbol'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='touched_assets',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='_importjob_touched_assets_+', to='portfolio.Asset'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0017_import_job_touched_assets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='consolidation_due_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='portfolio',
+            name='consolidation_scheduled_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
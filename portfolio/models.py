@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models import Sum, F, Case, When
+from django.db.models import Sum, F, Q, Case, When
 from django.core import exceptions
 from decimal import Decimal
 from portfolio import constants
@@ -20,6 +20,15 @@ class Portfolio(models.Model):
     name = models.CharField(max_length=15, unique=True)
     desc_1 = models.CharField(max_length=20, blank=True, null=True)
     consolidated = models.BooleanField(default=False)
+    # Incremented by every consolidation that changed the portfolio
+    consolidation_version = models.PositiveIntegerField(default=0,
+        editable=False)
+    # Debounce of the background consolidation: when the pending run was
+    # sent and when the last write wants it to start
+    consolidation_scheduled_at = models.DateTimeField(blank=True, null=True,
+        editable=False)
+    consolidation_due_at = models.DateTimeField(blank=True, null=True,
+        editable=False)
     created_at = models.DateTimeField(auto_now=False, auto_now_add=True,
         editable=False)
     last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
@@ -48,6 +57,12 @@ class Asset(models.Model):
     desc_1 = models.CharField(max_length=20, blank=True, null=True)
     desc_2 = models.CharField(max_length=50, blank=True, null=True)
     desc_3 = models.CharField(max_length=100, blank=True, null=True)
+    # Quote service symbol and last successful ticker info lookup, empty
+    # while the asset only has placeholder metadata
+    symbol = models.CharField(max_length=20, blank=True, null=True,
+        editable=False)
+    info_updated_at = models.DateTimeField(blank=True, null=True,
+        editable=False)
     created_at = models.DateTimeField(auto_now=False, auto_now_add=True,
         editable=False)
     last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
@@ -113,6 +128,21 @@ class Transaction(models.Model):
     last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
         editable=False)
 
+    class Meta:
+        # Access paths of the selectors: per asset history ordered by date,
+        # pending rows of a portfolio, per type totals and the admin keyset
+        indexes = [
+            models.Index(fields=['portfolio', 'asset', 'transaction_date'],
+                name='transaction_asset_date_idx'),
+            models.Index(fields=['portfolio'],
+                condition=Q(consolidated=False),
+                name='transaction_unconsolidated_idx'),
+            models.Index(fields=['portfolio', 'type_transaction', 'asset'],
+                name='transaction_type_asset_idx'),
+            models.Index(fields=['transaction_date', 'id'],
+                name='transaction_date_id_idx'),
+        ]
+
 class PortfolioConsolidated(models.Model):
     # *_nczp => No Consider Zeroed Positions
     portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
@@ -131,6 +161,12 @@ class PortfolioConsolidated(models.Model):
     last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
         editable=False)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'currency'],
+                name='unique_consolidated_portfolio_currency'),
+        ]
+
 class PortfolioAssetConsolidated(models.Model):
     # *_nczp => No Consider Zeroed Positions
     portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
@@ -150,6 +186,30 @@ class PortfolioAssetConsolidated(models.Model):
     total_dividend_nczp =  models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
     total_other_cost = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
     total_other_cost_nczp = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal(0))
+    # Running position state, used to apply new transactions as deltas
+    buy_quantity = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    buy_cost = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    sell_quantity = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    sell_value = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    dividend = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    other_cost = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    buy_quantity_nczp = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    buy_cost_nczp = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    sell_quantity_nczp = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    sell_value_nczp = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    dividend_nczp = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    other_cost_nczp = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    total_buy = models.DecimalField(max_digits=28, decimal_places=10, default=Decimal(0))
+    zeroed_date = models.DateTimeField(blank=True, null=True)
+    last_transaction_date = models.DateTimeField(blank=True, null=True)
+    last_transaction_pk = models.PositiveIntegerField(blank=True, null=True)
+    # Market values at market_price, recomputed when Asset.current_price moves
+    market_price = models.DecimalField(max_digits=12, decimal_places=5, default=Decimal(0))
+    total_current = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal(0))
+    result_currency = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal(0))
+    result_currency_nczp = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal(0))
+    result_percentage = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal(0))
+    result_percentage_nczp = models.DecimalField(max_digits=16, decimal_places=2, default=Decimal(0))
     created_at = models.DateTimeField(auto_now=False, auto_now_add=True,
         editable=False)
     last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
@@ -161,6 +221,62 @@ class PortfolioAssetConsolidated(models.Model):
             return True
         return False
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'asset'],
+                name='unique_consolidated_portfolio_asset'),
+        ]
+
+
+class PortfolioAssetZeroedPosition(models.Model):
+    # Last date the position of an asset went to zero inside a portfolio,
+    # kept up to date as transactions are written (see *_nczp)
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    asset = models.ForeignKey(Asset, on_delete=models.CASCADE)
+    quantity = models.DecimalField(max_digits=20, decimal_places=5, default=Decimal(0))
+    last_transaction_date = models.DateTimeField(blank=True, null=True)
+    zeroed_date = models.DateTimeField(blank=True, null=True)
+    zeroed_transaction = models.ForeignKey(Transaction,
+        on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
+        editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'asset'],
+                name='unique_zeroed_position_portfolio_asset'),
+        ]
+
+
+class ImportJob(models.Model):
+    # Uploaded file processed in background, rows are committed in chunks and
+    # processed_rows is the checkpoint a restarted job resumes from
+    def __str__(self):
+        return "%s - %s" % (self.get_kind_display(), self.file.name)
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE,
+        blank=True, null=True)
+    kind = models.CharField(max_length=1,
+        choices=constants.ImportJobKind.choices)
+    status = models.CharField(max_length=1,
+        choices=constants.ImportJobStatus.choices,
+        default=constants.ImportJobStatus.PENDING)
+    file = models.FileField(upload_to='imports/%Y/%m/')
+    total_rows = models.PositiveIntegerField(blank=True, null=True)
+    processed_rows = models.PositiveIntegerField(default=0)
+    imported_rows = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.TextField(blank=True, default='')
+    # Assets of the rows imported so far, their positions are rebuilt once
+    # when the job is done
+    touched_assets = models.ManyToManyField(Asset, blank=True, editable=False,
+        related_name='+')
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True,
+        editable=False)
+    last_update = models.DateTimeField(auto_now=True, auto_now_add=False,
+        editable=False)
+
 
 class StockManager(models.Manager):
     def get_queryset(self):
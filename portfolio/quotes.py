@@ -0,0 +1,344 @@
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+from urllib.parse import urlsplit
+import logging
+import math
+import os
+import random
+import threading
+import time
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Client of the quote service (SERVICE_ASSET_INFO, SERVICE_PRICES_URL and
+# SERVICE_QUOTES_URL). Every process keeps one Session, its connections are
+# reused across calls and across the threads of the concurrent lookups
+
+TIMEOUT = (5, 14)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class QuoteServiceError(requests.RequestException):
+    pass
+
+
+class QuoteServiceUnavailable(QuoteServiceError):
+    # Connection errors, timeouts and the statuses of RETRY_STATUS that were
+    # still failing after the retries
+    pass
+
+
+class QuoteServiceCircuitOpen(QuoteServiceUnavailable):
+    # Raised without calling the service while its circuit is open
+    pass
+
+
+class QuoteServiceThrottled(QuoteServiceUnavailable):
+    # No request token within QUOTE_RATE_MAX_WAIT seconds
+    pass
+
+
+def _clock() -> float:
+    return time.time()
+
+
+class CircuitBreaker:
+    # Opens after QUOTE_CIRCUIT_FAILURES failed calls to a host within
+    # QUOTE_CIRCUIT_RESET seconds. While open calls fail at once, after
+    # QUOTE_CIRCUIT_RESET seconds a single call probes the host and closes
+    # the circuit again if it succeeds. The state is in the default cache,
+    # shared by the workers when the cache is
+    def __init__(self, host: str):
+        self.key = 'quote-circuit-%s' % host
+
+    def is_open(self) -> bool:
+        # False once the circuit can be probed
+        opened = cache.get(self.key + '-opened')
+        return (opened is not None and
+            _clock() - opened < settings.QUOTE_CIRCUIT_RESET)
+
+    def before(self) -> bool:
+        # True when the call is the probe of a half open circuit
+        if cache.get(self.key + '-opened') is None:
+            return False
+        if self.is_open():
+            raise QuoteServiceCircuitOpen('%s is open' % self.key)
+        if not cache.add(self.key + '-probe', True,
+                timeout=settings.QUOTE_CIRCUIT_RESET):
+            raise QuoteServiceCircuitOpen('%s is being probed' % self.key)
+        return True
+
+    def success(self, probe: bool) -> None:
+        if probe:
+            cache.delete_many([self.key + '-opened', self.key + '-probe',
+                self.key + '-failures'])
+            logger.info('%s closed', self.key)
+
+    def failure(self, probe: bool) -> None:
+        if probe:
+            self._open()
+            return
+        key = self.key + '-failures'
+        cache.add(key, 0, timeout=settings.QUOTE_CIRCUIT_RESET)
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            # Expired between add and incr
+            cache.set(key, 1, timeout=settings.QUOTE_CIRCUIT_RESET)
+            failures = 1
+        if failures >= settings.QUOTE_CIRCUIT_FAILURES:
+            self._open()
+
+    def _open(self) -> None:
+        cache.set(self.key + '-opened', _clock(), timeout=None)
+        cache.delete_many([self.key + '-probe', self.key + '-failures'])
+        logger.warning('%s opened for %ss', self.key,
+            settings.QUOTE_CIRCUIT_RESET)
+
+
+class LocalTokenBucket:
+    # Stand-in for RedisTokenBucket, the quota is per process
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = _clock()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        # 0 when a token was taken, otherwise the seconds until the next one
+        with self.lock:
+            now = _clock()
+            self.tokens = min(self.burst,
+                self.tokens + max(now - self.updated, 0) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RedisTokenBucket:
+    # One bucket for all the workers, refilled and taken from atomically
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return tostring(wait)
+    """
+
+    def __init__(self, rate: float, burst: int, url: str):
+        import redis
+        self.rate = rate
+        self.burst = burst
+        self.script = redis.Redis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self) -> float:
+        return float(self.script(keys=['quote-rate-limit'], args=[self.rate,
+            self.burst, _clock(), math.ceil(self.burst / self.rate) + 1]))
+
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_bucket = None
+_bucket_pid = None
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    # The retries are made by request() with jitter, not by urllib3
+    adapter = HTTPAdapter(
+        pool_connections=settings.QUOTE_SERVICE_POOL_CONNECTIONS,
+        pool_maxsize=settings.QUOTE_SERVICE_POOL_SIZE,
+        max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    # A Session inherited through fork (Celery prefork workers) shares its
+    # sockets with the parent, the child opens its own
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _new_session()
+                _session_pid = pid
+    return _session
+
+
+def get_bucket():
+    # None when QUOTE_RATE_LIMIT is 0
+    global _bucket, _bucket_pid
+    if not settings.QUOTE_RATE_LIMIT:
+        return None
+    pid = os.getpid()
+    if _bucket is None or _bucket_pid != pid:
+        with _lock:
+            if _bucket is None or _bucket_pid != pid:
+                if settings.QUOTE_RATE_LIMIT_REDIS_URL:
+                    _bucket = RedisTokenBucket(settings.QUOTE_RATE_LIMIT,
+                        settings.QUOTE_RATE_BURST,
+                        settings.QUOTE_RATE_LIMIT_REDIS_URL)
+                else:
+                    _bucket = LocalTokenBucket(settings.QUOTE_RATE_LIMIT,
+                        settings.QUOTE_RATE_BURST)
+                _bucket_pid = pid
+    return _bucket
+
+
+def _acquire() -> None:
+    bucket = get_bucket()
+    if bucket is None:
+        return
+    deadline = _clock() + settings.QUOTE_RATE_MAX_WAIT
+    while True:
+        wait = bucket.take()
+        if not wait:
+            return
+        if _clock() + wait > deadline:
+            raise QuoteServiceThrottled('No quote request token within %ss' %
+                settings.QUOTE_RATE_MAX_WAIT)
+        time.sleep(wait)
+
+
+def _backoff(attempt: int) -> float:
+    # Full jitter, workers retrying together do not come back together
+    return random.uniform(0, settings.QUOTE_SERVICE_BACKOFF * 2 ** attempt)
+
+
+def request(
+    url: str,
+    *,
+    retries: Optional[int] = None
+) -> requests.Response:
+    # GET with bounded retries. Transport errors and RETRY_STATUS responses
+    # are retried and raise QuoteServiceUnavailable at the end, any other
+    # response is returned as it is. Every attempt goes through the circuit
+    # breaker of the host and takes a token of the rate limiter
+    if retries is None:
+        retries = settings.QUOTE_SERVICE_RETRIES
+    circuit = CircuitBreaker(urlsplit(url).netloc)
+    for attempt in range(retries + 1):
+        probe = circuit.before()
+        try:
+            _acquire()
+            response = get_session().get(url, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = QuoteServiceUnavailable('%s: %s' % (url, e))
+        except QuoteServiceThrottled:
+            if probe:
+                cache.delete(circuit.key + '-probe')
+            raise
+        else:
+            if response.status_code not in RETRY_STATUS:
+                circuit.success(probe)
+                return response
+            error = QuoteServiceUnavailable('%s: status %s' % (url,
+                response.status_code))
+        circuit.failure(probe)
+        if attempt < retries:
+            delay = _backoff(attempt)
+            logger.info('%s, retrying in %.2fs', error, delay)
+            time.sleep(delay)
+    raise error
+
+
+def check_circuit(url: str) -> None:
+    # Raises QuoteServiceCircuitOpen while the circuit of the host of url is
+    # open, for callers that should not start at all
+    circuit = CircuitBreaker(urlsplit(url).netloc)
+    if circuit.is_open():
+        raise QuoteServiceCircuitOpen('%s is open' % circuit.key)
+
+
+def get_json(
+    url: str,
+    *,
+    retries: Optional[int] = None
+) -> Optional[dict]:
+    # None when the service answered without the data (4xx or a body that is
+    # not JSON)
+    response = request(url, retries=retries)
+    if response.status_code != 200:
+        logger.debug('%s: status %s', url, response.status_code)
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        logger.debug('%s: invalid JSON', url)
+        return None
+
+
+# Result of a call given up by the rate limiter, made again by get_json_many
+_THROTTLED = object()
+
+
+def _fetch_json(
+    url: str,
+    hosts: dict
+):
+    with hosts[urlsplit(url).netloc]:
+        try:
+            return get_json(url)
+        except QuoteServiceThrottled:
+            return _THROTTLED
+        except QuoteServiceError as e:
+            logger.warning('%s', e)
+            return None
+
+
+def get_json_many(
+    urls: Iterable[str],
+    *,
+    concurrency: Optional[int] = None,
+    per_host: Optional[int] = None
+) -> list:
+    # get_json of every url, in order, with None for the failed ones. The
+    # calls are fanned out over a pool of concurrency threads sharing the
+    # pooled Session, at most per_host of them to the same host. Calls
+    # throttled by the rate limiter are made again, up to
+    # QUOTE_SERVICE_RETRIES times, once the others are done
+    urls = list(urls)
+    if not urls:
+        return []
+    per_host = per_host or settings.PRICE_REFRESH_PER_HOST
+    hosts = {netloc: threading.BoundedSemaphore(per_host)
+        for netloc in {urlsplit(url).netloc for url in urls}}
+    results = [_THROTTLED] * len(urls)
+    pending = list(range(len(urls)))
+    workers = min(concurrency or settings.PRICE_REFRESH_CONCURRENCY, len(urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for attempt in range(settings.QUOTE_SERVICE_RETRIES + 1):
+            if not pending:
+                break
+            if attempt:
+                logger.info('%d quote requests throttled, retrying',
+                    len(pending))
+            fetched = executor.map(lambda url: _fetch_json(url, hosts),
+                [urls[i] for i in pending])
+            for i, data in zip(pending, fetched):
+                results[i] = data
+            pending = [i for i in pending if results[i] is _THROTTLED]
+    if pending:
+        logger.warning('%d quote requests throttled, skipped', len(pending))
+    return [None if data is _THROTTLED else data for data in results]
@@ -1,22 +1,33 @@
 from django.contrib.auth.models import User
+from django.db import connection
 from django.db.models import (
     Sum,
     F,
+    Q,
     Case,
-    When
+    When,
+    OuterRef,
+    Subquery,
+    Value,
+    DecimalField
 )
+from django.db.models.functions import Coalesce
 from portfolio.models import (
     Portfolio,
     Transaction,
     Asset,
     AssetType,
     PortfolioConsolidated,
-    PortfolioAssetConsolidated
+    PortfolioAssetConsolidated,
+    PortfolioAssetZeroedPosition,
+    ImportJob
 )
 from portfolio.constants import (
     TypeTransactions
 )
-from typing import Iterable
+from typing import Iterable, Optional
+from decimal import Decimal
+import datetime
 
 def get_portfolios(
     *,
@@ -27,6 +38,24 @@ def get_portfolios(
     filters['owner'] = fetched_by
     return Portfolio.objects.filter(**filters).distinct()
 
+def get_portfolios_total_value(
+    *,
+    fetched_by: User,
+    filters=None
+) -> Iterable[Portfolio]:
+    # total_value is the market value of the consolidated positions, summed
+    # in a correlated subquery instead of one query per portfolio
+    total = PortfolioAssetConsolidated.objects.filter(
+            portfolio=OuterRef('pk')
+        ).order_by().values('portfolio').annotate(
+            total=Sum(F('quantity')*F('asset__current_price'))
+        ).values('total')
+    qs = get_portfolios(fetched_by=fetched_by, filters=filters)
+    return qs.annotate(total_value=Coalesce(
+        Subquery(total, output_field=DecimalField(max_digits=28, decimal_places=10)),
+        Value(Decimal(0)),
+        output_field=DecimalField(max_digits=28, decimal_places=10)))
+
 def get_transactions(
     *,
     portfolio: Portfolio,
@@ -62,13 +91,15 @@ def get_stocks(
 
 def get_active_assets(
     *,
-    type_investment: AssetType,
+    type_investment: Optional[AssetType] = None,
     filters=None
 ) -> Iterable[Asset]:
-    qs = PortfolioAssetConsolidated.objects.filter(
-        asset__type_investment=type_investment)
-    qs = qs.values('asset').distinct('asset')
-    return Asset.objects.filter(pk__in=[q['asset'] for q in qs])
+    # Assets of any consolidated position, all types when none is given
+    qs = PortfolioAssetConsolidated.objects.all()
+    if type_investment is not None:
+        qs = qs.filter(asset__type_investment=type_investment)
+    filters = filters or {}
+    return Asset.objects.filter(pk__in=qs.values('asset')).filter(**filters)
 
 def get_fiis(
     *,
@@ -137,54 +168,69 @@ def get_transactions_asset(
     return qs.filter(asset=asset)
 
 #NCZP => No Consider Zeroed Positions
-def get_transactions_asset_nczp(
+def get_last_zeroed_transaction(
     *,
     portfolio:Portfolio,
-    asset:Asset,
-    filters=None
-) -> Iterable[Transaction]:
-    from django.db import connection
+    asset:Asset
+) -> Optional[dict]:
+    # Running quantity per transaction date in a single ordered scan, the
+    # default window frame already sums every row up to the current date.
+    # The last transaction of the zeroing date is the one that closed it
     with connection.cursor() as cursor:
         cursor.execute('''
-        WITH transaction_dates
-             AS (SELECT DISTINCT transaction_date date_t
-                 FROM   portfolio_transaction
-                 WHERE  portfolio_id = %s
-                        AND asset_id = %s)
-        SELECT td.date_t,
-               Sum(CASE
-                     WHEN pt.type_transaction = \''''+
-                        TypeTransactions.BUY.value +
-                        '''\' THEN pt.quantity * -1
-                     WHEN pt.type_transaction = \''''+
-                        TypeTransactions.SELL.value +
-                        '''\' THEN pt.quantity
-                     ELSE NULL
-                   END) AS qty
-        FROM   portfolio_transaction pt,
-               transaction_dates td
-        WHERE  pt.portfolio_id = %s
-               AND pt.asset_id = %s
-               AND pt.transaction_date <= td.date_t
-        GROUP  BY td.date_t
-        HAVING Sum(CASE
-                     WHEN pt.type_transaction = \''''+
-                        TypeTransactions.BUY.value +
-                        '''\' THEN pt.quantity * -1
-                     WHEN pt.type_transaction = \''''+
-                        TypeTransactions.SELL.value + 
-                        '''\' THEN pt.quantity
-                     ELSE NULL
-                   END) = 0
-        ORDER  BY td.date_t DESC
-        ''', [portfolio.pk, asset.pk, portfolio.pk, asset.pk]);
+        SELECT date_t, id
+        FROM   (SELECT transaction_date date_t,
+                       id,
+                       Sum(CASE
+                             WHEN type_transaction = %s THEN quantity * -1
+                             WHEN type_transaction = %s THEN quantity
+                             ELSE NULL
+                           END) OVER (ORDER BY transaction_date) AS qty
+                FROM   portfolio_transaction
+                WHERE  portfolio_id = %s
+                       AND asset_id = %s) running_qty
+        WHERE  qty = 0
+        ORDER  BY date_t DESC, id DESC
+        LIMIT  1
+        ''', [TypeTransactions.BUY.value, TypeTransactions.SELL.value,
+            portfolio.pk, asset.pk])
         row = cursor.fetchone()
-        #print('LEN %s', len(row))
     if row:
-        qs = get_transactions_asset(portfolio=portfolio, asset=asset)
-        return qs.filter(transaction_date__gt=row[0])
+        return {'transaction_date': row[0], 'pk': row[1]}
+    return None
+
+def get_last_zeroed_date(
+    *,
+    portfolio:Portfolio,
+    asset:Asset
+) -> Optional[datetime.datetime]:
+    zeroed = get_last_zeroed_transaction(portfolio=portfolio, asset=asset)
+    return zeroed['transaction_date'] if zeroed else None
+
+def get_zeroed_position(
+    *,
+    portfolio:Portfolio,
+    asset:Asset
+) -> Optional[PortfolioAssetZeroedPosition]:
+    return PortfolioAssetZeroedPosition.objects.filter(
+        portfolio=portfolio, asset=asset).first()
+
+def get_transactions_asset_nczp(
+    *,
+    portfolio:Portfolio,
+    asset:Asset,
+    filters=None
+) -> Iterable[Transaction]:
+    qs = get_transactions_asset(portfolio=portfolio, asset=asset,
+        filters=filters)
+    position = get_zeroed_position(portfolio=portfolio, asset=asset)
+    if position is not None:
+        zeroed_date = position.zeroed_date
     else:
-        return get_transactions_asset(portfolio=portfolio, asset=asset)
+        zeroed_date = get_last_zeroed_date(portfolio=portfolio, asset=asset)
+    if zeroed_date is not None:
+        return qs.filter(transaction_date__gt=zeroed_date)
+    return qs
 
 def get_all_assets_portfolio(
     *,
@@ -216,6 +262,48 @@ def get_current_assets_portfolio(
     ).filter(current_qty__gt=0)
     return Asset.objects.filter(pk__in=[q['asset'] for q in qs])
 
+def get_assets_totals(
+    *,
+    portfolio:Portfolio,
+    assets:Optional[Iterable[Asset]]=None,
+    filters=None
+) -> dict:
+    # Per asset aggregates of a portfolio in a single grouped query, keyed
+    # by asset id. Same formulas as the scalar helpers in services
+    qs = get_transactions(portfolio=portfolio, filters=filters)
+    if assets is not None:
+        qs = qs.filter(asset__in=assets)
+    buy = Q(type_transaction=TypeTransactions.BUY.value)
+    sell = Q(type_transaction=TypeTransactions.SELL.value)
+    dividend = Q(type_transaction=TypeTransactions.DIVIDEND.value)
+    gross = F('unit_cost') * F('quantity')
+    qs = qs.values('asset').annotate(
+        quantity_total=Sum(Case(
+            When(buy, then=F('quantity')),
+            When(sell, then=F('quantity')*-1),
+        )),
+        total_cost=Sum(Case(
+            When(buy, then=(gross + F('other_costs'))*-1),
+            When(sell, then=gross - F('other_costs')),
+        )),
+        total_buy=Sum(Case(When(buy, then=gross - F('other_costs')))),
+        total_sell=Sum(Case(When(sell, then=gross - F('other_costs')))),
+        total_dividend=Sum(Case(When(dividend, then=gross - F('other_costs')))),
+        total_other_cost=Sum('other_costs'),
+    ).order_by()
+
+    totals = {}
+    for row in qs:
+        totals[row['asset']] = {
+            'quantity': row['quantity_total'] or Decimal(0),
+            'total_cost': row['total_cost'] or Decimal(0),
+            'total_buy': row['total_buy'] or Decimal(0),
+            'total_sell': row['total_sell'] or Decimal(0),
+            'total_dividend': row['total_dividend'] or Decimal(0),
+            'total_other_cost': row['total_other_cost'] or Decimal(0),
+        }
+    return totals
+
 def get_assets_consolidated(
     *,
     portfolio:Portfolio,
@@ -225,6 +313,18 @@ def get_assets_consolidated(
     filters = filters or {}
     return qs.filter(**filters)
 
+def get_assets_consolidated_user(
+    *,
+    user: User,
+    filters=None
+) -> Iterable[PortfolioAssetConsolidated]:
+    filters = filters or {}
+    qs = PortfolioAssetConsolidated.objects.filter(
+        portfolio__in=get_portfolios(
+            fetched_by=user
+        ))
+    return qs.filter(**filters)
+
 def get_portfolio_consolidated(
     *,
     portfolio:Portfolio,
@@ -233,3 +333,12 @@ def get_portfolio_consolidated(
     qs = PortfolioConsolidated.objects.filter(portfolio=portfolio)
     filters = filters or {}
     return qs.filter(**filters)
+
+def get_import_jobs(
+    *,
+    fetched_by: User,
+    filters=None
+) -> Iterable[ImportJob]:
+    filters = filters or {}
+    filters['owner'] = fetched_by
+    return ImportJob.objects.filter(**filters)
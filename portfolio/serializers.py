@@ -0,0 +1,169 @@
+from django.db.models import F
+from rest_framework import serializers
+from decimal import Decimal
+from typing import Iterable, Optional
+
+
+class ValuesSerializer:
+    # Serializes the rows of QuerySet.values() as they come from the
+    # database, without model instances or a DRF field per value.
+    # sources maps the output names that are not model fields to a lookup,
+    # computed the names filled by compute() to the values they need
+    fields = ()
+    sources = {}
+    computed = {}
+
+    def __init__(
+        self,
+        *,
+        fields: Optional[Iterable[str]] = None,
+        context: Optional[dict] = None
+    ):
+        self.context = context or {}
+        if fields:
+            invalid = [f for f in fields if f not in self.fields]
+            if invalid:
+                raise serializers.ValidationError(
+                    {'fields': 'Unknown fields: %s' % ', '.join(invalid)})
+            self.selected = [f for f in self.fields if f in fields]
+        else:
+            self.selected = list(self.fields)
+
+    def values(self, queryset):
+        # id is always read, it is the position of the keyset pagination
+        names = ['id'] + self.selected
+        for name in self.selected:
+            names += self.computed.get(name, ())
+        names = [n for n in dict.fromkeys(names) if n not in self.computed]
+        # Sources are read under an alias, their names may be model fields
+        return queryset.values(
+            *[n for n in names if n not in self.sources],
+            **{'src_' + n: F(self.sources[n]) for n in names if n in self.sources})
+
+    def compute(self, row: dict) -> None:
+        pass
+
+    def to_representation(self, rows: Iterable[dict]) -> list:
+        keys = [(name, 'src_' + name if name in self.sources else name)
+            for name in self.selected]
+        data = []
+        for row in rows:
+            self.compute(row)
+            data.append({name: str(row[key]) if isinstance(row[key], Decimal)
+                else row[key] for name, key in keys})
+        return data
+
+
+class PortfolioSerializer(ValuesSerializer):
+    fields = (
+        'id',
+        'name',
+        'desc_1',
+        'consolidated',
+        'consolidation_version',
+        'created_at',
+        'last_update',
+    )
+
+
+class PortfolioConsolidatedSerializer(ValuesSerializer):
+    fields = (
+        'id',
+        'currency',
+        'total_cost',
+        'total_cost_nczp',
+        'total_dividend',
+        'total_dividend_nczp',
+        'total_other_cost',
+        'total_other_cost_nczp',
+        'last_update',
+    )
+
+
+class PositionSerializer(ValuesSerializer):
+    fields = (
+        'id',
+        'ticker',
+        'currency',
+        'quantity',
+        'avg_p_price',
+        'avg_p_price_nczp',
+        'avg_s_price',
+        'avg_s_price_nczp',
+        'total_cost',
+        'total_cost_nczp',
+        'total_dividend',
+        'total_dividend_nczp',
+        'total_other_cost',
+        'total_other_cost_nczp',
+        'last_update',
+    )
+    sources = {
+        'ticker': 'asset__ticker',
+    }
+
+
+class ResultSerializer(ValuesSerializer):
+    # Same rows as services.get_results_consolidate
+    fields = (
+        'id',
+        'ticker',
+        'quantity',
+        'current_price',
+        'currency',
+        'last_update',
+        'avg_p_price_nczp',
+        'total_cost',
+        'total_cost_nczp',
+        'total_dividend_nczp',
+        'total_current',
+        'portfolio_percentage',
+        'result_currency_nczp',
+        'result_percentage_nczp',
+        'result_currency',
+        'result_percentage',
+    )
+    sources = {
+        'ticker': 'asset__ticker',
+        'current_price': 'market_price',
+        'currency': 'asset__currency',
+        'last_update': 'asset__last_update',
+    }
+    computed = {
+        'portfolio_percentage': ('total_current',),
+    }
+
+    def compute(self, row: dict) -> None:
+        if 'portfolio_percentage' in self.selected:
+            total = self.context.get('total_portfolio')
+            row['portfolio_percentage'] = \
+                (row['total_current']/total)*100 if total else Decimal(0)
+
+
+class ImportJobSerializer(ValuesSerializer):
+    fields = (
+        'id',
+        'kind',
+        'status',
+        'portfolio',
+        'total_rows',
+        'processed_rows',
+        'imported_rows',
+        'error_count',
+        'progress',
+        'errors',
+        'created_at',
+        'last_update',
+    )
+    sources = {
+        'portfolio': 'portfolio_id',
+    }
+    computed = {
+        'progress': ('processed_rows', 'total_rows'),
+    }
+
+    def compute(self, row: dict) -> None:
+        if 'progress' in self.selected:
+            total = row['total_rows']
+            row['progress'] = \
+                round(row['processed_rows']*100/total, 2) if total else None
@@ -2,9 +2,13 @@ from django.contrib.auth.models import User
 from django.core import exceptions
 from django.utils import timezone
 from django.db import transaction
+from django.core.files import File
+from django.conf import settings
 from decouple import config
 from django.db.models import (
     Sum,
+    Min,
+    Max,
     F,
     Q,
     Case,
@@ -18,22 +22,28 @@ from portfolio.models import (
     Asset,
     Transaction,
     PortfolioConsolidated,
-    PortfolioAssetConsolidated
+    PortfolioAssetConsolidated,
+    PortfolioAssetZeroedPosition,
+    ImportJob
 )
 from portfolio.selectors import (
     get_transactions_asset,
     get_transactions,
-    get_current_assets_portfolio,
     get_all_assets_portfolio,
     get_transactions_asset_nczp,
+    get_last_zeroed_transaction,
     get_portfolio_consolidated,
     get_assets_consolidated,
-    get_assets
+    get_assets_totals,
+    get_assets,
+    get_active_assets
 )
 from portfolio.constants import (
     TypeTransactions,
     CurrencyChoices,
-    StockBrokerChoices
+    StockBrokerChoices,
+    ImportJobKind,
+    ImportJobStatus
 )
 from typing import (
     Optional,
@@ -42,10 +52,21 @@ from typing import (
     Iterable,
     Literal
 )
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from itertools import groupby, islice
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 import datetime
 from enum import Enum
-import requests, json, re
+from portfolio import quotes
+import requests, re, csv, io, logging
+
+logger = logging.getLogger(__name__)
+
+# Error messages stored on an ImportJob, the rest are only counted
+IMPORT_JOB_MAX_ERRORS = 1000
+# Transactions marked consolidated per UPDATE
+TRANSACTION_UPDATE_BATCH = 2000
 
 
 def _test_permissions(
@@ -99,8 +120,89 @@ def task_refresh_price(
     refresh(ticker)
 
 def task_refresh_all_prices():
-    from portfolio.tasks import refresh_assets_prices
-    refresh_assets_prices()
+    from portfolio.tasks import refresh_all_prices
+    refresh_all_prices()
+
+def task_consolidate_portfolio(
+    *,
+    portfolio_id: int,
+    countdown: int = 0
+):
+    from portfolio.tasks import consolidate_portfolio as consolidate
+    consolidate(portfolio_id, countdown=countdown)
+
+def _now() -> datetime.datetime:
+    return timezone.now()
+
+def schedule_consolidation(
+    *,
+    portfolio_id: int
+) -> None:
+    # Trailing debounce: every write moves the run CONSOLIDATION_DEBOUNCE
+    # seconds after itself, a single run is pending at a time and a burst
+    # of writes postpones it by CONSOLIDATION_MAX_DELAY seconds at most. The
+    # state is on the portfolio row, shared by the web and worker processes
+    debounce = settings.CONSOLIDATION_DEBOUNCE
+
+    def schedule():
+        now = _now()
+        due = now + datetime.timedelta(seconds=debounce)
+        # A run pending for longer than it can be postponed was lost
+        lost = now - datetime.timedelta(
+            seconds=settings.CONSOLIDATION_MAX_DELAY + debounce * 2)
+        if Portfolio.objects.filter(
+                Q(consolidation_scheduled_at__isnull=True) |
+                    Q(consolidation_scheduled_at__lt=lost),
+                pk=portfolio_id).update(consolidation_scheduled_at=now,
+                    consolidation_due_at=due):
+            task_consolidate_portfolio(portfolio_id=portfolio_id,
+                countdown=debounce)
+        else:
+            Portfolio.objects.filter(pk=portfolio_id).update(
+                consolidation_due_at=due)
+    transaction.on_commit(schedule)
+
+def consolidate_debounced_portfolio(
+    *,
+    portfolio_id: int
+) -> Optional[bool]:
+    # Run of schedule_consolidation. When writes came in after it was
+    # scheduled it is sent again for the end of the debounce and returns
+    # None. The pending run is cleared before consolidating, a write made
+    # meanwhile schedules a new one
+    state = Portfolio.objects.filter(pk=portfolio_id).values(
+        'consolidation_scheduled_at', 'consolidation_due_at').first()
+    if state is None:
+        return False
+    scheduled_at = state['consolidation_scheduled_at']
+    if scheduled_at is not None:
+        now = _now()
+        run_at = min(state['consolidation_due_at'] or now, scheduled_at +
+            datetime.timedelta(seconds=settings.CONSOLIDATION_MAX_DELAY))
+        if run_at > now:
+            task_consolidate_portfolio(portfolio_id=portfolio_id,
+                countdown=(run_at - now).total_seconds())
+            return None
+        Portfolio.objects.filter(pk=portfolio_id).update(
+            consolidation_scheduled_at=None, consolidation_due_at=None)
+    return consolidate_scheduled_portfolio(portfolio_id=portfolio_id)
+
+def get_portfolio_detail_cache_key(
+    *,
+    portfolio: Portfolio,
+    user: User
+) -> str:
+    # Read from the database so every process, web or worker, gets the same
+    # key. Transaction writes unset consolidated, consolidations move the
+    # version and price refreshes the last_update of the held assets
+    prices = PortfolioAssetConsolidated.objects.filter(
+        portfolio=portfolio).aggregate(updated=Max('asset__last_update'))
+    return 'portfolio-detail-%s-%s-%s-%s-%s' % (
+        portfolio.pk,
+        user.pk,
+        portfolio.consolidation_version,
+        int(portfolio.consolidated),
+        prices['updated'].timestamp() if prices['updated'] else 0)
 
 def get_or_create_asset_type(
     *,
@@ -133,9 +235,20 @@ def create_asset(
     if id:
         filter['pk'] = id
 
-    data = {}
-    asset_info = get_ticker_info(ticker=ticker)
+    current = Asset.objects.filter(**filter).first()
+    if current is not None and is_asset_info_fresh(asset=current):
+        # The stored metadata stands in for the lookup
+        asset_info = {
+            'symbol': current.symbol,
+            'longname': current.name,
+            'shortname': current.desc_1,
+        }
+        info_updated_at = current.info_updated_at
+    else:
+        asset_info = get_ticker_info(ticker=ticker)
+        info_updated_at = timezone.now() if asset_info else None
 
+    data = {}
     data['ticker'] = ticker
     data['type_investment'] = type_investment
     data['name'] = name or asset_info.get('longname')
@@ -144,30 +257,379 @@ def create_asset(
     data['desc_1'] = desc_1 or asset_info.get('shortname')
     data['desc_2'] = desc_2 or asset_info.get('symbol')
     data['desc_3'] = desc_3
+    data['symbol'] = asset_info.get('symbol')
+    data['info_updated_at'] = info_updated_at
 
-    try:
-        asset = Asset.objects.get(**filter)
+    if current is not None:
+        asset = current
         Asset.objects.filter(**filter).update(**data)
         asset.refresh_from_db()
-    except exceptions.ObjectDoesNotExist:
+    else:
         asset = Asset.objects.create(**data)
     task_refresh_price(ticker=ticker)
     return asset
 
 
+def task_enrich_assets(
+    *,
+    countdown: int = 0
+):
+    from portfolio.tasks import enrich_assets
+    enrich_assets(countdown=countdown)
+
+def _asset_from_row(
+    *,
+    row: dict,
+    asset_types: dict
+) -> Asset:
+    ticker = (row.get('ticker') or '').strip()
+    if not ticker:
+        raise exceptions.ValidationError('Missing ticker')
+    Asset._meta.get_field('ticker').run_validators(ticker)
+    type_name = (row.get('type_investment') or '').strip()
+    if not type_name:
+        raise exceptions.ValidationError('Missing type_investment')
+    if type_name not in asset_types:
+        asset_types[type_name] = get_or_create_asset_type(name=type_name)
+    currency = (row.get('currency') or '').strip() or CurrencyChoices.REAL.value
+    if not validate_currency(currency=currency):
+        raise exceptions.ValidationError('Invalid Currency')
+
+    return Asset(
+        ticker=ticker,
+        type_investment=asset_types[type_name],
+        name=(row.get('name') or '')[0:60].strip(),
+        currency=currency,
+        desc_1=(row.get('desc_1') or '')[0:20].strip() or None,
+        desc_2=(row.get('desc_2') or '')[0:50].strip() or None,
+        desc_3=(row.get('desc_3') or '')[0:100].strip() or None)
+
+def _set_asset_info(
+    *,
+    asset: Asset,
+    info: dict,
+    now: datetime.datetime
+) -> None:
+    # Only blank fields are filled, a name is required so the ticker stands
+    # in until a lookup succeeds
+    asset.name = asset.name or (info.get('longname') or '')[0:60] or asset.ticker
+    asset.desc_1 = asset.desc_1 or (info.get('shortname') or '')[0:20] or None
+    asset.desc_2 = asset.desc_2 or (info.get('symbol') or '')[0:50] or None
+    if info:
+        asset.symbol = info.get('symbol') or asset.symbol
+        asset.info_updated_at = now
+
+_ASSET_IMPORT_FIELDS = [
+    'type_investment',
+    'name',
+    'currency',
+    'desc_1',
+    'desc_2',
+    'desc_3',
+    'symbol',
+    'info_updated_at',
+]
+
+def import_assets(
+    *,
+    batch: list,
+    infos: Optional[dict] = None
+) -> tuple:
+    # Rows of a ';' separated file (ticker, name, type_investment, currency,
+    # desc_1, desc_2, desc_3) as (line, row). Ticker info is looked up
+    # concurrently, unless given in infos, and the assets are written with
+    # one bulk insert and one bulk update. Tickers whose lookup failed are
+    # stored as placeholders and enriched later
+    asset_types = {}
+    assets = {}
+    errors = []
+    for line, row in batch:
+        try:
+            asset = _asset_from_row(row=row, asset_types=asset_types)
+        except exceptions.ValidationError as e:
+            errors += ['Line %s: %s' % (line, m) for m in e.messages]
+            continue
+        assets[asset.ticker] = asset
+    if not assets:
+        return 0, errors
+
+    if infos is None:
+        infos = get_tickers_info(tickers=assets)
+    existing = {a.ticker: a for a in get_assets(
+        filters={'ticker__in': list(assets)})}
+    now = timezone.now()
+    for ticker, asset in assets.items():
+        current = existing.get(ticker)
+        if current is not None:
+            # Stored values are kept where the row leaves a field blank
+            asset.pk = current.pk
+            asset.current_price = current.current_price
+            asset.symbol = current.symbol
+            asset.info_updated_at = current.info_updated_at
+            for name in ('name', 'desc_1', 'desc_2', 'desc_3'):
+                setattr(asset, name, getattr(asset, name) or getattr(current, name))
+        _set_asset_info(asset=asset, info=infos.get(ticker) or {}, now=now)
+
+    Asset.objects.bulk_update([a for a in assets.values() if a.pk],
+        _ASSET_IMPORT_FIELDS)
+    Asset.objects.bulk_create([a for a in assets.values() if not a.pk],
+        ignore_conflicts=True)
+
+    tickers = sorted(assets)
+    transaction.on_commit(lambda: [task_refresh_price(ticker=ticker)
+        for ticker in tickers])
+    if any(a.info_updated_at is None for a in assets.values()):
+        transaction.on_commit(lambda: task_enrich_assets(
+            countdown=settings.ASSET_INFO_RETRY_DELAY))
+    return len(assets), errors
+
+def enrich_assets(
+    *,
+    limit: int = 500
+) -> int:
+    # Retries the lookup of the assets stored with placeholder metadata
+    assets = list(get_assets(filters={'info_updated_at__isnull': True})
+        .order_by('pk')[:limit])
+    infos = get_tickers_info(tickers=[a.ticker for a in assets])
+    now = timezone.now()
+    enriched = []
+    for asset in assets:
+        info = infos.get(asset.ticker)
+        if not info:
+            continue
+        if asset.name == asset.ticker:
+            asset.name = ''
+        _set_asset_info(asset=asset, info=info, now=now)
+        asset.last_update = now
+        enriched.append(asset)
+    Asset.objects.bulk_update(enriched,
+        ['name', 'desc_1', 'desc_2', 'symbol', 'info_updated_at', 'last_update'])
+    return len(enriched)
+
+def is_asset_info_fresh(
+    *,
+    asset: Asset
+) -> bool:
+    return bool(asset.symbol and asset.info_updated_at and
+        asset.info_updated_at > timezone.now() -
+            datetime.timedelta(seconds=settings.ASSET_INFO_TTL))
+
+def refresh_asset_info(
+    *,
+    asset: Asset
+) -> bool:
+    # Looks the ticker up again whatever the age of the stored metadata
+    info = get_ticker_info(ticker=asset.ticker)
+    if not info:
+        return False
+    now = timezone.now()
+    if asset.name == asset.ticker:
+        asset.name = ''
+    _set_asset_info(asset=asset, info=info, now=now)
+    asset.last_update = now
+    asset.save(update_fields=['name', 'desc_1', 'desc_2', 'symbol',
+        'info_updated_at', 'last_update'])
+    return True
+
+def get_asset_symbol(
+    *,
+    asset: Asset
+) -> Optional[str]:
+    # The stored symbol while it is within ASSET_INFO_TTL, a stale one is
+    # still used when the lookup fails
+    if not is_asset_info_fresh(asset=asset):
+        try:
+            refresh_asset_info(asset=asset)
+        except requests.RequestException:
+            pass
+    return asset.symbol
+
 def refresh_current_price(
     *,
     ticker: str
 ) -> bool:
-    price = get_current_price(ticker=ticker)
+    asset = get_assets(filters={'ticker': ticker}).first()
+    if asset is None:
+        price = get_current_price(ticker=ticker)
+    else:
+        # Already looked up when it is missing, not searched for again
+        symbol = get_asset_symbol(asset=asset)
+        if not symbol:
+            return False
+        price = get_current_price(ticker=ticker, symbol=symbol)
     if price:
         Asset.objects.filter(ticker=ticker).update(
             current_price=price,
             last_update=timezone.now()
         )
+        if asset is not None:
+            refresh_market_values(assets=[asset.pk])
         return True
     return False
 
+def _parse_chart_price(
+    data: Optional[dict]
+) -> Decimal:
+    try:
+        price = data['chart']['result'][0]['meta']['regularMarketPrice']
+        return Decimal(str(price))
+    except (KeyError, IndexError, TypeError, InvalidOperation):
+        raise exceptions.ObjectDoesNotExist
+
+def _parse_quotes(
+    data: Optional[dict]
+) -> dict:
+    try:
+        result = data['quoteResponse']['result']
+        return {q['symbol']: Decimal(str(q['regularMarketPrice']))
+            for q in result if q.get('regularMarketPrice') is not None}
+    except (KeyError, TypeError, InvalidOperation):
+        return {}
+
+def _get_chart_prices(
+    *,
+    symbols: list
+) -> dict:
+    url = config('SERVICE_PRICES_URL')
+    prices = {}
+    results = quotes.get_json_many(url + symbol for symbol in symbols)
+    for symbol, data in zip(symbols, results):
+        try:
+            prices[symbol] = _parse_chart_price(data)
+        except exceptions.ObjectDoesNotExist:
+            pass
+    return prices
+
+def get_current_prices(
+    *,
+    symbols: Iterable[str],
+    chunk_size: Optional[int] = None
+) -> dict:
+    # Prices by symbol, missing ones were not found. With SERVICE_QUOTES_URL
+    # every chunk of symbols is one request, the symbols a failed or partial
+    # answer left out get one chart request each. Without it every symbol is
+    # one chart request. The requests run concurrently
+    symbols = list(dict.fromkeys(symbols))
+    chunk_size = chunk_size or settings.PRICE_REFRESH_CHUNK_SIZE
+    prices = {}
+    url = config('SERVICE_QUOTES_URL', default='')
+    if url:
+        chunks = [symbols[i:i + chunk_size]
+            for i in range(0, len(symbols), chunk_size)]
+        for data in quotes.get_json_many(url + ','.join(chunk)
+                for chunk in chunks):
+            prices.update(_parse_quotes(data))
+    missing = [symbol for symbol in symbols if symbol not in prices]
+    if missing:
+        prices.update(_get_chart_prices(symbols=missing))
+    return prices
+
+def refresh_prices(
+    *,
+    tickers: Optional[Iterable[str]] = None,
+    chunk_size: Optional[int] = None
+) -> int:
+    # The prices of the active assets, or of the given tickers, are fetched
+    # concurrently and written with one UPDATE per chunk of assets. Returns
+    # the number of prices updated. Raises QuoteServiceCircuitOpen before
+    # doing anything while the quote service is failing
+    quotes.check_circuit(config('SERVICE_QUOTES_URL', default='') or
+        config('SERVICE_PRICES_URL'))
+    chunk_size = chunk_size or settings.PRICE_REFRESH_CHUNK_SIZE
+    if tickers is None:
+        qs = get_active_assets()
+    else:
+        qs = get_assets(filters={'ticker__in': list(tickers)})
+    assets = list(qs.order_by('pk'))
+    now = timezone.now()
+    changed = {}
+
+    stale = [a.ticker for a in assets if not is_asset_info_fresh(asset=a)]
+    infos = get_tickers_info(tickers=stale)
+    for asset in assets:
+        symbol = (infos.get(asset.ticker) or {}).get('symbol')
+        if symbol:
+            asset.symbol = symbol
+            asset.info_updated_at = now
+            changed[asset.pk] = asset
+
+    prices = get_current_prices(symbols=[a.symbol for a in assets if a.symbol],
+        chunk_size=chunk_size)
+    priced = set()
+    for asset in assets:
+        price = prices.get(asset.symbol)
+        if price:
+            asset.current_price = price
+            asset.last_update = now
+            changed[asset.pk] = asset
+            priced.add(asset.pk)
+
+    unpriced = [a.ticker for a in assets if a.pk not in priced]
+    if unpriced:
+        logger.warning('No price for %d of %d assets: %s', len(unpriced),
+            len(assets), ', '.join(unpriced[:20]))
+
+    Asset.objects.bulk_update(list(changed.values()), ['current_price',
+        'symbol', 'info_updated_at', 'last_update'], batch_size=chunk_size)
+    refresh_market_values(assets=priced)
+    return len(priced)
+
+@transaction.atomic
+def refresh_zeroed_position(
+    *,
+    portfolio: Portfolio,
+    asset: Asset,
+    inserted: Optional[Transaction] = None
+) -> Optional[PortfolioAssetZeroedPosition]:
+    position = PortfolioAssetZeroedPosition.objects.select_for_update(
+        ).filter(portfolio=portfolio, asset=asset).first()
+
+    # A newly inserted transaction dated after everything already indexed
+    # only moves the running quantity, anything else rebuilds the index
+    if (inserted is not None and position is not None and
+            position.last_transaction_date is not None):
+        transaction_date = inserted.transaction_date
+        if timezone.is_naive(transaction_date):
+            transaction_date = timezone.make_aware(transaction_date)
+        if transaction_date > position.last_transaction_date:
+            traded = position.quantity != 0 or position.zeroed_date is not None
+            quantity = Decimal(str(inserted.quantity))
+            if inserted.type_transaction == TypeTransactions.BUY.value:
+                position.quantity += quantity
+                traded = True
+            elif inserted.type_transaction == TypeTransactions.SELL.value:
+                position.quantity -= quantity
+                traded = True
+            position.last_transaction_date = transaction_date
+            if traded and position.quantity == 0:
+                position.zeroed_date = transaction_date
+                position.zeroed_transaction_id = inserted.pk
+            position.save()
+            return position
+
+    qs = get_transactions_asset(portfolio=portfolio, asset=asset)
+    qs = qs.aggregate(
+        quantity=Sum(Case(
+            When(type_transaction=TypeTransactions.BUY.value, then=F('quantity')),
+            When(type_transaction=TypeTransactions.SELL.value, then=F('quantity')*-1),
+        )),
+        last_transaction_date=Max('transaction_date'))
+    if qs['last_transaction_date'] is None:
+        if position is not None:
+            position.delete()
+        return None
+
+    zeroed = get_last_zeroed_transaction(portfolio=portfolio, asset=asset)
+    if position is None:
+        position = PortfolioAssetZeroedPosition(portfolio=portfolio,
+            asset=asset)
+    position.quantity = qs['quantity'] or Decimal(0)
+    position.last_transaction_date = qs['last_transaction_date']
+    position.zeroed_date = zeroed['transaction_date'] if zeroed else None
+    position.zeroed_transaction_id = zeroed['pk'] if zeroed else None
+    position.save()
+    return position
+
 def create_transaction(
     *,
     id: Optional[int] = 0,
@@ -216,16 +678,278 @@ def create_transaction(
     try:
         transaction = Transaction.objects.get(pk=id)
         Transaction.objects.filter(pk=id).update(**data)
+        # Queryset updates skip the signals, so the zeroed positions of the
+        # previous and the new asset are refreshed here
+        refresh_zeroed_position(portfolio=portfolio, asset=asset)
+        if (transaction.portfolio_id, transaction.asset_id) != (portfolio.pk, asset.pk):
+            refresh_zeroed_position(portfolio=transaction.portfolio,
+                asset=transaction.asset)
         transaction.refresh_from_db()
     except exceptions.ObjectDoesNotExist:
         transaction = Transaction.objects.create(**data)
-    task_refresh_price(ticker=asset.ticker)
 
+    # save() would write back a stale consolidation_version and last_update
+    Portfolio.objects.filter(pk=portfolio.pk).update(consolidated=False)
     portfolio.consolidated = False
-    portfolio.save()
     task_refresh_price(ticker=asset.ticker)
     return transaction
 
+def _parse_decimal(
+    text: Optional[str]
+) -> Decimal:
+    # Broker exports use a decimal comma and a currency prefix
+    text = (text or '').strip()
+    for symbol in ('R$', '$', '€'):
+        text = text.replace(symbol, '')
+    text = text.replace(',', '.').strip() or '0'
+    try:
+        return Decimal(text)
+    except InvalidOperation:
+        raise exceptions.ValidationError('Invalid number %s' % text)
+
+def _transaction_from_row(
+    *,
+    portfolio: Portfolio,
+    row: dict,
+    assets: dict
+) -> Transaction:
+    ticker = (row.get('ticker') or '').strip()
+    asset = assets.get(ticker)
+    if asset is None:
+        raise exceptions.ValidationError('Unknown asset %s' % ticker)
+    type_transaction = (row.get('transaction') or '').strip()
+    if type_transaction not in TypeTransactions.values:
+        raise exceptions.ValidationError(
+            'Invalid transaction %s' % type_transaction)
+    currency = (row.get('currency') or '').strip() or CurrencyChoices.REAL.value
+    if not validate_currency(currency=currency):
+        raise exceptions.ValidationError('Invalid Currency')
+    try:
+        transaction_date = timezone.make_aware(datetime.datetime.strptime(
+            (row.get('date') or '').strip(), '%d/%m/%Y'))
+    except ValueError:
+        raise exceptions.ValidationError('Invalid date %s' % row.get('date'))
+
+    data = {
+        'quantity': _parse_decimal(row.get('qty')),
+        'unit_cost': _parse_decimal(row.get('avg_price')),
+        'other_costs': _parse_decimal(row.get('other_costs')),
+    }
+    # bulk_create does not validate, max_digits is checked here
+    for name, value in data.items():
+        Transaction._meta.get_field(name).run_validators(value)
+
+    return Transaction(
+        portfolio=portfolio,
+        type_transaction=type_transaction,
+        transaction_date=transaction_date,
+        type_investment_id=asset.type_investment_id,
+        asset=asset,
+        currency=currency,
+        desc_1=(row.get('desc_1') or '')[0:20].strip(),
+        desc_2=(row.get('desc_2') or '')[0:100].strip(),
+        stockbroker=StockBrokerChoices.RI.value,
+        consolidated=False,
+        **data)
+
+def _load_row_assets(
+    *,
+    batch: list,
+    assets: dict
+) -> None:
+    tickers = {(row.get('ticker') or '').strip()
+        for _, row in batch} - set(assets)
+    if tickers:
+        assets.update({a.ticker: a
+            for a in get_assets(filters={'ticker__in': tickers})})
+
+def _transactions_from_rows(
+    *,
+    portfolio: Portfolio,
+    batch: list,
+    assets: dict
+) -> tuple:
+    _load_row_assets(batch=batch, assets=assets)
+    objs = []
+    errors = []
+    for line, row in batch:
+        try:
+            objs.append(_transaction_from_row(portfolio=portfolio,
+                row=row, assets=assets))
+        except exceptions.ValidationError as e:
+            errors += ['Line %s: %s' % (line, m) for m in e.messages]
+    return objs, errors
+
+def task_run_import_job(
+    *,
+    job_id: int
+):
+    from portfolio.tasks import run_import_job
+    run_import_job(job_id)
+
+def create_import_job(
+    *,
+    user: User,
+    kind: str,
+    file: File,
+    portfolio: Optional[Portfolio] = None
+) -> ImportJob:
+    if kind == ImportJobKind.TRANSACTIONS:
+        if portfolio is None or not portfolio.test_permission_user(user=user):
+            raise exceptions.PermissionDenied
+    elif kind != ImportJobKind.ASSETS:
+        raise exceptions.ValidationError('Invalid kind %s' % kind)
+
+    job = ImportJob.objects.create(owner=user, portfolio=portfolio,
+        kind=kind, file=file)
+    transaction.on_commit(lambda: task_run_import_job(job_id=job.pk))
+    return job
+
+def resume_import_job(
+    *,
+    user: User,
+    job: ImportJob
+) -> bool:
+    # A failed job, or one whose worker died, continues from its checkpoint
+    if job.owner_id != user.pk:
+        raise exceptions.PermissionDenied
+    if job.status == ImportJobStatus.DONE:
+        return False
+    ImportJob.objects.filter(pk=job.pk).update(
+        status=ImportJobStatus.PENDING, last_update=timezone.now())
+    transaction.on_commit(lambda: task_run_import_job(job_id=job.pk))
+    return True
+
+def _read_import_rows(
+    file: File
+) -> Iterable[tuple]:
+    lines = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    return enumerate(csv.DictReader(lines, delimiter=';'), start=2)
+
+def _import_transactions_chunk(
+    *,
+    job: ImportJob,
+    batch: list,
+    state: dict
+) -> tuple:
+    objs, errors = _transactions_from_rows(portfolio=job.portfolio,
+        batch=batch, assets=state.setdefault('assets', {}))
+    if objs:
+        Transaction.objects.bulk_create(objs)
+        # Committed with the checkpoint, a job that stops halfway leaves the
+        # portfolio dirty. The positions are rebuilt by _import_transactions_done
+        Portfolio.objects.filter(pk=job.portfolio_id).update(consolidated=False)
+        job.touched_assets.add(*{obj.asset_id for obj in objs})
+    return len(objs), errors
+
+@transaction.atomic
+def _import_transactions_done(
+    *,
+    job: ImportJob
+) -> None:
+    # Signals do not fire for bulk_create, their work runs here once for
+    # the whole file
+    assets = list(job.touched_assets.all())
+    if not assets:
+        return
+    portfolio = job.portfolio
+    Portfolio.objects.filter(pk=portfolio.pk).update(consolidated=False)
+    for asset in assets:
+        refresh_zeroed_position(portfolio=portfolio, asset=asset)
+    schedule_consolidation(portfolio_id=portfolio.pk)
+    tickers = sorted(a.ticker for a in assets)
+    transaction.on_commit(lambda: [task_refresh_price(ticker=ticker)
+        for ticker in tickers])
+
+def _import_assets_prepare(
+    *,
+    batch: list,
+    state: dict
+) -> None:
+    # The lookups are slow, they run before the chunk transaction so that
+    # no lock is held while they wait
+    tickers = [(row.get('ticker') or '').strip() for _, row in batch]
+    state['infos'] = get_tickers_info(tickers=[t for t in tickers if t])
+
+def _import_assets_chunk(
+    *,
+    job: ImportJob,
+    batch: list,
+    state: dict
+) -> tuple:
+    return import_assets(batch=batch, infos=state.pop('infos', None))
+
+def run_import_job(
+    *,
+    job_id: int,
+    chunk_size: Optional[int] = None
+) -> ImportJob:
+    # Each chunk is committed together with the checkpoint. A job started
+    # again, after a worker crash or by hand, skips the rows already committed
+    chunk_size = chunk_size or settings.IMPORT_JOB_CHUNK_SIZE
+    job = ImportJob.objects.select_related('portfolio').get(pk=job_id)
+    if job.status == ImportJobStatus.DONE:
+        return job
+    if job.kind == ImportJobKind.TRANSACTIONS:
+        prepare = None
+        process = _import_transactions_chunk
+        done = _import_transactions_done
+    else:
+        prepare = _import_assets_prepare
+        process = _import_assets_chunk
+        done = None
+
+    chunks_done = False
+    try:
+        if job.total_rows is None:
+            with job.file.open('rb') as f:
+                job.total_rows = sum(1 for _ in _read_import_rows(f))
+        job.status = ImportJobStatus.RUNNING
+        job.save(update_fields=['total_rows', 'status', 'last_update'])
+
+        state = {}
+        with job.file.open('rb') as f:
+            rows = islice(_read_import_rows(f), job.processed_rows, None)
+            while True:
+                batch = list(islice(rows, chunk_size))
+                if not batch:
+                    break
+                if prepare is not None:
+                    prepare(batch=batch, state=state)
+                with transaction.atomic():
+                    checkpoint = ImportJob.objects.select_for_update().filter(
+                        pk=job.pk).values_list('processed_rows', flat=True).get()
+                    if checkpoint != job.processed_rows:
+                        # Another worker got the job and is ahead of this one
+                        return job
+                    imported, errors = process(job=job, batch=batch,
+                        state=state)
+                    job.processed_rows += len(batch)
+                    job.imported_rows += imported
+                    # Only the first errors are kept, all of them are counted
+                    kept = max(IMPORT_JOB_MAX_ERRORS - job.error_count, 0)
+                    job.errors += ''.join('%s\n' % e for e in errors[:kept])
+                    job.error_count += len(errors)
+                    job.save(update_fields=['processed_rows', 'imported_rows',
+                        'error_count', 'errors', 'last_update'])
+        chunks_done = True
+        if done is not None:
+            done(job=job)
+    except Exception:
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJobStatus.FAILED, last_update=timezone.now())
+        if done is not None and not chunks_done:
+            # The chunks committed before the failure are not left behind
+            try:
+                done(job=job)
+            except Exception:
+                logger.exception('Import job %s: positions not rebuilt', job.pk)
+        raise
+
+    job.status = ImportJobStatus.DONE
+    job.save(update_fields=['status', 'last_update'])
+    return job
+
 def create_fii_transaction(
     *,
     user: User,
@@ -384,9 +1108,12 @@ def get_total_dividend_asset(
 def get_total_dividend_asset_nczp(
     *,
     portfolio: Portfolio,
-    asset: Asset
+    asset: Asset,
+    transactions: Optional[Iterable[Transaction]] = None
 ) -> Decimal:
-    qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
+    qs = transactions
+    if qs is None:
+        qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
     qs = qs.filter(type_transaction=TypeTransactions.DIVIDEND.value)
     qs = qs.annotate(div=(F('unit_cost') * F('quantity')) - F('other_costs'))
     qs = qs.aggregate(Sum(F('div')))
@@ -404,9 +1131,12 @@ def get_operation_cost_asset(
 def get_operation_cost_asset_nczp(
     *,
     portfolio: Portfolio,
-    asset: Asset
+    asset: Asset,
+    transactions: Optional[Iterable[Transaction]] = None
 ) -> Decimal:
-    qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
+    qs = transactions
+    if qs is None:
+        qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
     qs = qs.aggregate(total_cost=Sum('other_costs'))
     return qs['total_cost'] if qs['total_cost'] is not None else Decimal(0)
 
@@ -438,9 +1168,12 @@ def get_avg_purchase_price(
 def get_avg_purchase_price_nczp(
     *,
     portfolio: Portfolio,
-    asset: Asset
+    asset: Asset,
+    transactions: Optional[Iterable[Transaction]] = None
 ) -> Decimal:
-    qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
+    qs = transactions
+    if qs is None:
+        qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
     qs = qs.filter(type_transaction = TypeTransactions.BUY.value)
     qs = qs.aggregate(
             avg_pp=Sum((F('unit_cost') * F('quantity')) + F('other_costs'))/
@@ -464,9 +1197,12 @@ def get_avg_sale_price(
 def get_avg_sale_price_nczp(
     *,
     portfolio: Portfolio,
-    asset: Asset
+    asset: Asset,
+    transactions: Optional[Iterable[Transaction]] = None
 ) -> Decimal:
-    qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
+    qs = transactions
+    if qs is None:
+        qs = get_transactions_asset_nczp(portfolio=portfolio, asset=asset)
     qs = qs.filter(type_transaction = TypeTransactions.SELL.value)
     qs = qs.aggregate(
             avg_sp=Sum((F('unit_cost') * F('quantity')) - F('other_costs'))/
@@ -479,23 +1215,22 @@ def get_total_cost_portfolio(
     portfolio: Portfolio
 ) -> Decimal:
 
-    assets = get_current_assets_portfolio(portfolio=portfolio)
-    total = 0
-    for asset in assets:
-        price = get_avg_purchase_price_nczp(portfolio=portfolio,asset=asset)
-        qty = get_qty_asset(portfolio=portfolio,asset=asset)
-        total = qty*price
-    return total
+    # One aggregate over the consolidated positions still held
+    total = get_assets_consolidated(portfolio=portfolio).aggregate(
+        total=Sum(F('quantity') * F('avg_p_price_nczp'),
+            filter=Q(quantity__gt=0)))['total']
+    return total if total is not None else Decimal(0)
 
 def get_total_value_portfolio(
     *,
     portfolio: Portfolio
 ) -> Decimal:
-    assets = get_current_assets_portfolio(portfolio=portfolio)
+    totals = get_assets_totals(portfolio=portfolio)
+    assets = get_assets(filters={
+        'pk__in': [pk for pk, t in totals.items() if t['quantity'] > 0]})
     total = 0
     for asset in assets:
-        qty = get_qty_asset(portfolio=portfolio,asset=asset)
-        total += qty*asset.current_price
+        total += totals[asset.pk]['quantity']*asset.current_price
     return total
 
 @transaction.atomic
@@ -512,26 +1247,335 @@ def reconsolidate_portfolio(
     Transaction.objects.filter(
             portfolio__pk=portfolio.pk
         ).update(consolidated = False)
+    schedule_consolidation(portfolio_id=portfolio.pk)
     task_refresh_all_prices()
     return True
 
-@transaction.atomic
+#NCZP => No Consider Zeroed Positions
+def _new_position() -> dict:
+    return {
+        'buy_quantity': Decimal(0),
+        'buy_cost': Decimal(0),
+        'sell_quantity': Decimal(0),
+        'sell_value': Decimal(0),
+        'dividend': Decimal(0),
+        'other_cost': Decimal(0),
+        'buy_quantity_nczp': Decimal(0),
+        'buy_cost_nczp': Decimal(0),
+        'sell_quantity_nczp': Decimal(0),
+        'sell_value_nczp': Decimal(0),
+        'dividend_nczp': Decimal(0),
+        'other_cost_nczp': Decimal(0),
+        'total_buy': Decimal(0),
+        'traded': False,
+        'zeroed_date': None,
+        'last_transaction_date': None,
+        'last_transaction_pk': None,
+    }
+
+_POSITION_STATE_FIELDS = (
+    'buy_quantity',
+    'buy_cost',
+    'sell_quantity',
+    'sell_value',
+    'dividend',
+    'other_cost',
+    'buy_quantity_nczp',
+    'buy_cost_nczp',
+    'sell_quantity_nczp',
+    'sell_value_nczp',
+    'dividend_nczp',
+    'other_cost_nczp',
+    'total_buy',
+    'zeroed_date',
+    'last_transaction_date',
+    'last_transaction_pk',
+)
+
+def _load_position(
+    *,
+    ac: PortfolioAssetConsolidated
+) -> dict:
+    position = _new_position()
+    for field in _POSITION_STATE_FIELDS:
+        position[field] = getattr(ac, field)
+    position['traded'] = bool(ac.buy_quantity or ac.sell_quantity)
+    return position
+
+def _close_position_date(
+    *,
+    position: dict
+) -> None:
+    # A position is zeroed when buys and sells up to (and including) the
+    # last date seen sum to zero; the nczp sums restart after that date
+    if not position['traded']:
+        return
+    if position['buy_quantity'] - position['sell_quantity'] != 0:
+        return
+    position['zeroed_date'] = position['last_transaction_date']
+    for key in ('buy_quantity_nczp', 'buy_cost_nczp', 'sell_quantity_nczp',
+            'sell_value_nczp', 'dividend_nczp', 'other_cost_nczp'):
+        position[key] = Decimal(0)
+
+def _apply_transaction(
+    *,
+    position: dict,
+    pk: int,
+    type_transaction: str,
+    transaction_date: datetime.datetime,
+    quantity: Decimal,
+    unit_cost: Decimal,
+    other_costs: Decimal
+) -> None:
+    if (position['last_transaction_date'] is not None and
+            transaction_date != position['last_transaction_date']):
+        _close_position_date(position=position)
+    position['last_transaction_date'] = transaction_date
+    position['last_transaction_pk'] = max(pk,
+        position['last_transaction_pk'] or 0)
+
+    other_costs = other_costs or Decimal(0)
+    if type_transaction == TypeTransactions.BUY.value:
+        cost = (unit_cost * quantity) + other_costs
+        position['buy_quantity'] += quantity
+        position['buy_cost'] += cost
+        position['buy_quantity_nczp'] += quantity
+        position['buy_cost_nczp'] += cost
+        position['total_buy'] += (unit_cost * quantity) - other_costs
+        position['traded'] = True
+    elif type_transaction == TypeTransactions.SELL.value:
+        value = (unit_cost * quantity) - other_costs
+        position['sell_quantity'] += quantity
+        position['sell_value'] += value
+        position['sell_quantity_nczp'] += quantity
+        position['sell_value_nczp'] += value
+        position['traded'] = True
+    elif type_transaction == TypeTransactions.DIVIDEND.value:
+        dividend = (unit_cost * quantity) - other_costs
+        position['dividend'] += dividend
+        position['dividend_nczp'] += dividend
+    position['other_cost'] += other_costs
+    position['other_cost_nczp'] += other_costs
+
+def _replay_transactions(
+    *,
+    transactions: Iterable[tuple],
+    positions: Optional[dict] = None
+) -> dict:
+    # Rows are (asset, pk, type_transaction, transaction_date, quantity,
+    # unit_cost, other_costs) ordered by asset and transaction_date.
+    # Assets found in positions continue from that running state
+    positions = positions or {}
+    for asset, rows in groupby(transactions, key=itemgetter(0)):
+        position = positions.get(asset) or _new_position()
+        for (_, pk, type_transaction, transaction_date,
+                quantity, unit_cost, other_costs) in rows:
+            _apply_transaction(
+                position=position,
+                pk=pk,
+                type_transaction=type_transaction,
+                transaction_date=transaction_date,
+                quantity=quantity,
+                unit_cost=unit_cost,
+                other_costs=other_costs)
+        _close_position_date(position=position)
+        positions[asset] = position
+    return positions
+
+def _replay_positions(
+    *,
+    portfolio: Portfolio,
+    assets: Iterable[Asset],
+    positions: Optional[dict] = None,
+    filters=None,
+    replayed: Optional[set] = None
+) -> dict:
+    # The pks of the rows read are added to replayed
+    filters = filters or {}
+    filters['asset__in'] = assets
+    qs = get_transactions(portfolio=portfolio, filters=filters)
+    qs = qs.order_by('asset', 'transaction_date', 'pk').values_list(
+        'asset',
+        'pk',
+        'type_transaction',
+        'transaction_date',
+        'quantity',
+        'unit_cost',
+        'other_costs')
+
+    def rows():
+        for row in qs.iterator():
+            if replayed is not None:
+                replayed.add(row[1])
+            yield row
+    return _replay_transactions(transactions=rows(), positions=positions)
+
+def _can_apply_delta(
+    *,
+    ac: Optional[PortfolioAssetConsolidated],
+    first_pk: int,
+    first_date: datetime.datetime
+) -> bool:
+    # New rows can be applied on top of the stored state only when they
+    # were all inserted after, and dated after, the last applied transaction.
+    # Edits and deletes mark already applied rows as unconsolidated again
+    if ac is None or ac.last_transaction_pk is None:
+        return False
+    return (first_pk > ac.last_transaction_pk and
+        first_date > ac.last_transaction_date)
+
+def _set_asset_consolidated(
+    *,
+    ac: PortfolioAssetConsolidated,
+    position: dict
+) -> PortfolioAssetConsolidated:
+    def div(v1, v2):
+        return v1/v2 if v2 else Decimal(0)
+
+    qty = position['buy_quantity'] - position['sell_quantity']
+    avg_p_price_nczp = div(position['buy_cost_nczp'],
+        position['buy_quantity_nczp'])
+    ac.quantity = qty
+    ac.avg_p_price = div(position['buy_cost'], position['buy_quantity'])
+    ac.avg_p_price_nczp = avg_p_price_nczp
+    ac.avg_s_price = div(position['sell_value'], position['sell_quantity'])
+    ac.avg_s_price_nczp = div(position['sell_value_nczp'],
+        position['sell_quantity_nczp'])
+    ac.total_cost = position['sell_value'] - position['buy_cost']
+    ac.total_cost_nczp = (qty*avg_p_price_nczp) if qty > 0 else 0
+    ac.total_dividend = position['dividend']
+    ac.total_dividend_nczp = position['dividend_nczp']
+    ac.total_other_cost = position['other_cost']
+    ac.total_other_cost_nczp = position['other_cost_nczp']
+    for field in _POSITION_STATE_FIELDS:
+        setattr(ac, field, position[field])
+    return ac
+
+def _set_asset_market(
+    *,
+    ac: PortfolioAssetConsolidated,
+    price: Decimal
+) -> PortfolioAssetConsolidated:
+    total_current = ac.quantity*price
+    result_nczp = total_current - ac.total_cost_nczp
+    result = ac.total_cost + total_current
+    ac.market_price = price
+    ac.total_current = total_current if ac.quantity else 0
+    ac.result_currency_nczp = result_nczp if ac.quantity else 0
+    ac.result_percentage_nczp = (result_nczp/ac.total_cost_nczp)*100 \
+        if ac.quantity and ac.total_cost_nczp else 0
+    ac.result_currency = result
+    ac.result_percentage = (result/ac.total_buy)*100 if ac.total_buy else 0
+    return ac
+
+_ASSET_MARKET_FIELDS = (
+    'market_price',
+    'total_current',
+    'result_currency',
+    'result_currency_nczp',
+    'result_percentage',
+    'result_percentage_nczp',
+)
+
+_ASSET_CONSOLIDATED_FIELDS = (
+    'quantity',
+    'avg_p_price',
+    'avg_p_price_nczp',
+    'avg_s_price',
+    'avg_s_price_nczp',
+    'total_cost',
+    'total_cost_nczp',
+    'total_dividend',
+    'total_dividend_nczp',
+    'total_other_cost',
+    'total_other_cost_nczp',
+) + _POSITION_STATE_FIELDS + _ASSET_MARKET_FIELDS
+
+_PORTFOLIO_CONSOLIDATED_FIELDS = (
+    'total_cost',
+    'total_cost_nczp',
+    'total_dividend',
+    'total_dividend_nczp',
+    'total_other_cost',
+    'total_other_cost_nczp',
+)
+
+def _bulk_save(
+    *,
+    model: Model,
+    objs: Iterable[Model],
+    changed: Iterable[Model],
+    fields: Iterable[str],
+    batch_size: int = 500
+) -> None:
+    # One INSERT for the new rows and one UPDATE for the changed ones per
+    # batch. bulk_update skips auto_now, so last_update is set here
+    if objs:
+        model.objects.bulk_create(objs, batch_size=batch_size)
+    changed = list(changed)
+    if changed:
+        now = timezone.now()
+        for obj in changed:
+            obj.last_update = now
+        model.objects.bulk_update(changed,
+            fields=list(fields) + ['last_update'],
+            batch_size=batch_size)
+
 def consolidate_portfolio(
     *,
     portfolio: Portfolio,
-    user: User
+    user: User,
+    incremental: bool = True
 ) -> bool:
 
     _test_permissions(user=user,
         permission='add_portfolioassetconsolidated',
         object=portfolio)
 
+    return _consolidate_portfolio(portfolio=portfolio,
+        incremental=incremental)
+
+def consolidate_scheduled_portfolio(
+    *,
+    portfolio_id: int,
+    full: bool = False
+) -> bool:
+    # Background and bulk runs, no user involved. full replays every asset
+    # of the portfolio from its whole history
+    if full:
+        with transaction.atomic():
+            Portfolio.objects.filter(pk=portfolio_id).update(consolidated=False)
+            Transaction.objects.filter(
+                    portfolio__pk=portfolio_id
+                ).update(consolidated=False)
+    portfolio = Portfolio.objects.filter(pk=portfolio_id).first()
+    if portfolio is None:
+        return False
+    return _consolidate_portfolio(portfolio=portfolio, incremental=not full)
+
+@transaction.atomic
+def _consolidate_portfolio(
+    *,
+    portfolio: Portfolio,
+    incremental: bool = True
+) -> bool:
+    if portfolio.consolidated:
+        return True
+
+    # Concurrent runs for the same portfolio queue on its row; the ones
+    # that get it after a run finished find it consolidated and reuse it
+    locked = Portfolio.objects.select_for_update().get(pk=portfolio.pk)
+    portfolio.consolidated = locked.consolidated
+    portfolio.consolidation_version = locked.consolidation_version
     if portfolio.consolidated:
         return True
 
     ts = get_transactions(portfolio=portfolio, filters={'consolidated': False})
-    ts = ts.values('asset').distinct('asset')
-    assets = get_assets(filters={'pk__in':[t['asset'] for t in ts]})
+    ts = ts.values('asset').annotate(
+        first_pk=Min('pk'),
+        first_date=Min('transaction_date'))
+    ts = {t['asset']: t for t in ts}
+    assets = list(get_assets(filters={'pk__in': list(ts)}))
 
     try:
         all_a = get_all_assets_portfolio(portfolio=portfolio)
@@ -540,55 +1584,71 @@ def consolidate_portfolio(
         pass
 
     assets_consolidated = get_assets_consolidated(portfolio=portfolio, filters={'asset__pk__in':[a.pk for a in assets]})
-    ac_d = {a.asset.ticker: a for a in assets_consolidated}
-
+    ac_d = {a.asset_id: a for a in assets_consolidated}
 
+    delta_assets = []
+    replay_assets = []
     for asset in assets:
-        if asset.ticker not in ac_d:
+        if incremental and _can_apply_delta(ac=ac_d.get(asset.pk),
+                first_pk=ts[asset.pk]['first_pk'],
+                first_date=ts[asset.pk]['first_date']):
+            delta_assets.append(asset)
+        else:
+            replay_assets.append(asset)
+
+    positions = {}
+    replayed = set()
+    if delta_assets:
+        positions = _replay_positions(portfolio=portfolio,
+            assets=delta_assets,
+            positions={a.pk: _load_position(ac=ac_d[a.pk]) for a in delta_assets},
+            filters={'consolidated': False},
+            replayed=replayed)
+    if replay_assets:
+        positions.update(_replay_positions(portfolio=portfolio,
+            assets=replay_assets, replayed=replayed))
+
+    new_ac = []
+    for asset in assets:
+        if asset.pk not in ac_d:
             ac = PortfolioAssetConsolidated()
             ac.asset = asset
             ac.portfolio = portfolio
             ac.currency = asset.currency
+            new_ac.append(ac)
         else:
-            ac = ac_d[asset.ticker]
-
-        qty = get_qty_asset(portfolio=portfolio,asset=asset)
-        avg_p_price_nczp = get_avg_purchase_price_nczp(portfolio=portfolio,asset=asset)
-        ac.quantity = qty
-        #current_price = get_current_price(ticker=asset.ticker)
-        ac.avg_p_price = get_avg_purchase_price(portfolio=portfolio,asset=asset)
-        ac.avg_p_price_nczp = avg_p_price_nczp
-        ac.avg_s_price = get_avg_sale_price(portfolio=portfolio,asset=asset)
-        ac.avg_s_price_nczp = get_avg_sale_price_nczp(portfolio=portfolio,asset=asset)
-        ac.total_cost = get_total_cost_asset(portfolio=portfolio, asset=asset)
-        ac.total_cost_nczp = (qty*avg_p_price_nczp) if qty > 0 else 0
-        ac.total_dividend = get_total_dividend_asset(portfolio=portfolio,asset=asset)
-        ac.total_dividend_nczp = get_total_dividend_asset_nczp(portfolio=portfolio,asset=asset)
-        ac.total_other_cost = get_operation_cost_asset(portfolio=portfolio,asset=asset)
-        ac.total_other_cost_nczp = get_operation_cost_asset_nczp(portfolio=portfolio,asset=asset)
-        ac.save()
+            ac = ac_d[asset.pk]
 
-    assets_consolidated = get_assets_consolidated(portfolio=portfolio)
-    curr = assets_consolidated.values('currency').distinct('currency')
-    currencies = [c['currency'] for c in curr]
+        _set_asset_consolidated(ac=ac,
+            position=positions.get(asset.pk) or _new_position())
+        _set_asset_market(ac=ac, price=asset.current_price)
+    _bulk_save(model=PortfolioAssetConsolidated,
+        objs=new_ac,
+        changed=ac_d.values(),
+        fields=_ASSET_CONSOLIDATED_FIELDS)
 
-    for currency in currencies:
-        try:
-            pc = get_portfolio_consolidated(portfolio=portfolio, filters={'currency': currency}).get()
-        except exceptions.ObjectDoesNotExist:
+    assets_consolidated = get_assets_consolidated(portfolio=portfolio)
+    totals = assets_consolidated.values('currency').annotate(
+        sum_tc = Sum('total_cost'),
+        sum_tc_nczp = Sum('total_cost_nczp'),
+        sum_div = Sum('total_dividend'),
+        sum_div_nczp = Sum('total_dividend_nczp'),
+        sum_other_cost = Sum('total_other_cost'),
+        sum_other_cost_nczp = Sum('total_other_cost_nczp')
+    ).order_by()
+    pc_d = {pc.currency: pc for pc in get_portfolio_consolidated(portfolio=portfolio)}
+
+    new_pc = []
+    changed_pc = []
+    for qs in totals:
+        if qs['currency'] not in pc_d:
             pc = PortfolioConsolidated()
             pc.portfolio = portfolio
-            pc.currency = currency
-
-        qs = assets_consolidated.filter(currency=currency)
-        qs = qs.aggregate(
-            sum_tc = Sum('total_cost'),
-            sum_tc_nczp = Sum('total_cost_nczp'),
-            sum_div = Sum('total_dividend'),
-            sum_div_nczp = Sum('total_dividend_nczp'),
-            sum_other_cost = Sum('total_other_cost'),
-            sum_other_cost_nczp = Sum('total_other_cost_nczp')
-        )
+            pc.currency = qs['currency']
+            new_pc.append(pc)
+        else:
+            pc = pc_d[qs['currency']]
+            changed_pc.append(pc)
 
         pc.total_cost = qs['sum_tc'] or Decimal(0)
         pc.total_cost_nczp = qs['sum_tc_nczp'] or Decimal(0)
@@ -596,53 +1656,86 @@ def consolidate_portfolio(
         pc.total_dividend_nczp = qs['sum_div_nczp'] or Decimal(0)
         pc.total_other_cost = qs['sum_other_cost'] or Decimal(0)
         pc.total_other_cost_nczp = qs['sum_other_cost_nczp'] or Decimal(0)
-        pc.save()
-
-    transactions = get_transactions(
-        portfolio=portfolio,
-        filters={'consolidated': False})
-    transactions.update(consolidated=True)
+    _bulk_save(model=PortfolioConsolidated,
+        objs=new_pc,
+        changed=changed_pc,
+        fields=_PORTFOLIO_CONSOLIDATED_FIELDS)
+
+    # Only the rows the replay read, the ones committed meanwhile are left
+    # for the next run
+    replayed = sorted(replayed)
+    for i in range(0, len(replayed), TRANSACTION_UPDATE_BATCH):
+        get_transactions(portfolio=portfolio, filters={'consolidated': False,
+            'pk__in': replayed[i:i + TRANSACTION_UPDATE_BATCH]}
+            ).update(consolidated=True)
 
     portfolio.consolidated = True
-    portfolio.save()
+    portfolio.consolidation_version += 1
+    portfolio.last_update = timezone.now()
+    Portfolio.objects.filter(pk=portfolio.pk).update(
+        consolidated=portfolio.consolidated,
+        consolidation_version=portfolio.consolidation_version,
+        last_update=portfolio.last_update)
     return True
 
-def get_results_consolidate(
+def refresh_market_values(
+    *,
+    assets: Iterable[int]
+) -> int:
+    # Run by the price refreshes, so the consolidated rows of every portfolio
+    # holding the assets (pks) are read as they are. Only the rows stored at
+    # another price than the current one are read
+    stale = list(PortfolioAssetConsolidated.objects.filter(
+        asset__pk__in=list(assets)).exclude(
+        market_price=F('asset__current_price')).select_related('asset'))
+    for a in stale:
+        _set_asset_market(ac=a, price=a.asset.current_price)
+    _bulk_save(model=PortfolioAssetConsolidated,
+        objs=[],
+        changed=stale,
+        fields=_ASSET_MARKET_FIELDS)
+    return len(stale)
+
+def check_results_permission(
     *,
     portfolio: Portfolio,
     user: User
-) -> dict:
+) -> None:
     _test_permissions(user=user,
         permission='add_portfolioassetconsolidated',
         object=portfolio)
 
-    portfolio_c = get_portfolio_consolidated(portfolio=portfolio).first()
-    assets_c = get_assets_consolidated(portfolio=portfolio)
-    total_portfolio = 0
-    for a in assets_c:
-        total_portfolio += a.asset.current_price*a.quantity
+def get_results_consolidate(
+    *,
+    portfolio: Portfolio,
+    user: User
+) -> dict:
+    check_results_permission(portfolio=portfolio, user=user)
 
-    results_asset = []
+    # One joined query, the market values are kept current by the price
+    # refreshes
+    assets_c = list(get_assets_consolidated(
+        portfolio=portfolio).select_related('asset'))
 
+    total_portfolio = sum(a.total_current for a in assets_c)
+    results_asset = []
     for a in assets_c:
-        total_asset = a.quantity*a.asset.current_price
-        result_nczp = total_asset - a.total_cost_nczp
-        result = a.total_cost + total_asset
-        total_buy_transactions = get_total_buy_transactions(portfolio=portfolio, filters={'asset':a.asset})
         r = {
             'ticker': a.asset.ticker,
             'quantity': a.quantity,
             'current_price': a.asset.current_price,
             'currency': a.asset.currency,
             'last_update': a.asset.last_update,
+            'avg_p_price_nczp': a.avg_p_price_nczp,
             'total_cost': a.total_cost,
             'total_cost_nczp': a.total_cost_nczp,
-            'total_current': total_asset if a.quantity else 0,
-            'portfolio_percentage': (total_asset/total_portfolio)*100 if a.quantity else 0,
-            'result_currency_nczp': result_nczp if a.quantity else 0,
-            'result_percentage_nczp': (result_nczp/a.total_cost_nczp)*100 if a.quantity else 0,
-            'result_currency': result,
-            'result_percentage': (result/total_buy_transactions)*100 if total_buy_transactions else 0,
+            'total_dividend_nczp': a.total_dividend_nczp,
+            'total_current': a.total_current,
+            'portfolio_percentage': (a.total_current/total_portfolio)*100 if a.quantity and total_portfolio else 0,
+            'result_currency_nczp': a.result_currency_nczp,
+            'result_percentage_nczp': a.result_percentage_nczp,
+            'result_currency': a.result_currency,
+            'result_percentage': a.result_percentage,
         }
         results_asset += [r]
     return results_asset
@@ -651,69 +1744,68 @@ def get_ticker_info(
     *,
     ticker: str
 ) -> dict:
-    symbol = None
-    url = config('SERVICE_ASSET_INFO')+ticker
-    print('URL %s', url)
-    response = requests.get(url, timeout=(5, 14))
-    if response.status_code == 200:
+    # {} when the service does not know the ticker, transport failures
+    # raise QuoteServiceUnavailable
+    data = quotes.get_json(config('SERVICE_ASSET_INFO')+ticker)
+    try:
+        j = data.get('quotes')
+        for quote in j:
+            if ticker in quote.get('symbol'):
+                j = quote
+                break
+        symbol = re.sub(' +', ' ', j.get('symbol'))
+        longname = re.sub(' +', ' ', j.get('longname'))
+        shortname = re.sub(' +', ' ', j.get('shortname'))
+
+        return {
+            'symbol': symbol,
+            'longname': longname,
+            'shortname': shortname,
+        }
+    except (IndexError, AttributeError, TypeError, ValueError):
+        return {}
+
+def get_tickers_info(
+    *,
+    tickers: Iterable[str],
+    max_workers: Optional[int] = None
+) -> dict:
+    # Lookups run in a bounded thread pool, the time taken is the one of the
+    # slowest lookup instead of their sum. A failed lookup gives {}
+    tickers = list(dict.fromkeys(tickers))
+    if not tickers:
+        return {}
+
+    def lookup(ticker):
         try:
-            j = json.loads(response.text)
-            j = j.get('quotes')
-            for quote in j:
-                if ticker in quote.get('symbol'):
-                    j = quote
-                    break
-            symbol = re.sub(' +', ' ', j.get('symbol'))
-            longname = re.sub(' +', ' ', j.get('longname'))
-            shortname = re.sub(' +', ' ', j.get('shortname'))
-
-            return {
-                'symbol': symbol,
-                'longname': longname,
-                'shortname': shortname,
-            }
-        except (IndexError, AttributeError):
-            pass
-    return {}
+            return get_ticker_info(ticker=ticker)
+        except requests.RequestException:
+            return {}
+
+    workers = min(max_workers or settings.ASSET_INFO_WORKERS, len(tickers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(tickers, executor.map(lookup, tickers)))
 
 
 
 def get_current_price(
     *,
-    ticker: str
+    ticker: str,
+    symbol: Optional[str] = None
 ) -> Decimal:
-    symbol = get_ticker_info(ticker=ticker)
-    price = 0
-    symbol = symbol.get('symbol')
-
-    url = config('SERVICE_PRICES_URL')+str(symbol)
-    print('URL %s', url)
-    try:
-        response = requests.get(url, timeout=(5, 14))
-    except requests.exceptions.ConnectionError:
-        return 0
-    print('response %s %s', ticker, response)
-    if response.status_code == 200:
-        try:
-            j = json.loads(response.text)
-            j = j.get('chart')
-            j = j.get('result')
-            j = j[0]
-            j = j.get('meta')
-            price = j.get('regularMarketPrice')
-            currency = j.get('currency')
-        except IndexError:
-            raise exceptions.ObjectDoesNotExist
-        except AttributeError:
-            raise exceptions.ObjectDoesNotExist
-    else:
+    # Only the quote request is made when the symbol is known. An answer
+    # without a price raises ObjectDoesNotExist, transport failures raise
+    # QuoteServiceUnavailable
+    if symbol is None:
+        symbol = get_ticker_info(ticker=ticker).get('symbol')
+    if not symbol:
         raise exceptions.ObjectDoesNotExist
-    return Decimal(price)
+    return _parse_chart_price(quotes.get_json(config('SERVICE_PRICES_URL')+symbol))
 
 def validate_currency(
     *,
     currency: str
 ) -> bool:
-    if currency in CurrencyChoices.choices:
+    if currency in CurrencyChoices.values:
         return True
     return False
@@ -1,25 +1,121 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from portfolio.models import Transaction, Portfolio
+from portfolio.models import Transaction, Portfolio, Asset
+from portfolio.services import (
+    refresh_zeroed_position,
+    schedule_consolidation
+)
+from contextlib import contextmanager
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+def _pending():
+    return getattr(_state, 'pending', None)
+
+def _deleting():
+    if not hasattr(_state, 'deleting'):
+        _state.deleting = set()
+    return _state.deleting
+
+@contextmanager
+def deferred_unconsolidation():
+    # Transaction saves and deletes inside the block only record what they
+    # touched, the dirty marks are written once for all of them at exit.
+    # Nested blocks are flushed by the outermost one
+    if _pending() is not None:
+        yield
+        return
+    _state.pending = {'saved': set(), 'deleted': set(), 'pairs': set()}
+    try:
+        yield
+        pending = _state.pending
+    finally:
+        _state.pending = None
+    _flush(pending)
+
+def _flush(pending):
+    pairs = pending['pairs']
+    if not pairs:
+        return
+    portfolio_ids = {portfolio_id for portfolio_id, _ in pairs}
+    Portfolio.objects.filter(pk__in=portfolio_ids).update(consolidated=False)
+
+    # Saved rows are replayed from themselves, deleted ones from the start of
+    # their asset
+    marks = Q(pk__in=pending['saved'])
+    for portfolio_id, asset_id in pending['deleted']:
+        marks |= Q(portfolio_id=portfolio_id, asset_id=asset_id)
+    Transaction.objects.filter(marks).update(consolidated=False)
+
+    portfolios = Portfolio.objects.in_bulk(portfolio_ids)
+    assets = Asset.objects.in_bulk({asset_id for _, asset_id in pairs})
+    for portfolio_id, asset_id in sorted(pairs):
+        if portfolio_id not in portfolios or asset_id not in assets:
+            continue
+        refresh_zeroed_position(portfolio=portfolios[portfolio_id],
+            asset=assets[asset_id])
+    for portfolio_id in sorted(portfolio_ids):
+        schedule_consolidation(portfolio_id=portfolio_id)
+    logger.debug('Unconsolidated %d assets of %d portfolios',
+        len(pairs), len(portfolio_ids))
+
+@receiver(pre_delete, sender=Portfolio)
+def portfolio_deleting(sender, instance, **kwargs):
+    # Its transactions go with it, nothing has to be kept up to date. The
+    # cascade does not always delete them before the portfolio row
+    _deleting().add(instance.pk)
+
+@receiver(post_delete, sender=Portfolio)
+def portfolio_deleted(sender, instance, **kwargs):
+    _deleting().discard(instance.pk)
 
 @receiver(post_save, sender=Transaction)
 def set_unconsolidated(sender, **kwargs):
     transaction = kwargs['instance']
-    portfolio = Portfolio.objects.filter(pk=transaction.portfolio.pk)
-    portfolio.update(consolidated = False)
+    if transaction.portfolio_id is None:
+        return
+    pending = _pending()
+    if pending is not None:
+        pending['saved'].add(transaction.pk)
+        pending['pairs'].add((transaction.portfolio_id, transaction.asset_id))
+        return
 
-    Transaction.objects.filter(pk=transaction.pk).update(consolidated = False)
-    print("Request Transaction finished!")
+    Portfolio.objects.filter(pk=transaction.portfolio_id).update(
+        consolidated=False)
+    Transaction.objects.filter(pk=transaction.pk).update(consolidated=False)
+    refresh_zeroed_position(portfolio=transaction.portfolio,
+        asset=transaction.asset,
+        inserted=transaction if kwargs.get('created') else None)
+    schedule_consolidation(portfolio_id=transaction.portfolio_id)
+    logger.debug('Transaction %s saved', transaction.pk)
 
 @receiver(post_delete, sender=Transaction)
-def set_unconsolidated(sender, **kwargs):
+def set_unconsolidated_delete(sender, **kwargs):
     transaction = kwargs['instance']
-    portfolio = Portfolio.objects.filter(pk=transaction.portfolio.pk)
-    portfolio.update(consolidated = False)
-
-    t = Transaction.objects.filter(
-            portfolio__pk=transaction.portfolio.pk,
-            asset__pk=transaction.asset.pk
-        ).update(consolidated = False)
-    print('transaction %s', t)
-    print("Delete Transaction finished!")
+    if (transaction.portfolio_id is None or
+            transaction.portfolio_id in _deleting()):
+        return
+    pending = _pending()
+    if pending is not None:
+        pending['deleted'].add((transaction.portfolio_id, transaction.asset_id))
+        pending['pairs'].add((transaction.portfolio_id, transaction.asset_id))
+        return
+
+    if not Portfolio.objects.filter(pk=transaction.portfolio_id).update(
+            consolidated=False):
+        # Deleted together with its portfolio
+        return
+    count = Transaction.objects.filter(
+            portfolio_id=transaction.portfolio_id,
+            asset_id=transaction.asset_id
+        ).update(consolidated=False)
+    refresh_zeroed_position(portfolio=transaction.portfolio,
+        asset=transaction.asset)
+    schedule_consolidation(portfolio_id=transaction.portfolio_id)
+    logger.debug('Transaction %s deleted, %d transactions unconsolidated',
+        transaction.pk, count)
@@ -9,10 +9,52 @@ def add(x, y):
 def refresh_current_price(ticker):
     app.send_task('refresh_current_price', args=[ticker])
 
-def refresh_assets_prices():
+@app.task(name='consolidate_portfolio')
+def consolidate_scheduled_portfolio(portfolio_id, full=False):
+    from portfolio.services import (
+        consolidate_scheduled_portfolio as consolidate,
+        consolidate_debounced_portfolio
+    )
+    if full:
+        return consolidate(portfolio_id=portfolio_id, full=True)
+    return consolidate_debounced_portfolio(portfolio_id=portfolio_id)
+
+@app.task(name='consolidation_summary')
+def consolidation_summary(results):
+    return {'portfolios': len(results), 'consolidated': sum(map(bool, results))}
+
+# acks_late with reject_on_worker_lost puts the job back in the queue when
+# the worker dies, it resumes from the last committed chunk
+@app.task(name='run_import_job', acks_late=True, reject_on_worker_lost=True)
+def process_import_job(job_id):
+    from portfolio.services import run_import_job as run
+    return run(job_id=job_id).status
+
+def run_import_job(job_id):
+    app.send_task('run_import_job', args=[job_id])
+
+@app.task(name='enrich_assets')
+def enrich_placeholder_assets():
+    from portfolio.services import enrich_assets as enrich
+    return enrich()
+
+def enrich_assets(countdown=0):
+    app.send_task('enrich_assets', countdown=countdown)
+
+def consolidate_portfolio(portfolio_id, countdown=0):
+    app.send_task('consolidate_portfolio', args=[portfolio_id],
+        countdown=countdown)
+
+@app.task(name='refresh_current_price')
+def refresh_ticker_price(ticker):
     from portfolio.services import refresh_current_price as refresh_price
-    from portfolio.selectors import get_assets_types, get_active_assets
-    for t in get_assets_types():
-        assets = get_active_assets(type_investment=t)
-        for asset in assets:
-            app.send_task('refresh_current_price', args=[asset.ticker])
+    return refresh_price(ticker=ticker)
+
+# Named after the module path, the beat schedule sends it under that name
+@app.task(name='portfolio.tasks.refresh_assets_prices')
+def refresh_assets_prices(tickers=None):
+    from portfolio.services import refresh_prices
+    return refresh_prices(tickers=tickers)
+
+def refresh_all_prices(tickers=None):
+    app.send_task('portfolio.tasks.refresh_assets_prices', args=[tickers])
@@ -0,0 +1,56 @@
+from django.test import TestCase
+from django.utils import timezone
+from portfolio.models import Transaction
+from portfolio.tests.utils import TestUtils
+from decimal import Decimal
+import re
+
+class TransactionAdminTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.stock = self.util.get_standard_asset(ticker='ITSA4', type_investment='STOCK')
+        date = timezone.now() - timezone.timedelta(days=200)
+        # Pairs of rows share a date so the id breaks the ties
+        Transaction.objects.bulk_create([Transaction(
+            portfolio=self.portfolio,
+            type_transaction='B',
+            transaction_date=date + timezone.timedelta(days=i // 2),
+            type_investment=self.stock.type_investment,
+            asset=self.stock,
+            quantity=Decimal('1'),
+            unit_cost=Decimal('10')) for i in range(150)])
+        self.client.force_login(self.user)
+
+    def _page(self, url):
+        content = self.client.get(url).content.decode()
+        ids = [int(pk) for pk in re.findall(
+            r'name="_selected_action" value="(\d+)"', content)]
+        next_url = re.search(r'href="(\?[^"]*after=[^"]*)">Next', content)
+        return ids, next_url and next_url.group(1).replace('&amp;', '&')
+
+    def test_keyset_pages(self):
+        url = '/admin/portfolio/stocktransaction/'
+        first, next_url = self._page(url)
+        second, last_url = self._page(url + next_url)
+
+        expected = list(Transaction.objects.order_by(
+            '-transaction_date', '-id').values_list('pk', flat=True))
+        self.assertEqual(first + second, expected)
+        self.assertIsNone(last_url)
+
+    def test_ticker_search(self):
+        ids, _ = self._page('/admin/portfolio/stocktransaction/?q=itsa4')
+        self.assertEqual(len(ids), 100)
+        # Not a ticker, matched by the search fields
+        Transaction.objects.filter(pk=Transaction.objects.order_by(
+            '-transaction_date', '-id')[0].pk).update(desc_1='Dividend')
+        ids, _ = self._page('/admin/portfolio/stocktransaction/?q=divid')
+        self.assertEqual(len(ids), 1)
+        ids, _ = self._page('/admin/portfolio/stocktransaction/?q=XPTO3')
+        self.assertEqual(ids, [])
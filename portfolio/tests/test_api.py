@@ -0,0 +1,110 @@
+from django.test import TestCase
+from rest_framework.test import APIClient
+from django.contrib.auth.models import Permission, User
+from portfolio.models import PortfolioAssetConsolidated, ImportJob
+from portfolio.constants import ImportJobKind
+from portfolio.services import _set_asset_market
+from portfolio.tests.utils import TestUtils
+from decimal import Decimal
+
+class PortfolioAPITestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.permission = Permission.objects.get(
+            codename='add_portfolioassetconsolidated')
+        self.user.user_permissions.add(self.permission)
+        for i in range(3):
+            asset = self.util.get_standard_asset(ticker='ITSA%s' % i,
+                type_investment='STOCK')
+            asset.current_price = Decimal('10')
+            asset.save()
+            ac = PortfolioAssetConsolidated(portfolio=self.portfolio,
+                asset=asset, quantity=Decimal(i + 1),
+                total_cost=Decimal('-5'), total_buy=Decimal('5'))
+            _set_asset_market(ac=ac, price=asset.current_price)
+            ac.save()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_positions_keyset_pagination(self):
+        url = '/api/portfolios/%s/positions/' % self.portfolio.pk
+        response = self.client.get(url, {'page_size': 2, 'fields': 'ticker,quantity'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [
+            {'ticker': 'ITSA0', 'quantity': '1.00000'},
+            {'ticker': 'ITSA1', 'quantity': '2.00000'},
+        ])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([r['ticker'] for r in response.data['results']], ['ITSA2'])
+        self.assertIsNone(response.data['next'])
+
+    def test_results(self):
+        url = '/api/portfolios/%s/results/' % self.portfolio.pk
+        response = self.client.get(url, {'fields': 'ticker,portfolio_percentage,result_currency'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][2], {
+            'ticker': 'ITSA2',
+            'portfolio_percentage': '50.00',
+            'result_currency': '25.00',
+        })
+
+    def test_results_permission(self):
+        self.user.user_permissions.remove(self.permission)
+        self.user = User.objects.get(pk=self.user.pk)
+        self.client.force_authenticate(user=self.user)
+        for path in ('positions', 'results'):
+            response = self.client.get('/api/portfolios/%s/%s/' % (
+                self.portfolio.pk, path))
+            self.assertEqual(response.status_code, 403)
+
+    def test_unknown_field(self):
+        url = '/api/portfolios/%s/positions/' % self.portfolio.pk
+        response = self.client.get(url, {'fields': 'ticker,owner'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get(self):
+        url = '/api/portfolios/%s/' % self.portfolio.pk
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], self.portfolio.name)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_other_owner(self):
+        other = self.util.get_standard_user()
+        other.pk = None
+        other.username = 'other'
+        other.save()
+        self.client.force_authenticate(user=other)
+        response = self.client.get('/api/portfolios/%s/' % self.portfolio.pk)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/portfolios/')
+        self.assertEqual(response.data['results'], [])
+
+
+class ImportJobAPITestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.job = ImportJob.objects.create(owner=self.user,
+            kind=ImportJobKind.ASSETS, file='imports/a.csv',
+            total_rows=8, processed_rows=2, error_count=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_import_job_progress(self):
+        response = self.client.get('/api/import-jobs/%s/' % self.job.pk,
+            {'fields': 'status,progress,error_count'})
+        self.assertEqual(response.data,
+            {'status': 'P', 'progress': 25.0, 'error_count': 1})
+
+        other = User.objects.create(username='other')
+        self.client.force_authenticate(user=other)
+        response = self.client.get('/api/import-jobs/%s/' % self.job.pk)
+        self.assertEqual(response.status_code, 404)
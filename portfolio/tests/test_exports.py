@@ -0,0 +1,51 @@
+from django.core import exceptions
+from django.test import TestCase
+from django.utils import timezone
+from portfolio.exports import (
+    TRANSACTION_FIELDS,
+    get_export_filters,
+    stream_export
+)
+from portfolio.models import Transaction
+from portfolio.tests.utils import TestUtils
+from decimal import Decimal
+import datetime
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.stock = self.util.get_standard_asset(ticker='ITSA4', type_investment='STOCK')
+        for day, type_transaction in ((1, 'B'), (2, 'B'), (3, 'S')):
+            Transaction.objects.create(
+                portfolio=self.portfolio,
+                type_transaction=type_transaction,
+                transaction_date=timezone.make_aware(datetime.datetime(2020, 1, day, 12)),
+                type_investment=self.stock.type_investment,
+                asset=self.stock,
+                quantity=Decimal('10'),
+                unit_cost=Decimal('10'))
+
+    def test_export_filters(self):
+        filters = get_export_filters(asset='ITSA4', date_from='2020-01-02',
+            date_to='2020-01-02', type_transaction='B')
+        self.assertEqual(Transaction.objects.filter(**filters).count(), 1)
+
+        with self.assertRaises(exceptions.ValidationError):
+            get_export_filters(date_to='2020-02-30')
+        with self.assertRaises(exceptions.ValidationError):
+            get_export_filters(type_transaction='X')
+
+    def test_stream_export(self):
+        lines = list(stream_export(queryset=Transaction.objects.all(),
+            fields=TRANSACTION_FIELDS, format='csv', chunk_size=1))
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('id;portfolio;ticker;'))
+        self.assertIn(';ITSA4;S;', lines[3])
+
+        lines = list(stream_export(queryset=Transaction.objects.all(),
+            fields=TRANSACTION_FIELDS, format='jsonl'))
+        self.assertEqual(len(lines), 3)
+        self.assertIn('"quantity": "10.00000"', lines[0])
@@ -0,0 +1,211 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from portfolio import quotes
+from unittest import mock
+import requests, threading, time
+
+@override_settings(QUOTE_SERVICE_RETRIES=2, QUOTE_SERVICE_BACKOFF=0.5,
+    QUOTE_CIRCUIT_FAILURES=5, QUOTE_RATE_LIMIT=0)
+class QuoteClientTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.session = mock.Mock()
+        patches = [
+            mock.patch('portfolio.quotes.get_session', return_value=self.session),
+            mock.patch('portfolio.quotes.time.sleep'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _response(self, status_code, body=None):
+        response = mock.Mock(status_code=status_code)
+        if body is None:
+            response.json.side_effect = ValueError
+        else:
+            response.json.return_value = body
+        return response
+
+    def test_retries(self):
+        self.session.get.side_effect = [requests.ConnectionError(),
+            self._response(503), self._response(200, {'a': 1})]
+        self.assertEqual(quotes.get_json('https://quotes/a'), {'a': 1})
+        self.assertEqual(self.session.get.call_count, 3)
+        self.assertEqual(quotes.time.sleep.call_count, 2)
+        # Jittered, at most the exponential backoff
+        first, second = [c[0][0] for c in quotes.time.sleep.call_args_list]
+        self.assertTrue(0 <= first <= 0.5 and 0 <= second <= 1)
+
+    def test_unavailable(self):
+        self.session.get.side_effect = requests.Timeout()
+        with self.assertRaises(quotes.QuoteServiceUnavailable):
+            quotes.get_json('https://quotes/a')
+        self.assertEqual(self.session.get.call_count, 3)
+        # Still a RequestException for the callers that catch those
+        self.assertTrue(issubclass(quotes.QuoteServiceUnavailable,
+            requests.RequestException))
+
+    def test_not_found(self):
+        self.session.get.side_effect = [self._response(404),
+            self._response(200)]
+        self.assertIsNone(quotes.get_json('https://quotes/a'))
+        self.assertIsNone(quotes.get_json('https://quotes/a'))
+        self.assertEqual(self.session.get.call_count, 2)
+
+    @override_settings(QUOTE_CIRCUIT_RESET=30)
+    def test_circuit_breaker(self):
+        self.session.get.side_effect = requests.Timeout()
+        for i in range(2):
+            with self.assertRaises(quotes.QuoteServiceUnavailable):
+                quotes.get_json('https://quotes/a')
+        # Opened by the fifth failure, the retry after it fails fast
+        self.assertEqual(self.session.get.call_count, 5)
+        with self.assertRaises(quotes.QuoteServiceCircuitOpen):
+            quotes.get_json('https://quotes/b')
+        self.assertEqual(self.session.get.call_count, 5)
+        # Other hosts have their own circuit
+        self.session.get.side_effect = None
+        self.session.get.return_value = self._response(200, {'a': 1})
+        self.assertEqual(quotes.get_json('https://other/a'), {'a': 1})
+
+        # Half open after the reset, a failed probe opens it again
+        later = time.time() + 31
+        with mock.patch('portfolio.quotes._clock', return_value=later):
+            self.session.get.side_effect = requests.Timeout()
+            with self.assertRaises(quotes.QuoteServiceCircuitOpen):
+                quotes.get_json('https://quotes/a')
+            self.assertEqual(self.session.get.call_count, 7)
+            with self.assertRaises(quotes.QuoteServiceCircuitOpen):
+                quotes.check_circuit('https://quotes/a')
+
+        with mock.patch('portfolio.quotes._clock', return_value=later + 31):
+            self.session.get.side_effect = None
+            self.assertEqual(quotes.get_json('https://quotes/a'), {'a': 1})
+            # Closed by the probe
+            self.assertEqual(quotes.get_json('https://quotes/a'), {'a': 1})
+            quotes.check_circuit('https://quotes/a')
+
+    def test_single_probe(self):
+        circuit = quotes.CircuitBreaker('quotes')
+        circuit._open()
+        with mock.patch('portfolio.quotes._clock', return_value=time.time() + 31):
+            self.assertTrue(circuit.before())
+            with self.assertRaises(quotes.QuoteServiceCircuitOpen):
+                circuit.before()
+
+
+class QuoteRateLimitTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patches = [
+            mock.patch('portfolio.quotes._clock', side_effect=lambda: self.now),
+            mock.patch('portfolio.quotes.time.sleep', side_effect=self._sleep),
+            mock.patch('portfolio.quotes._bucket', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _sleep(self, seconds):
+        self.now += seconds
+
+    @override_settings(QUOTE_RATE_LIMIT=2, QUOTE_RATE_BURST=2,
+        QUOTE_RATE_MAX_WAIT=10)
+    def test_acquire(self):
+        self.assertIsInstance(quotes.get_bucket(), quotes.LocalTokenBucket)
+        for i in range(4):
+            quotes._acquire()
+        # The burst right away, then one token every half second
+        self.assertEqual(quotes.time.sleep.call_count, 2)
+        self.assertAlmostEqual(self.now, 1001.0)
+
+    @override_settings(QUOTE_RATE_LIMIT=0.05, QUOTE_RATE_BURST=1,
+        QUOTE_RATE_MAX_WAIT=10)
+    def test_throttled(self):
+        quotes._acquire()
+        with self.assertRaises(quotes.QuoteServiceThrottled):
+            quotes._acquire()
+        quotes.time.sleep.assert_not_called()
+
+    @override_settings(QUOTE_RATE_LIMIT=0)
+    def test_disabled(self):
+        self.assertIsNone(quotes.get_bucket())
+        quotes._acquire()
+
+
+class QuoteSessionTestCase(SimpleTestCase):
+
+    @override_settings(QUOTE_SERVICE_POOL_SIZE=32)
+    def test_session_per_process(self):
+        with mock.patch('portfolio.quotes._session', None):
+            session = quotes.get_session()
+            self.assertIs(quotes.get_session(), session)
+            adapter = session.get_adapter('https://query1.finance.yahoo.com')
+            self.assertEqual(adapter._pool_maxsize, 32)
+
+            with mock.patch('portfolio.quotes.os.getpid', return_value=-1):
+                self.assertIsNot(quotes.get_session(), session)
+
+
+class QuoteConcurrencyTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.barrier = None
+
+    def _get_json(self, url):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            if self.barrier is not None:
+                self.barrier.wait()
+            else:
+                time.sleep(0.01)
+            if url.endswith('fail'):
+                raise quotes.QuoteServiceUnavailable(url)
+            return {'url': url}
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def test_get_json_many(self):
+        # Every call waits for the others, they only finish if they run at
+        # the same time
+        self.barrier = threading.Barrier(4, timeout=5)
+        urls = ['https://a/1', 'https://a/2', 'https://b/3', 'https://b/fail']
+        with mock.patch('portfolio.quotes.get_json', side_effect=self._get_json):
+            results = quotes.get_json_many(urls, concurrency=4, per_host=2)
+        self.assertEqual(results, [{'url': 'https://a/1'},
+            {'url': 'https://a/2'}, {'url': 'https://b/3'}, None])
+
+    @override_settings(QUOTE_SERVICE_RETRIES=1)
+    def test_throttled_retried(self):
+        calls = []
+
+        def get_json(url):
+            calls.append(url)
+            if url.endswith('busy') and calls.count(url) == 1 or \
+                    url.endswith('full'):
+                raise quotes.QuoteServiceThrottled(url)
+            return {'url': url}
+
+        urls = ['https://a/1', 'https://a/busy', 'https://a/full']
+        with mock.patch('portfolio.quotes.get_json', side_effect=get_json), \
+                self.assertLogs('portfolio.quotes', 'WARNING') as logs:
+            results = quotes.get_json_many(urls)
+        self.assertEqual(results, [{'url': 'https://a/1'},
+            {'url': 'https://a/busy'}, None])
+        self.assertEqual(len(calls), 5)
+        self.assertIn('1 quote requests throttled, skipped', logs.output[0])
+
+    def test_per_host_limit(self):
+        urls = ['https://a/%s' % i for i in range(20)]
+        with mock.patch('portfolio.quotes.get_json', side_effect=self._get_json):
+            quotes.get_json_many(urls, concurrency=10, per_host=3)
+        self.assertLessEqual(self.peak, 3)
@@ -8,8 +8,12 @@ from portfolio.selectors import (
     get_transactions,
     get_fii_transactions,
     get_stock_transactions,
-    get_transactions_asset
+    get_transactions_asset,
+    get_assets_totals,
+    get_portfolios_total_value,
+    get_last_zeroed_transaction
 )
+from portfolio.models import Transaction, Portfolio, PortfolioAssetConsolidated
 from portfolio.tests.utils import TestUtils
 
 class AssetSelectorsTestCase(TestCase):
@@ -42,3 +46,124 @@ class AssetSelectorsTestCase(TestCase):
         })
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].ticker, self.fii.ticker)
+
+class TransactionSelectorsTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.stock = self.util.get_standard_asset(
+            ticker='ITSA4',
+            type_investment='STOCK'
+        )
+        self.fii = self.util.get_standard_asset(
+            ticker='HGLG11',
+            type_investment='FII'
+        )
+        self.portfolio = self.util.get_standard_portfolio(
+            user=self.util.get_standard_user())
+        for asset, type_transaction, quantity, unit_cost in (
+                (self.stock, 'B', '10', '10'),
+                (self.stock, 'S', '4', '12'),
+                (self.fii, 'B', '2', '100'),
+                (self.fii, 'Div', '2', '0.8')):
+            Transaction.objects.create(
+                portfolio=self.portfolio,
+                type_transaction=type_transaction,
+                transaction_date=timezone.now(),
+                type_investment=asset.type_investment,
+                asset=asset,
+                quantity=Decimal(quantity),
+                unit_cost=Decimal(unit_cost),
+                other_costs=Decimal('0.5'))
+
+    def test_get_assets_totals(self):
+        totals = get_assets_totals(portfolio=self.portfolio)
+        self.assertEqual(len(totals), 2)
+        self.assertEqual(totals[self.stock.pk]['quantity'], Decimal('6'))
+        self.assertEqual(totals[self.stock.pk]['total_cost'], Decimal('-53'))
+        self.assertEqual(totals[self.stock.pk]['total_buy'], Decimal('99.5'))
+        self.assertEqual(totals[self.stock.pk]['total_sell'], Decimal('47.5'))
+        self.assertEqual(totals[self.stock.pk]['total_other_cost'], Decimal('1'))
+        self.assertEqual(totals[self.fii.pk]['total_dividend'], Decimal('1.1'))
+
+    def test_get_assets_totals_filtered(self):
+        totals = get_assets_totals(portfolio=self.portfolio,
+            assets=[self.fii])
+        self.assertEqual(list(totals), [self.fii.pk])
+        self.assertEqual(totals[self.fii.pk]['quantity'], Decimal('2'))
+
+class ZeroedTransactionSelectorsTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.stock = self.util.get_standard_asset(
+            ticker='ITSA4',
+            type_investment='STOCK'
+        )
+        self.portfolio = self.util.get_standard_portfolio(
+            user=self.util.get_standard_user())
+        self.date = timezone.now() - timezone.timedelta(days=30)
+
+    def _create(self, type_transaction, quantity, days):
+        return Transaction.objects.create(
+            portfolio=self.portfolio,
+            type_transaction=type_transaction,
+            transaction_date=self.date + timezone.timedelta(days=days),
+            type_investment=self.stock.type_investment,
+            asset=self.stock,
+            quantity=Decimal(quantity),
+            unit_cost=Decimal('10'),
+            other_costs=Decimal('0'))
+
+    def _zeroed(self):
+        return get_last_zeroed_transaction(portfolio=self.portfolio,
+            asset=self.stock)
+
+    def test_never_zeroed(self):
+        self.assertIsNone(self._zeroed())
+        self._create('B', '10', 0)
+        self._create('S', '4', 1)
+        self._create('Div', '6', 2)
+        self.assertIsNone(self._zeroed())
+
+    def test_multiple_zeroings(self):
+        self._create('B', '10', 0)
+        self._create('S', '10', 1)
+        self._create('B', '5', 2)
+        last = self._create('S', '5', 3)
+        self._create('B', '3', 4)
+        self.assertEqual(self._zeroed()['pk'], last.pk)
+
+    def test_same_day_ties(self):
+        self._create('B', '10', 0)
+        # Zeroed in the middle of the day but not at its end
+        self._create('S', '10', 1)
+        self._create('B', '5', 1)
+        self.assertIsNone(self._zeroed())
+
+        # Every row of the day has the day's quantity, the last one is taken
+        self._create('B', '5', 2)
+        last = self._create('S', '10', 2)
+        self.assertEqual(self._zeroed()['pk'], last.pk)
+
+class PortfolioSelectorsTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.empty = Portfolio.objects.create(owner=self.user, name='empty')
+        for ticker, quantity, price in (('ITSA4', '10', '9.5'), ('HGLG11', '2', '150')):
+            asset = self.util.get_standard_asset(ticker=ticker, type_investment='STOCK')
+            asset.current_price = Decimal(price)
+            asset.save()
+            PortfolioAssetConsolidated.objects.create(portfolio=self.portfolio,
+                asset=asset, quantity=Decimal(quantity))
+
+    def test_get_portfolios_total_value(self):
+        with self.assertNumQueries(1):
+            totals = {p.pk: p.total_value
+                for p in get_portfolios_total_value(fetched_by=self.user)}
+        self.assertEqual(totals[self.portfolio.pk], Decimal('395'))
+        self.assertEqual(totals[self.empty.pk], Decimal('0'))
+
@@ -1,13 +1,27 @@
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Permission, User
 from portfolio.models import (
-    Portfolio
+    Portfolio,
+    Transaction,
+    Asset,
+    PortfolioAssetConsolidated,
+    PortfolioAssetZeroedPosition,
+    ImportJob
 )
-from django.test import TestCase
+from portfolio.constants import ImportJobKind, ImportJobStatus
+from django.test import (
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+    skipUnlessDBFeature
+)
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from portfolio.services import (
     create_portfolio,
     create_asset,
     get_or_create_asset_type,
+    create_transaction,
     create_fii_transaction,
     create_stock_transaction,
     get_qty_asset,
@@ -16,12 +30,38 @@ from portfolio.services import (
     get_avg_purchase_price,
     get_avg_sale_price,
     get_total_cost_portfolio,
+    _replay_transactions,
+    _set_asset_consolidated,
+    _set_asset_market,
+    get_results_consolidate,
+    get_portfolio_detail_cache_key,
+    schedule_consolidation,
+    consolidate_debounced_portfolio,
+    consolidate_scheduled_portfolio,
+    create_import_job,
+    run_import_job,
+    resume_import_job,
+    import_assets,
+    enrich_assets,
+    get_tickers_info,
+    refresh_current_price,
+    refresh_asset_info,
+    refresh_prices,
+    refresh_market_values,
     #get_percentage_portfolio
 )
 from portfolio.tests.utils import TestUtils
+from portfolio import quotes
 from django.utils import timezone
+from django.urls import reverse
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.functions import Concat
 from django.core import serializers, exceptions
+from django.core.files.base import ContentFile
 from decimal import Decimal
+from unittest import mock
+import tempfile, threading, requests, os
 
 
 class PortfolioServicesTestCase(TestCase):
@@ -51,7 +91,9 @@ class PortfolioServicesTestCase(TestCase):
         portfolio = self.util.get_standard_portfolio(user=self.user)
 
         data = portfolio.__dict__
-        for key in ['created_at', 'last_update', '_state', 'owner_id', 'consolidated']:
+        for key in ['created_at', 'last_update', '_state', 'owner_id', 'consolidated',
+                'consolidation_version', 'consolidation_scheduled_at',
+                'consolidation_due_at']:
             del data[key]
         data['owner'] = self.user
         data['name'] = 'New Name'
@@ -120,7 +162,8 @@ class AssetServicesTestCase(TestCase):
 
         data = asset.__dict__
         data['type_investment'] = self.util.get_standard_asset_type(name='STOCK')
-        for key in ['created_at', 'last_update', '_state', 'type_investment_id']:
+        for key in ['created_at', 'last_update', '_state', 'type_investment_id',
+                'symbol', 'info_updated_at']:
             del data[key]
 
         data['type_investment'] = self.util.get_standard_asset_type(name='FII')
@@ -152,7 +195,8 @@ class AssetServicesTestCase(TestCase):
 
         data = asset.__dict__
         data['type_investment'] = self.util.get_standard_asset_type(name='STOCK')
-        for key in ['created_at', 'last_update', '_state', 'type_investment_id']:
+        for key in ['created_at', 'last_update', '_state', 'type_investment_id',
+                'symbol', 'info_updated_at']:
             del data[key]
 
         data['ticker'] = 'XXXX4'
@@ -474,3 +518,894 @@ class TransactionServicesTestCase(TestCase):
             with self.subTest(i=key):
                 with self.assertRaises(TypeError):
                     transaction = create_fii_transaction(**options.get(key))
+
+class ConsolidationReplayTestCase(TestCase):
+
+    def setUp(self):
+        self.d1 = timezone.now() - timezone.timedelta(days=30)
+        self.d2 = self.d1 + timezone.timedelta(days=10)
+        self.d3 = self.d2 + timezone.timedelta(days=10)
+
+    def test_replay_without_zeroed_position(self):
+        rows = [
+            (1, 1, 'B', self.d1, Decimal('10'), Decimal('10'), Decimal('1')),
+            (1, 2, 'B', self.d2, Decimal('10'), Decimal('20'), Decimal('1')),
+            (1, 3, 'Div', self.d2, Decimal('20'), Decimal('0.5'), Decimal('0')),
+            (1, 4, 'S', self.d3, Decimal('5'), Decimal('30'), Decimal('1')),
+        ]
+        positions = _replay_transactions(transactions=rows)
+        ac = _set_asset_consolidated(ac=PortfolioAssetConsolidated(),
+            position=positions[1])
+
+        self.assertEqual(ac.quantity, Decimal('15'))
+        self.assertEqual(ac.avg_p_price, Decimal('15.1'))
+        self.assertEqual(ac.avg_p_price_nczp, Decimal('15.1'))
+        self.assertEqual(ac.avg_s_price, Decimal('29.8'))
+        self.assertEqual(ac.total_cost, Decimal('149') - Decimal('302'))
+        self.assertEqual(ac.total_dividend, Decimal('10'))
+        self.assertEqual(ac.total_other_cost, Decimal('3'))
+        self.assertIsNone(positions[1]['zeroed_date'])
+
+    def test_replay_with_zeroed_position(self):
+        rows = [
+            (1, 5, 'B', self.d1, Decimal('10'), Decimal('10'), Decimal('0')),
+            (1, 6, 'Div', self.d1, Decimal('10'), Decimal('1'), Decimal('0')),
+            (1, 7, 'S', self.d2, Decimal('10'), Decimal('12'), Decimal('0')),
+            (1, 8, 'B', self.d3, Decimal('4'), Decimal('11'), Decimal('0.4')),
+            (2, 9, 'B', self.d1, Decimal('1'), Decimal('5'), Decimal('0')),
+        ]
+        positions = _replay_transactions(transactions=rows)
+        ac = _set_asset_consolidated(ac=PortfolioAssetConsolidated(),
+            position=positions[1])
+
+        self.assertEqual(positions[1]['zeroed_date'], self.d2)
+        self.assertEqual(ac.quantity, Decimal('4'))
+        self.assertEqual(ac.avg_p_price, Decimal('144.4')/Decimal('14'))
+        self.assertEqual(ac.avg_p_price_nczp, Decimal('11.1'))
+        self.assertEqual(ac.avg_s_price_nczp, Decimal(0))
+        self.assertEqual(ac.total_cost_nczp, Decimal('44.4'))
+        self.assertEqual(ac.total_dividend, Decimal('10'))
+        self.assertEqual(ac.total_dividend_nczp, Decimal(0))
+        self.assertEqual(ac.total_other_cost_nczp, Decimal('0.4'))
+        self.assertEqual(positions[2]['buy_quantity'], Decimal('1'))
+
+    def test_replay_delta_matches_full_replay(self):
+        rows = [
+            (1, 1, 'B', self.d1, Decimal('10'), Decimal('10'), Decimal('0')),
+            (1, 2, 'S', self.d2, Decimal('10'), Decimal('12'), Decimal('0')),
+            (1, 3, 'B', self.d3, Decimal('4'), Decimal('11'), Decimal('0.4')),
+            (1, 4, 'Div', self.d3 + timezone.timedelta(days=1),
+                Decimal('4'), Decimal('0.5'), Decimal('0')),
+        ]
+        full = _replay_transactions(transactions=rows)
+        partial = _replay_transactions(transactions=rows[:2])
+        delta = _replay_transactions(transactions=rows[2:],
+            positions=partial)
+
+        self.assertEqual(full, delta)
+        self.assertEqual(delta[1]['last_transaction_pk'], 4)
+        self.assertEqual(delta[1]['zeroed_date'], self.d2)
+
+class ZeroedPositionServicesTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.stock = self.util.get_standard_asset(ticker='ITSA4', type_investment='STOCK')
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.date = timezone.now() - timezone.timedelta(days=30)
+
+    def _transaction(self, type_transaction, days, quantity):
+        return Transaction.objects.create(
+            portfolio=self.portfolio,
+            type_transaction=type_transaction,
+            transaction_date=self.date + timezone.timedelta(days=days),
+            type_investment=self.stock.type_investment,
+            asset=self.stock,
+            quantity=Decimal(quantity),
+            unit_cost=Decimal('10'))
+
+    def _position(self):
+        return PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio, asset=self.stock)
+
+    def test_zeroed_position_maintained_on_write(self):
+        self._transaction('B', 0, '10')
+        sell = self._transaction('S', 1, '10')
+        self.assertEqual(self._position().zeroed_date, sell.transaction_date)
+        self.assertEqual(self._position().zeroed_transaction_id, sell.pk)
+
+        self._transaction('B', 2, '5')
+        self.assertEqual(self._position().quantity, Decimal('5'))
+        self.assertEqual(self._position().zeroed_transaction_id, sell.pk)
+
+        #Back-dated insert rebuilds the index
+        self._transaction('B', -1, '1')
+        self.assertIsNone(self._position().zeroed_date)
+        self.assertEqual(self._position().quantity, Decimal('6'))
+
+    def test_zeroed_position_after_delete(self):
+        self._transaction('B', 0, '10')
+        sell = self._transaction('S', 1, '10')
+        sell.delete()
+        self.assertIsNone(self._position().zeroed_date)
+        self.assertEqual(self._position().quantity, Decimal('10'))
+
+class ResultsConsolidateTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        content_type = ContentType.objects.get_for_model(PortfolioAssetConsolidated)
+        permission = Permission.objects.get(
+            codename='add_portfolioassetconsolidated',
+            content_type=content_type,
+        )
+        self.user.user_permissions.add(permission)
+        self.user.refresh_from_db()
+        date = timezone.now() - timezone.timedelta(days=30)
+        for i in range(3):
+            asset = self.util.get_standard_asset(ticker='ITSA%s' % i,
+                type_investment='STOCK')
+            rows = [
+                (asset.pk, 1, 'B', date, Decimal('10'), Decimal('10'), Decimal('1')),
+                (asset.pk, 2, 'B', date + timezone.timedelta(days=1),
+                    Decimal('10'), Decimal('20'), Decimal('1')),
+            ]
+            ac = PortfolioAssetConsolidated(portfolio=self.portfolio,
+                asset=asset)
+            _set_asset_consolidated(ac=ac,
+                position=_replay_transactions(transactions=rows)[asset.pk])
+            _set_asset_market(ac=ac, price=asset.current_price)
+            ac.save()
+
+    def test_results_consolidate(self):
+        Asset.objects.filter(ticker='ITSA0').update(current_price=Decimal('25'))
+        # Done by the price refresh, reading the results writes nothing
+        self.assertEqual(refresh_market_values(
+            assets=Asset.objects.values_list('pk', flat=True)), 1)
+
+        results = get_results_consolidate(portfolio=self.portfolio,
+            user=self.user)
+        r = {r['ticker']: r for r in results}['ITSA0']
+        self.assertEqual(r['total_current'], Decimal('500'))
+        self.assertEqual(r['result_currency'], Decimal('198'))
+        self.assertEqual(r['result_currency_nczp'], Decimal('198'))
+        # Read back from the stored row, two decimal places
+        self.assertEqual(r['result_percentage'],
+            round(Decimal('198')/Decimal('298')*100, 2))
+        self.assertEqual(r['portfolio_percentage'], Decimal('100'))
+        self.assertEqual(PortfolioAssetConsolidated.objects.get(
+            asset__ticker='ITSA0').market_price, Decimal('25'))
+
+    def test_total_cost_portfolio(self):
+        # ITSA0 sold out, only the positions held count
+        PortfolioAssetConsolidated.objects.filter(
+            asset__ticker='ITSA0').update(quantity=Decimal('0'))
+        expected = sum(ac.quantity * ac.avg_p_price_nczp for ac in
+            PortfolioAssetConsolidated.objects.exclude(asset__ticker='ITSA0'))
+        with self.assertNumQueries(1):
+            total = get_total_cost_portfolio(portfolio=self.portfolio)
+        self.assertEqual(total, expected)
+        self.assertNotEqual(total, 0)
+
+    def test_results_consolidate_queries(self):
+        # One joined select, no write while prices are unchanged
+        self.user.has_perm('portfolio.add_portfolioassetconsolidated')
+        with self.assertNumQueries(1):
+            results = get_results_consolidate(portfolio=self.portfolio,
+                user=self.user)
+        self.assertEqual(len(results), 3)
+
+class ConsolidatePortfolioTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.date = timezone.now() - timezone.timedelta(days=30)
+        self.assets = {ticker: self.util.get_standard_asset(ticker=ticker,
+            type_investment='STOCK') for ticker in ('ITSA4', 'BBAS3', 'PETR4')}
+        self._buy('ITSA4', 10, 0)
+        self._buy('BBAS3', 5, 1)
+        # get_all_assets_portfolio runs DISTINCT ON, postgres only
+        patch = mock.patch('portfolio.services.get_all_assets_portfolio',
+            side_effect=lambda portfolio: Asset.objects.filter(
+                transaction__portfolio=portfolio).distinct())
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _buy(self, ticker, quantity, days):
+        asset = self.assets[ticker]
+        return Transaction.objects.create(portfolio=self.portfolio,
+            type_transaction='B', type_investment=asset.type_investment,
+            transaction_date=self.date + timezone.timedelta(days=days),
+            asset=asset, quantity=Decimal(quantity), unit_cost=Decimal('10'),
+            other_costs=Decimal('0'))
+
+    def _consolidate(self, **kwargs):
+        return consolidate_scheduled_portfolio(portfolio_id=self.portfolio.pk,
+            **kwargs)
+
+    def _quantities(self):
+        return dict(PortfolioAssetConsolidated.objects.filter(
+            portfolio=self.portfolio).values_list('asset__ticker', 'quantity'))
+
+    def test_consolidation_bulk_saves(self):
+        self.assertTrue(self._consolidate())
+        self.assertEqual(self._quantities(), {'ITSA4': Decimal('10'),
+            'BBAS3': Decimal('5')})
+
+        # One changed row and one new row
+        self._buy('ITSA4', 4, 2)
+        self._buy('PETR4', 3, 2)
+        table = PortfolioAssetConsolidated._meta.db_table
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(self._consolidate())
+        # One INSERT for the new rows and one UPDATE for the changed ones
+        writes = [q['sql'].split()[0] for q in ctx.captured_queries
+            if q['sql'].startswith(('INSERT INTO "%s"' % table,
+                'UPDATE "%s"' % table))]
+        self.assertEqual(writes, ['INSERT', 'UPDATE'])
+        self.assertEqual(self._quantities(), {'ITSA4': Decimal('14'),
+            'BBAS3': Decimal('5'), 'PETR4': Decimal('3')})
+        ac = PortfolioAssetConsolidated.objects.get(asset__ticker='ITSA4')
+        self.assertEqual(ac.total_cost, Decimal('-140'))
+        self.assertGreater(ac.last_update, self.date)
+
+    def test_row_committed_during_run(self):
+        from portfolio import services
+        replay = services._replay_positions
+        late = []
+
+        def replay_then_commit(**kwargs):
+            positions = replay(**kwargs)
+            # Committed by another writer after the replay read the rows
+            late.append(self._buy('ITSA4', 2, 3))
+            return positions
+
+        with mock.patch.object(services, '_replay_positions',
+                replay_then_commit):
+            self._consolidate()
+        self.assertEqual(self._quantities()['ITSA4'], Decimal('10'))
+        self.assertFalse(Transaction.objects.get(pk=late[0].pk).consolidated)
+
+        # Applied by the next run
+        Portfolio.objects.filter(pk=self.portfolio.pk).update(consolidated=False)
+        self._consolidate()
+        self.assertEqual(self._quantities()['ITSA4'], Decimal('12'))
+        self.assertFalse(Transaction.objects.filter(consolidated=False).exists())
+
+    def test_incremental_and_full(self):
+        from portfolio import services
+        self._consolidate()
+        self._buy('ITSA4', 4, 2)
+        with mock.patch.object(services, '_replay_positions',
+                wraps=services._replay_positions) as replay:
+            self._consolidate()
+        # Only the new transaction is applied on the stored position
+        replay.assert_called_once()
+        self.assertEqual(list(replay.call_args[1]['assets']),
+            [self.assets['ITSA4']])
+        self.assertIn('positions', replay.call_args[1])
+
+        with mock.patch.object(services, '_replay_positions',
+                wraps=services._replay_positions) as replay:
+            self._consolidate(full=True)
+        # Every asset replayed from its whole history
+        replay.assert_called_once()
+        self.assertEqual({a.ticker for a in replay.call_args[1]['assets']},
+            {'ITSA4', 'BBAS3'})
+        self.assertNotIn('positions', replay.call_args[1])
+        self.assertEqual(self._quantities(), {'ITSA4': Decimal('14'),
+            'BBAS3': Decimal('5')})
+        self.assertFalse(Transaction.objects.filter(consolidated=False).exists())
+
+    def test_create_transaction_keeps_version(self):
+        stale = Portfolio.objects.get(pk=self.portfolio.pk)
+        self._consolidate()
+        version = Portfolio.objects.get(pk=self.portfolio.pk).consolidation_version
+        with mock.patch('portfolio.services.task_refresh_price') as refresh:
+            create_transaction(portfolio=stale, type_transaction='B',
+                asset=self.assets['ITSA4'], quantity=Decimal('1'),
+                unit_cost=Decimal('10'))
+        refresh.assert_called_once_with(ticker='ITSA4')
+        portfolio = Portfolio.objects.get(pk=self.portfolio.pk)
+        self.assertFalse(portfolio.consolidated)
+        self.assertEqual(portfolio.consolidation_version, version)
+
+    def test_task_full(self):
+        from portfolio import tasks
+        with mock.patch('portfolio.services.consolidate_scheduled_portfolio',
+                return_value=True) as consolidate:
+            tasks.consolidate_scheduled_portfolio(self.portfolio.pk, full=True)
+            tasks.consolidate_scheduled_portfolio(self.portfolio.pk)
+        self.assertEqual(consolidate.call_args_list, [
+            mock.call(portfolio_id=self.portfolio.pk, full=True),
+            mock.call(portfolio_id=self.portfolio.pk)])
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentConsolidationTestCase(TransactionTestCase):
+    # Each run has its own thread and connection, sqlite has no row locks
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        asset = self.util.get_standard_asset(ticker='ITSA4',
+            type_investment='STOCK')
+        patch = mock.patch('portfolio.services.task_consolidate_portfolio')
+        patch.start()
+        self.addCleanup(patch.stop)
+        Transaction.objects.create(portfolio=self.portfolio,
+            type_transaction='B', type_investment=asset.type_investment,
+            transaction_date=timezone.now(), asset=asset,
+            quantity=Decimal('10'), unit_cost=Decimal('10'),
+            other_costs=Decimal('0'))
+
+    def test_concurrent_runs(self):
+        from portfolio import services
+        replay = services._replay_positions
+        started = threading.Event()
+        release = threading.Event()
+        replayed_by = set()
+        results = []
+
+        def slow_replay(**kwargs):
+            replayed_by.add(threading.get_ident())
+            started.set()
+            release.wait(5)
+            return replay(**kwargs)
+
+        def run():
+            try:
+                results.append(consolidate_scheduled_portfolio(
+                    portfolio_id=self.portfolio.pk))
+            finally:
+                connection.close()
+
+        with mock.patch.object(services, '_replay_positions', slow_replay):
+            first = threading.Thread(target=run)
+            first.start()
+            self.assertTrue(started.wait(5))
+            second = threading.Thread(target=run)
+            second.start()
+            # The second run waits on the portfolio row
+            second.join(0.5)
+            self.assertTrue(second.is_alive())
+            release.set()
+            first.join(5)
+            second.join(5)
+
+        # Only the first run did the work, the second reused it
+        self.assertEqual(results, [True, True])
+        self.assertEqual(len(replayed_by), 1)
+        self.assertEqual(PortfolioAssetConsolidated.objects.get(
+            portfolio=self.portfolio).quantity, Decimal('10'))
+
+class PortfolioDetailCacheTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+
+    def _key(self):
+        return get_portfolio_detail_cache_key(portfolio=self.portfolio,
+            user=self.user)
+
+    def test_detail_cache_key(self):
+        asset = self.util.get_standard_asset(ticker='ITSA4',
+            type_investment='STOCK')
+        PortfolioAssetConsolidated.objects.create(portfolio=self.portfolio,
+            asset=asset)
+        key = self._key()
+        self.assertEqual(key, self._key())
+
+        # A price refreshed by another process
+        Asset.objects.filter(pk=asset.pk).update(current_price=Decimal('12'),
+            last_update=timezone.now() + timezone.timedelta(seconds=1))
+        self.assertNotEqual(key, self._key())
+
+        key = self._key()
+        self.portfolio.consolidated = not self.portfolio.consolidated
+        self.assertNotEqual(key, self._key())
+
+        key = self._key()
+        self.portfolio.consolidation_version += 1
+        self.assertNotEqual(key, self._key())
+
+class ScheduleConsolidationTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.now = timezone.now()
+        self.task = mock.Mock()
+        # The consolidation itself runs DISTINCT ON, postgres only
+        self.consolidate = mock.Mock(return_value=True)
+        patches = [
+            mock.patch('portfolio.services._now',
+                side_effect=lambda: self.now),
+            mock.patch('portfolio.services.task_consolidate_portfolio',
+                self.task),
+            mock.patch('portfolio.services.consolidate_scheduled_portfolio',
+                self.consolidate),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _tick(self, seconds):
+        self.now += timezone.timedelta(seconds=seconds)
+
+    def _countdowns(self):
+        return [c[1]['countdown'] for c in self.task.call_args_list]
+
+    @override_settings(CONSOLIDATION_DEBOUNCE=5, CONSOLIDATION_MAX_DELAY=60)
+    def test_trailing_debounce(self):
+        schedule_consolidation(portfolio_id=self.portfolio.pk)
+        self._tick(3)
+        schedule_consolidation(portfolio_id=self.portfolio.pk)
+        # One run pending
+        self.assertEqual(self._countdowns(), [5])
+
+        # Moved to 5 seconds after the last write
+        self._tick(2)
+        self.assertIsNone(consolidate_debounced_portfolio(
+            portfolio_id=self.portfolio.pk))
+        self.assertEqual(self._countdowns(), [5, 3])
+        self.consolidate.assert_not_called()
+
+        self._tick(3)
+        self.assertTrue(consolidate_debounced_portfolio(
+            portfolio_id=self.portfolio.pk))
+        self.consolidate.assert_called_once_with(
+            portfolio_id=self.portfolio.pk)
+
+        # A later write schedules a new run
+        schedule_consolidation(portfolio_id=self.portfolio.pk)
+        self.assertEqual(self._countdowns(), [5, 3, 5])
+
+    @override_settings(CONSOLIDATION_DEBOUNCE=5, CONSOLIDATION_MAX_DELAY=20)
+    def test_state_in_database(self):
+        schedule_consolidation(portfolio_id=self.portfolio.pk)
+        # Nothing kept in the process, another one sees the pending run
+        cache.clear()
+        self._tick(1)
+        schedule_consolidation(portfolio_id=self.portfolio.pk)
+        self.assertEqual(self._countdowns(), [5])
+        portfolio = Portfolio.objects.get(pk=self.portfolio.pk)
+        self.assertEqual(portfolio.consolidation_due_at,
+            self.now + timezone.timedelta(seconds=5))
+
+        # The run was lost, a write long after sends a new one
+        self._tick(60)
+        schedule_consolidation(portfolio_id=self.portfolio.pk)
+        self.assertEqual(self._countdowns(), [5, 5])
+
+    @override_settings(CONSOLIDATION_DEBOUNCE=5, CONSOLIDATION_MAX_DELAY=20)
+    def test_max_delay(self):
+        for i in range(6):
+            schedule_consolidation(portfolio_id=self.portfolio.pk)
+            self._tick(4)
+        # Writes keep coming, the run is not postponed past the max delay
+        self.assertTrue(consolidate_debounced_portfolio(
+            portfolio_id=self.portfolio.pk))
+        self.assertEqual(self._countdowns(), [5])
+
+    def test_view_consolidating(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='add_portfolioassetconsolidated'))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('view_portfolio',
+            args=[self.portfolio.pk]))
+        self.assertContains(response, 'Consolidating...')
+        self.assertEqual(self._countdowns(), [5])
+
+        # Consolidated, nothing scheduled
+        Portfolio.objects.filter(pk=self.portfolio.pk).update(consolidated=True)
+        response = self.client.get(reverse('view_portfolio',
+            args=[self.portfolio.pk]))
+        self.assertNotContains(response, 'Consolidating...')
+        self.assertEqual(self.task.call_count, 1)
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImportTransactionsTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.util.get_standard_asset(ticker='ITSA4', type_investment='STOCK')
+        self.util.get_standard_asset(ticker='HGLG11', type_investment='FII')
+        self.header = 'ticker;transaction;date;qty;avg_price;currency;other_costs;desc_1'
+
+    def _lines(self, count, ticker='ITSA4'):
+        return [self.header] + ['%s;B;%02d/01/2020;10;R$ 10,5;R$;0,2;x' % (
+            ticker, i % 28 + 1) for i in range(count)]
+
+    def _run(self, lines, chunk_size=None):
+        job = create_import_job(user=self.user,
+            kind=ImportJobKind.TRANSACTIONS,
+            file=ContentFile('\n'.join(lines).encode(), name='t.csv'),
+            portfolio=self.portfolio)
+        return run_import_job(job_id=job.pk, chunk_size=chunk_size)
+
+    def test_import_transactions(self):
+        lines = self._lines(3) + ['HGLG11;S;10/02/2020;5;100;R$;;']
+        job = self._run(lines)
+
+        self.assertEqual(job.imported_rows, 4)
+        t = Transaction.objects.filter(asset__ticker='ITSA4').first()
+        self.assertEqual(t.unit_cost, Decimal('10.5'))
+        self.assertEqual(t.other_costs, Decimal('0.2'))
+        self.assertEqual(t.type_investment.name, 'STOCK')
+        self.assertFalse(t.consolidated)
+        self.assertEqual(PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio, asset__ticker='HGLG11').quantity, Decimal('-5'))
+        self.assertFalse(Portfolio.objects.get(pk=self.portfolio.pk).consolidated)
+
+    def test_import_transactions_errors(self):
+        lines = self._lines(2) + [
+            'XPTO3;B;01/01/2020;1;1;R$;0;',
+            'ITSA4;X;01/01/2020;1;1;R$;0;',
+            'ITSA4;B;31/02/2020;1;1;R$;0;',
+            'ITSA4;B;01/01/2020;1;abc;R$;0;',
+        ]
+        job = self._run(lines, chunk_size=2)
+        self.assertEqual(job.error_count, 4)
+        self.assertTrue(job.errors.startswith('Line 4:'))
+        # The valid rows are kept
+        self.assertEqual(job.imported_rows, 2)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_import_transactions_queries(self):
+        self._run(self._lines(1))
+        with CaptureQueriesContext(connection) as small:
+            self._run(self._lines(5))
+        with CaptureQueriesContext(connection) as large:
+            self._run(self._lines(500))
+        # Only the INSERTs grow with the file, split by the backend's limits
+        def count(ctx):
+            return len([q for q in ctx.captured_queries
+                if not q['sql'].startswith('INSERT')])
+        self.assertEqual(count(small), count(large))
+
+    def test_positions_rebuilt_once(self):
+        from portfolio import services
+        lines = self._lines(6) + ['HGLG11;B;10/02/2020;5;100;R$;;'] * 3
+        with mock.patch.object(services, 'refresh_zeroed_position',
+                    wraps=services.refresh_zeroed_position) as rebuild, \
+                mock.patch.object(services, 'schedule_consolidation') as schedule:
+            self._run(lines, chunk_size=2)
+        self.assertEqual(sorted(c[1]['asset'].ticker
+            for c in rebuild.call_args_list), ['HGLG11', 'ITSA4'])
+        schedule.assert_called_once_with(portfolio_id=self.portfolio.pk)
+        self.assertEqual(PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio, asset__ticker='ITSA4').quantity, Decimal('60'))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImportJobTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.util.get_standard_asset(ticker='ITSA4', type_investment='STOCK')
+        lines = ['ticker;transaction;date;qty;avg_price;currency;other_costs;desc_1']
+        lines += ['ITSA4;B;%02d/01/2020;10;10;R$;0;x' % (i + 1) for i in range(5)]
+        lines.insert(3, 'XPTO3;B;01/01/2020;1;1;R$;0;')
+        self.job = create_import_job(user=self.user,
+            kind=ImportJobKind.TRANSACTIONS,
+            file=ContentFile('\n'.join(lines).encode(), name='t.csv'),
+            portfolio=self.portfolio)
+
+    def test_run_import_job(self):
+        job = run_import_job(job_id=self.job.pk, chunk_size=2)
+
+        self.assertEqual(job.status, ImportJobStatus.DONE)
+        self.assertEqual(job.total_rows, 6)
+        self.assertEqual(job.processed_rows, 6)
+        self.assertEqual(job.imported_rows, 5)
+        self.assertEqual(job.error_count, 1)
+        self.assertEqual(job.errors, 'Line 4: Unknown asset XPTO3\n')
+        self.assertEqual(Transaction.objects.count(), 5)
+        self.assertEqual(PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio).quantity, Decimal('50'))
+
+        # Done jobs are not run again
+        run_import_job(job_id=self.job.pk, chunk_size=2)
+        self.assertEqual(Transaction.objects.count(), 5)
+
+    def test_resume_import_job(self):
+        from portfolio import services
+        chunk = services._import_transactions_chunk
+        calls = []
+
+        def crash(**kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise RuntimeError
+            return chunk(**kwargs)
+
+        Portfolio.objects.filter(pk=self.portfolio.pk).update(consolidated=True)
+        with mock.patch.object(services, '_import_transactions_chunk', crash):
+            with self.assertRaises(RuntimeError):
+                run_import_job(job_id=self.job.pk, chunk_size=2)
+        job = ImportJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.status, ImportJobStatus.FAILED)
+        self.assertEqual(job.processed_rows, 2)
+        self.assertEqual(Transaction.objects.count(), 2)
+        # The committed rows are not left behind a consolidated portfolio
+        self.assertFalse(Portfolio.objects.get(pk=self.portfolio.pk).consolidated)
+        self.assertEqual(PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio).quantity, Decimal('20'))
+
+        self.assertTrue(resume_import_job(user=self.user, job=job))
+        job = run_import_job(job_id=self.job.pk, chunk_size=2)
+        self.assertEqual(job.status, ImportJobStatus.DONE)
+        self.assertEqual(job.imported_rows, 5)
+        self.assertEqual(Transaction.objects.count(), 5)
+        # Includes the rows committed before the crash
+        self.assertEqual(PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio).quantity, Decimal('50'))
+
+    def test_create_import_job_permission(self):
+        other = User.objects.create(username='other')
+        with self.assertRaises(exceptions.PermissionDenied):
+            create_import_job(user=other, kind=ImportJobKind.TRANSACTIONS,
+                file=ContentFile(b'', name='t.csv'), portfolio=self.portfolio)
+
+
+class ImportAssetsTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.asset = self.util.get_standard_asset(ticker='ITSA4',
+            type_investment='STOCK')
+        Asset.objects.filter(pk=self.asset.pk).update(name='Itausa',
+            current_price=Decimal('10'))
+
+    def _info(self, ticker):
+        if ticker == 'FAIL3':
+            raise requests.ConnectionError
+        return {'symbol': ticker + '.SA', 'longname': 'Long ' + ticker,
+            'shortname': 'Short ' + ticker}
+
+    def test_import_assets(self):
+        batch = list(enumerate([
+            {'ticker': 'ITSA4', 'type_investment': 'STOCK', 'desc_3': 'x'},
+            {'ticker': 'HGLG11', 'name': 'CSHG', 'type_investment': 'FII'},
+            {'ticker': 'FAIL3', 'type_investment': 'STOCK'},
+            {'ticker': '', 'type_investment': 'STOCK'},
+            {'ticker': 'TOOLONG11', 'type_investment': 'STOCK'},
+        ], start=2))
+        with mock.patch('portfolio.services.get_ticker_info',
+                side_effect=lambda ticker: self._info(ticker)):
+            imported, errors = import_assets(batch=batch)
+
+        self.assertEqual(imported, 3)
+        self.assertEqual([e[:7] for e in errors], ['Line 5:', 'Line 6:'])
+        asset = Asset.objects.get(ticker='ITSA4')
+        self.assertEqual(asset.name, 'Itausa')
+        self.assertEqual(asset.desc_3, 'x')
+        self.assertEqual(asset.current_price, Decimal('10'))
+        asset = Asset.objects.get(ticker='HGLG11')
+        self.assertEqual((asset.name, asset.desc_2), ('CSHG', 'HGLG11.SA'))
+        self.assertEqual(asset.type_investment.name, 'FII')
+        self.assertIsNotNone(asset.info_updated_at)
+        placeholder = Asset.objects.get(ticker='FAIL3')
+        self.assertEqual(placeholder.name, 'FAIL3')
+        self.assertIsNone(placeholder.info_updated_at)
+
+        with mock.patch('portfolio.services.get_ticker_info',
+                side_effect=lambda ticker: self._info('OK')):
+            self.assertEqual(enrich_assets(), 1)
+        placeholder.refresh_from_db()
+        self.assertEqual(placeholder.name, 'Long OK')
+        self.assertIsNotNone(placeholder.info_updated_at)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_import_assets_job(self):
+        last_update = Asset.objects.get(pk=self.asset.pk).last_update
+        lines = ['ticker;name;type_investment;currency;desc_1;desc_2;desc_3',
+            'ITSA4;;STOCK;R$;;;', 'HGLG11;CSHG;FII;R$;;;']
+        job = create_import_job(user=TestUtils().get_standard_user(),
+            kind=ImportJobKind.ASSETS,
+            file=ContentFile('\n'.join(lines).encode(), name='a.csv'))
+        # The lookups run outside the chunk transaction
+        savepoints = len(connection.savepoint_ids)
+        depths = []
+
+        def lookup(tickers):
+            depths.append(len(connection.savepoint_ids))
+            return {t: self._info(t) for t in tickers}
+
+        with mock.patch('portfolio.services.get_tickers_info',
+                side_effect=lookup):
+            job = run_import_job(job_id=job.pk, chunk_size=1)
+
+        self.assertEqual(job.imported_rows, 2)
+        self.assertEqual(depths, [savepoints, savepoints])
+        asset = Asset.objects.get(pk=self.asset.pk)
+        self.assertEqual(asset.symbol, 'ITSA4.SA')
+        # last_update is the time of the price, an import leaves it alone
+        self.assertEqual(asset.last_update, last_update)
+
+    def test_get_tickers_info_concurrent(self):
+        # Every lookup waits for the others, they only finish if they run
+        # at the same time
+        barrier = threading.Barrier(4, timeout=5)
+
+        def lookup(ticker):
+            barrier.wait()
+            return {'symbol': ticker}
+
+        with mock.patch('portfolio.services.get_ticker_info',
+                side_effect=lookup):
+            infos = get_tickers_info(tickers=['A', 'B', 'C', 'D'],
+                max_workers=4)
+        self.assertEqual(infos['C'], {'symbol': 'C'})
+
+
+class AssetSymbolCacheTestCase(TestCase):
+
+    def setUp(self):
+        # No circuit breaker state from other tests
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.util = TestUtils()
+        self.asset = self.util.get_standard_asset(ticker='ITSA4',
+            type_investment='STOCK')
+        self.urls = []
+
+    def _session(self):
+        return mock.patch('portfolio.quotes.get_session',
+            return_value=mock.Mock(get=self._get))
+
+    def _get(self, url, **kwargs):
+        self.urls.append(url)
+        if 'search' in url:
+            body = {'quotes': [{'symbol': 'ITSA4.SA', 'longname': 'Itausa',
+                'shortname': 'ITAUSA PN'}]}
+        else:
+            body = {'chart': {'result': [{'meta': {
+                'regularMarketPrice': 10.5, 'currency': 'BRL'}}]}}
+        return mock.Mock(status_code=200, json=lambda: body)
+
+    def test_refresh_price_uses_stored_symbol(self):
+        ac = PortfolioAssetConsolidated.objects.create(asset=self.asset,
+            portfolio=self.util.get_standard_portfolio(
+                user=self.util.get_standard_user()),
+            quantity=Decimal('2'))
+        with self._session():
+            self.assertTrue(refresh_current_price(ticker='ITSA4'))
+            # The first refresh looks the symbol up and stores it
+            self.assertEqual(len(self.urls), 2)
+            self.assertTrue(refresh_current_price(ticker='ITSA4'))
+            self.assertEqual(len(self.urls), 3)
+            self.assertTrue(self.urls[-1].endswith('ITSA4.SA'))
+
+        self.asset.refresh_from_db()
+        self.assertEqual(self.asset.symbol, 'ITSA4.SA')
+        self.assertEqual(self.asset.current_price, Decimal('10.5'))
+        ac.refresh_from_db()
+        self.assertEqual(ac.total_current, Decimal('21'))
+
+    def test_refresh_price_without_symbol(self):
+        with mock.patch.object(self, '_get', return_value=mock.Mock(
+                status_code=200, json=lambda: {'quotes': []})) as get, \
+                self._session():
+            self.assertFalse(refresh_current_price(ticker='ITSA4'))
+        # One search, no price request
+        self.assertEqual(get.call_count, 1)
+
+    def test_symbol_ttl(self):
+        Asset.objects.filter(pk=self.asset.pk).update(symbol='OLD.SA',
+            info_updated_at=timezone.now() - timezone.timedelta(days=30))
+        with self._session():
+            refresh_current_price(ticker='ITSA4')
+        self.assertEqual(len(self.urls), 2)
+        self.assertEqual(Asset.objects.get(pk=self.asset.pk).symbol, 'ITSA4.SA')
+
+        with self._session():
+            self.assertTrue(refresh_asset_info(asset=self.asset))
+        self.assertEqual(len(self.urls), 3)
+
+
+class RefreshPricesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.util = TestUtils()
+        user = self.util.get_standard_user()
+        portfolio = self.util.get_standard_portfolio(user=user)
+        for i in range(5):
+            asset = self.util.get_standard_asset(ticker='ITSA%s' % i,
+                type_investment='STOCK')
+            PortfolioAssetConsolidated.objects.create(portfolio=portfolio,
+                asset=asset)
+        Asset.objects.exclude(ticker='ITSA4').update(
+            symbol=Concat('ticker', Value('.SA')), info_updated_at=timezone.now())
+        # Not held by any portfolio
+        self.util.get_standard_asset(ticker='XPTO3', type_investment='STOCK')
+        self.urls = []
+
+    def _session(self):
+        return mock.patch('portfolio.quotes.get_session',
+            return_value=mock.Mock(get=self._get))
+
+    def _get(self, url, **kwargs):
+        self.urls.append(url)
+        if 'search' in url:
+            ticker = url.rsplit('=', 1)[1]
+            body = {'quotes': [{'symbol': ticker + '.SA', 'longname': ticker,
+                'shortname': ticker}]}
+        elif 'quote' in url:
+            symbols = url.rsplit('=', 1)[1].split(',')
+            body = {'quoteResponse': {'result': [{'symbol': s,
+                'regularMarketPrice': 10 + int(s[4])} for s in symbols
+                if s.startswith('ITSA')]}}
+        elif 'GONE' in url:
+            body = {'chart': {'result': None}}
+        else:
+            body = {'chart': {'result': [{'meta': {
+                'regularMarketPrice': 7.5}}]}}
+        return mock.Mock(status_code=200, json=lambda: body)
+
+    def test_refresh_prices(self):
+        with self._session():
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(refresh_prices(chunk_size=3), 5)
+
+        # A search for the asset without symbol and one quote per chunk
+        self.assertEqual(len(self.urls), 3)
+        self.assertEqual(len([q for q in ctx.captured_queries
+            if q['sql'].startswith('UPDATE "%s"' % Asset._meta.db_table)]), 2)
+        prices = dict(Asset.objects.values_list('ticker', 'current_price'))
+        self.assertEqual(prices['ITSA2'], Decimal('12'))
+        # The held positions follow the new prices
+        self.assertEqual(PortfolioAssetConsolidated.objects.get(
+            asset__ticker='ITSA2').market_price, Decimal('12'))
+        self.assertEqual(prices['ITSA4'], Decimal('14'))
+        self.assertEqual(prices['XPTO3'], Decimal('0'))
+        self.assertEqual(Asset.objects.get(ticker='ITSA4').symbol, 'ITSA4.SA')
+
+    def test_refresh_prices_without_quotes_url(self):
+        with mock.patch.dict(os.environ, {'SERVICE_QUOTES_URL': ''}), \
+                self._session():
+            self.assertEqual(refresh_prices(tickers=['ITSA0', 'ITSA1']), 2)
+        self.assertEqual(len(self.urls), 2)
+        self.assertEqual(Asset.objects.get(ticker='ITSA1').current_price,
+            Decimal('7.5'))
+
+    def test_refresh_prices_quotes_fallback(self):
+        # Left out of the batch answer, then priced by its chart
+        Asset.objects.filter(ticker='ITSA3').update(symbol='VALE3.SA')
+        with self._session():
+            self.assertEqual(refresh_prices(tickers=['ITSA2', 'ITSA3']), 2)
+        self.assertEqual(len(self.urls), 2)
+        self.assertTrue(self.urls[1].endswith('/VALE3.SA'))
+        prices = dict(Asset.objects.values_list('ticker', 'current_price'))
+        self.assertEqual(prices['ITSA2'], Decimal('12'))
+        self.assertEqual(prices['ITSA3'], Decimal('7.5'))
+
+    def test_refresh_prices_unpriced(self):
+        Asset.objects.filter(ticker='ITSA3').update(symbol='GONE.SA')
+        with self._session(), \
+                self.assertLogs('portfolio.services', 'WARNING') as logs:
+            self.assertEqual(refresh_prices(), 4)
+        self.assertIn('No price for 1 of 5 assets: ITSA3', logs.output[0])
+
+    def test_refresh_prices_circuit_open(self):
+        with self._session():
+            quotes.CircuitBreaker('query1.finance.yahoo.com')._open()
+            with self.assertRaises(quotes.QuoteServiceCircuitOpen):
+                refresh_prices()
+        self.assertEqual(self.urls, [])
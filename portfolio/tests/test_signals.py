@@ -0,0 +1,79 @@
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.utils import timezone
+from portfolio.models import (
+    Portfolio,
+    Transaction,
+    PortfolioAssetZeroedPosition
+)
+from portfolio.signals import deferred_unconsolidation
+from portfolio.tests.utils import TestUtils
+from decimal import Decimal
+
+class DeferredUnconsolidationTestCase(TestCase):
+
+    def setUp(self):
+        self.util = TestUtils()
+        self.user = self.util.get_standard_user()
+        self.portfolio = self.util.get_standard_portfolio(user=self.user)
+        self.stock = self.util.get_standard_asset(ticker='ITSA4',
+            type_investment='STOCK')
+        self.date = timezone.now() - timezone.timedelta(days=100)
+
+    def _create(self, count, type_transaction='B'):
+        for i in range(count):
+            Transaction.objects.create(
+                portfolio=self.portfolio,
+                type_transaction=type_transaction,
+                transaction_date=self.date + timezone.timedelta(days=i),
+                type_investment=self.stock.type_investment,
+                asset=self.stock,
+                quantity=Decimal('1'),
+                unit_cost=Decimal('10'),
+                consolidated=True)
+
+    def _position(self):
+        return PortfolioAssetZeroedPosition.objects.get(
+            portfolio=self.portfolio, asset=self.stock)
+
+    def test_deferred_saves(self):
+        with CaptureQueriesContext(connection) as small:
+            with deferred_unconsolidation():
+                self._create(2)
+        with CaptureQueriesContext(connection) as large:
+            with deferred_unconsolidation():
+                self._create(20)
+        # One INSERT per row, the dirty marks are written once
+        self.assertEqual(len(large) - len(small), 18)
+        self.assertEqual(self._position().quantity, Decimal('22'))
+        self.assertFalse(Transaction.objects.filter(consolidated=True).exists())
+        self.assertFalse(Portfolio.objects.get(pk=self.portfolio.pk).consolidated)
+
+    def test_deferred_delete(self):
+        self._create(3)
+        self._create(3, type_transaction='S')
+        Transaction.objects.update(consolidated=True)
+        with deferred_unconsolidation():
+            with deferred_unconsolidation():
+                Transaction.objects.filter(type_transaction='S').delete()
+            # Nested blocks are flushed by the outermost one
+            self.assertTrue(Transaction.objects.filter(consolidated=True).exists())
+        self.assertFalse(Transaction.objects.filter(consolidated=True).exists())
+        self.assertEqual(self._position().quantity, Decimal('3'))
+
+    def test_single_row(self):
+        self._create(2)
+        self.assertEqual(self._position().quantity, Decimal('2'))
+        Transaction.objects.last().delete()
+        self.assertEqual(self._position().quantity, Decimal('1'))
+
+    def test_portfolio_cascade_delete(self):
+        self._create(3)
+        with CaptureQueriesContext(connection) as ctx:
+            self.portfolio.delete()
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(PortfolioAssetZeroedPosition.objects.exists())
+        self.assertFalse([q for q in ctx.captured_queries
+            if q['sql'].startswith('UPDATE "portfolio_transaction"') or
+                q['sql'].startswith('INSERT')])
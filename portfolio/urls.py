@@ -9,5 +9,9 @@ urlpatterns = [
         path('asset/upload_file', views.asset_upload_file,
             name='asset_upload_file'),
         path('transactions/upload_file', views.transactions_upload_file,
-            name='transactions_upload_file')
+            name='transactions_upload_file'),
+        path('transactions/export', views.export_transactions,
+            name='export_transactions'),
+        path('results/export', views.export_results,
+            name='export_results')
 ]
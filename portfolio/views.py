@@ -1,40 +1,75 @@
 from django.shortcuts import render
-from django.http import Http404, HttpResponseRedirect
-from django.core.files.storage import FileSystemStorage
-from django.db import transaction
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    StreamingHttpResponse
+)
+from django.core import exceptions
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers
+)
+from django.utils.http import quote_etag
 from .models import Portfolio, PortfolioAssetConsolidated, Asset
 from portfolio.services import (
-    consolidate_portfolio,
+    schedule_consolidation,
     reconsolidate_portfolio as reconsolidate,
-    create_asset,
-    create_transaction,
     get_current_price,
-    validate_currency,
-    get_results_consolidate
+    get_results_consolidate,
+    get_portfolio_detail_cache_key,
+    create_import_job
     )
 from portfolio.selectors import (
     get_portfolios,
     get_assets,
     get_portfolio_consolidated,
-    get_assets_consolidated,
-    get_current_assets_portfolio
+    get_current_assets_portfolio,
+    get_transactions_user,
+    get_assets_consolidated_user
     )
+from portfolio.exports import (
+    TRANSACTION_FIELDS,
+    RESULT_FIELDS,
+    EXPORT_FORMATS,
+    get_export_filters,
+    stream_export
+    )
+from portfolio.constants import ImportJobKind
 from .forms import AssetUploadFileForm, TransactionUploadFileForm
-import decimal
-import csv, io, datetime
 
 def view_portfolio(request, portfolio_id):
     portfolio = get_portfolios(
         fetched_by=request.user, filters={'pk':portfolio_id}).get()
 
-    consolidate_portfolio(portfolio=portfolio, user=request.user)
-
-    portfolio_c = get_portfolio_consolidated(portfolio=portfolio).first()
-    assets_c = get_assets_consolidated(portfolio=portfolio, filters={'quantity__gt':0})
-    results = {r['ticker']: r for r in get_results_consolidate(portfolio=portfolio, user=request.user)}
-
-    return render(request, 'portfolio/detail.html',
-        {'asset_list': assets_c, 'results': results, 'portfolio': portfolio_c})
+    # Consolidation runs in background, the last snapshot is shown meanwhile
+    if not portfolio.consolidated:
+        schedule_consolidation(portfolio_id=portfolio.pk)
+
+    # The key changes with every consolidation, transaction write and price
+    # refresh of the portfolio, a page cached under it is still current
+    key = get_portfolio_detail_cache_key(portfolio=portfolio, user=request.user)
+    etag = quote_etag(key)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        content = cache.get(key)
+        if content is None:
+            portfolio_c = get_portfolio_consolidated(portfolio=portfolio).first()
+            results = get_results_consolidate(portfolio=portfolio, user=request.user)
+            asset_list = [r for r in results if r['quantity'] > 0]
+            content = render(request, 'portfolio/detail.html',
+                {'asset_list': asset_list, 'portfolio': portfolio_c,
+                    'consolidating': not portfolio.consolidated}).content
+            cache.set(key, content, timeout=settings.PORTFOLIO_DETAIL_CACHE_TIMEOUT)
+        response = HttpResponse(content)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
 
 def reconsolidate_portfolio(request, portfolio_id):
     portfolio = get_portfolios(
@@ -46,84 +81,64 @@ def asset_upload_file(request):
     if request.method == 'POST':
         form = AssetUploadFileForm(request.POST, request.FILES)
         if form.is_valid():
-            fs = FileSystemStorage()
-            myfile = request.FILES['myfile']
-
-            paramFile = io.TextIOWrapper(myfile)
-            portfolio1 = csv.DictReader(paramFile, delimiter=";")
-            list_of_dict = list(portfolio1)
-            for row in list_of_dict:
-                create_asset(ticker=row['ticker'],
-                    name=row['name'],
-                    type_investment=row['type_investment'],
-                    desc_1=row['desc_1'],
-                    desc_2=row['desc_2'],
-                    desc_3=row['desc_3'])
-
-            filename = fs.save(myfile.name, myfile)
-            uploaded_file_url = fs.url(filename)
-
+            job = create_import_job(user=request.user,
+                kind=ImportJobKind.ASSETS,
+                file=request.FILES['myfile'])
             return render(request, 'portfolio/upload_files.html', {
-                'uploaded_file_url': uploaded_file_url
-            })
+                'form': AssetUploadFileForm(), 'job': job})
     else:
         form = AssetUploadFileForm()
     return render(request, 'portfolio/upload_files.html', {'form': form})
 
 def transactions_upload_file(request):
-
-    def convert_str_dec(text):
-        dec = 0
-        text = text.lstrip()
-        text = text if len(text) > 0 else '0'
-        try:
-            text = text.replace(',','.')
-            text = text.replace('R$','')
-            text = text.replace('$','')
-            text = text.replace('€','')
-            dec = decimal.Decimal(text)
-        except decimal.InvalidOperation:
-            raise decimal.InvalidOperation
-        return dec
-
     if request.method == 'POST':
         form = TransactionUploadFileForm(request.user, request.POST, request.FILES)
         if form.is_valid():
-            fs = FileSystemStorage()
-            myfile = request.FILES['myfile']
             portfolio = get_portfolios(fetched_by=request.user).get(
-                pk=request.POST['portfolio'])
-
-            paramFile = io.TextIOWrapper(myfile)
-            lines = csv.DictReader(paramFile, delimiter=";")
-            list_of_dict = list(lines)
-            #print(list_of_dict)
-            with transaction.atomic():
-                for row in list_of_dict:
-                    asset = get_assets(filters={'ticker': row['ticker']})[0]
-                    if validate_currency(currency=row.get('currency', 'R$').lstrip()):
-                        currency = row.get('currency', 'R$').lstrip()
-                    else:
-                        raise Exception('Invalid Currency')
-
-                    t = create_transaction(
-                        portfolio = portfolio,
-                        type_transaction = row['transaction'].lstrip(),
-                        transaction_date = datetime.datetime.strptime(row['date']+' 00:00', '%d/%m/%Y %H:%M'),
-                        asset = asset,
-                        quantity = convert_str_dec(row['qty']),
-                        unit_cost = convert_str_dec(row['avg_price']),
-                        currency = currency,
-                        other_costs = convert_str_dec(row.get('other_costs', '0')),
-                        desc_1=row.get('desc_1', '')[0:20].lstrip(),
-                        desc_2=row.get('desc_2', '')[0:100].lstrip())
-
-            filename = fs.save(myfile.name, myfile)
-            uploaded_file_url = fs.url(filename)
-
+                pk=form.cleaned_data['portfolio'])
+            job = create_import_job(user=request.user,
+                kind=ImportJobKind.TRANSACTIONS,
+                file=request.FILES['myfile'],
+                portfolio=portfolio)
             return render(request, 'portfolio/upload_files.html', {
-                'uploaded_file_url': uploaded_file_url
-            })
+                'form': TransactionUploadFileForm(request.user), 'job': job})
     else:
         form = TransactionUploadFileForm(request.user)
     return render(request, 'portfolio/upload_files.html', {'form': form})
+
+def _export(request, name, queryset, fields, filters):
+    format = request.GET.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('Invalid format %s' % format)
+    try:
+        queryset = queryset.filter(**get_export_filters(**filters))
+    except exceptions.ValidationError as e:
+        return HttpResponseBadRequest('; '.join(e.messages))
+
+    response = StreamingHttpResponse(
+        stream_export(queryset=queryset, fields=fields, format=format),
+        content_type='text/csv' if format == 'csv' else 'application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+        name, format)
+    return response
+
+def export_transactions(request):
+    return _export(request, 'transactions',
+        get_transactions_user(user=request.user),
+        TRANSACTION_FIELDS,
+        {
+            'portfolio': request.GET.get('portfolio'),
+            'asset': request.GET.get('asset'),
+            'date_from': request.GET.get('date_from'),
+            'date_to': request.GET.get('date_to'),
+            'type_transaction': request.GET.get('type_transaction'),
+        })
+
+def export_results(request):
+    return _export(request, 'results',
+        get_assets_consolidated_user(user=request.user),
+        RESULT_FIELDS,
+        {
+            'portfolio': request.GET.get('portfolio'),
+            'asset': request.GET.get('asset'),
+        })